@@ -1,73 +1,53 @@
 import os
+import sys
 import gdb
 import struct
 
-# Register addresses
-RCC_APB2ENR = 0x40021018
-AFIO_MAPR = 0x40010004
-# Debug MCU configuration register
-DBGMCU_CR = 0xe0042004
-# Debud Exception and Monitor Control Register; we need to set the TRCENA bit to enable access to the TPIU
-COREDEBUG_DEMCR = 0xe000edfc
-# TPIU Acychronous Clock Prescaler Register
-TPI_ACPR = 0xe0040010
-# TPIO Selected Pin Protocol Register
-TPI_SPPR = 0xe00400f0
-# Formatter and flush control register
-TPI_FFCR = 0xe0040304
-# Device ID - if last bit is set, we have ETM enabled - Cortex M4 manual, page 106
-TPI_DEV_ID = 0xE0040FC8
-# Data Watchpoint and Trace Control Register - defined in ARMv7 Architecture Manual page 879
-DWT_CTRL = 0xe0001000
-# ITM Lock Access Register
-ITM_LAR = 0xe0000fb0
-# ITM Trace Control Register
-ITM_TCR = 0xe0000e80
-# ITM Trace Enable - Each bit corresponds to a stimulus port to enable
-ITM_TER = 0xe0000e00
-# ITM Trace Privilege Register - enabled various tracing ports
-ITM_TPR = 0xE0000E40
-ETM_LAR = 0xe0041fb0
-ETM_CR = 0xe0041000
-ETM_TRACEIDR = 0xe0041200
-ETM_TECR1 = 0xe0041024
-ETM_FFRR = 0xe0041028
-ETM_FFLR = 0xe004102c
-# ETM Trigger Event Register
-ETM_TER = 0xe0041008
-ETM_TEE	= 0xE0041020
+# regmap.py sits next to this file, GDB doesn't put that on the path when sourcing it
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from regmap import (RegisterMap, GDBTarget, VerifyError, write, set_bits, clear_bits,
+                    enable_dbg, configure_tpiu, enable_etm, enable_itm, trace_config)
+# The register addresses, etm.py's names for them
+from regmap import (RCC_APB2ENR, AFIO_MAPR, DBGMCU_CR, COREDEBUG_DEMCR, TPI_ACPR, TPI_SPPR, TPI_FFCR,
+                    TPI_DEV_ID, DWT_CTRL, ITM_LAR, ITM_TCR, ITM_TER, ITM_TPR, ETM_LAR, ETM_CR,
+                    ETM_TRACEIDR, ETM_TECR1, ETM_FFRR, ETM_FFLR, ETM_TER, ETM_TEE)
 
+# Print every register access
+VERBOSE = False
+
+# One inferior lookup, and the register values written so far, for the whole session - dropped
+# when DEMCR shows the target was reset since (see regmap.py)
+REGISTERS = RegisterMap(GDBTarget())
+
+
+def apply(stages, from_tty=False):
+    try:
+        plan = REGISTERS.apply(stages)
+    except VerifyError as error:
+        raise gdb.GdbError(str(error))
+    if VERBOSE or from_tty:
+        print(f"{plan.writes} registers written in {len(plan.blocks)} transfers, {plan.skipped} already set, verified")
+    return plan
 
 def writeInt(address,value):
-    target = gdb.inferiors()[0]
-    target.write_memory(address,struct.pack("I",value),4)
-    return
+    if VERBOSE:
+        print(f"Writing memory value 0x{value:08X} at address 0x{address:X}")
+    apply([[write(address, value)]])
 
 def writeShort(address,value):
-     target = gdb.inferiors()[0]
-     target.write_memory(address,struct.pack("H",value),2)
-     return
+     REGISTERS.target.inferior.write_memory(address,struct.pack("H",value),2)
+     REGISTERS.invalidate([REGISTERS.name(address & ~3)])
 
 # We are running on a firmware image here, no threading so this _should_ be OK.
 def setBit(address,mask):
-    target = gdb.inferiors()[0]
-    targetVal = target.read_memory(address,4)
-    targetVal = struct.unpack("I",targetVal.tobytes())[0]
-    print(f"Read memory value 0x{targetVal:08X} at address 0x{address:X}")
-    targetVal |= mask
-    print(f"Writing memory value 0x{targetVal:08X} at address 0x{address:X}")
-    targetVal = target.write_memory(address,struct.pack("I",targetVal),4)
-    return
+    if VERBOSE:
+        print(f"Setting bits 0x{mask:08X} at address 0x{address:X}")
+    apply([[set_bits(address, mask)]])
 
 def clearBit(address,mask):
-    target = gdb.inferiors()[0]
-    targetVal = target.read_memory(address,4)
-    targetVal = struct.unpack("I",targetVal.tobytes())[0]
-    print(f"Read memory value 0x{targetVal:08X} at address 0x{address:X}")
-    targetVal &= ~mask
-    print(f"Writing memory value 0x{targetVal:08X} at address 0x{address:X}")
-    targetVal = target.write_memory(address,struct.pack("I",targetVal),4)
-    return
+    if VERBOSE:
+        print(f"Clearing bits 0x{mask:08X} at address 0x{address:X}")
+    apply([[clear_bits(address, mask)]])
 
 class enableDBG(gdb.Command):
     def __init__(self):
@@ -75,8 +55,7 @@ class enableDBG(gdb.Command):
             "enableDBG", gdb.COMMAND_USER
         )
     def invoke(self, args, from_tty):
-        setBit(DBGMCU_CR,0x20)
-        setBit(COREDEBUG_DEMCR,0x1000000)
+        apply(enable_dbg(), from_tty)
 
 class configureTPIU(gdb.Command):
     def __init__(self):
@@ -85,11 +64,8 @@ class configureTPIU(gdb.Command):
                 )
 
     def invoke(self,args,from_tty):
-        writeInt(TPI_ACPR, 15) # Trace clock divider HCLK/(x+1)
-        # TPIO Reg - Selected pin protocol
-        writeInt(TPI_SPPR,2)# Pin protocol: 0 = Sync Trace Port Mode, 1 = NRZ, 2 =USART, 3 = Reserved
-        # TPIO Reg: Formatter and flush control
-        writeInt(TPI_FFCR,0x102)# Enable TPIU framing (0x100 to disable)
+        # Trace clock divider HCLK/(x+1), UART pin protocol, TPIU framing - see regmap.configure_tpiu
+        apply(configure_tpiu(int(args, 0) if args else 15), from_tty)
 
 class enableETM(gdb.Command):
     def __init__(self):
@@ -98,24 +74,31 @@ class enableETM(gdb.Command):
                 )
 
     def invoke(self,args,from_tty):
-        writeInt(DWT_CTRL,0x40011a01)
-        # ETM configuration example
-        # Write 0xC5AC CE55 to the ETM Lock Access Register to unlock the write accesITM registers
-        writeInt(ETM_LAR , 0xC5ACCE55)
-        # Write 0x0000 1D1E to the ETM control register (configure the trace)
-        #writeInt(ETM_CR , 0x00001D1E 
-        writeInt(ETM_CR , 0x00201d0e)
-        # Set stream
-        writeInt(ETM_TRACEIDR, 1) # TraceBusID 1
-        # Write 0x0000 406F to the ETM Trigger Event register (define the trigger event)
-        writeInt(ETM_TER , 0x0000406F)
-        # Write 0x0000 006F to the ETM Trace Enable Event register (define an event to start/stop)
-        writeInt(ETM_TEE, 0x0000006F)
-        # Write 0x0000 0001 to the ETM Trace Start/stop register (enable the trace)
-        writeInt(ETM_TECR1, 0x00000001)
-        # Write 0x0000191E to the ETM Control Register (end of configuration)
-        writeInt(ETM_CR , 0x0000191E)
+        # DWT PC sampling, ETM unlock, program, trace ID, trigger / enable events - see regmap.enable_etm
+        apply(enable_etm(), from_tty)
+
+class enableITM(gdb.Command):
+    def __init__(self):
+        super(enableITM, self).__init__(
+                "enableITM", gdb.COMMAND_USER
+                )
+
+    # PC samples / exception trace from DWT_CTRL and local timestamps on SWO - see itmdecode.py
+    def invoke(self,args,from_tty):
+        apply(enable_itm(), from_tty)
+
+class configureTrace(gdb.Command):
+    def __init__(self):
+        super(configureTrace, self).__init__(
+                "configureTrace", gdb.COMMAND_USER
+                )
+
+    # enableDBG, configureTPIU and enableETM as one plan, args is the TPIU prescaler
+    def invoke(self,args,from_tty):
+        apply(trace_config(int(args, 0) if args else 15), from_tty)
 
 enableDBG()
 configureTPIU()
 enableETM()
+enableITM()
+configureTrace()
@@ -0,0 +1,657 @@
+import configparser
+import zipfile
+import numpy as np
+
+'''
+Streaming TPIU / ETMv3 decoder
+
+etm.py / etm-dev.cfg put the TPIU on SWO in UART mode (TPI_SPPR = 2) with the formatter
+on (TPI_FFCR = 0x102) and the ETM on TraceBusID 1, cycle accurate with branch broadcast
+(ETM_CR = 0x191E), ACPR 3 at 16 MHz = 4 Mbaud. The same chain as the PulseView session
+(etm-pulseview.pvs: uart -> arm_tpiu -> arm_etmv3), a chunk at a time in constant memory:
+
+- UARTDecoder: logic analyzer samples to bytes, start bits are found from the falling
+  edges and the data bits of every byte in a chunk sampled with one fancy index
+- TPIUDeframer: 16 byte formatter frames to one byte stream per trace ID, aligned on
+  the full frame sync (FF FF FF 7F), the frames of a chunk decoded as one (frames, 16) array
+- ETMDecoder: ETMv3 packets to an event array (EVENT_DTYPE): the address of every I-sync
+  and branch, the atoms executed since the event before and the running cycle count
+
+With branch broadcast every taken branch has its target address in the trace, expanding
+that into every instruction needs the firmware image. Only the packets an ETM-M4 emits are
+decoded (no data trace), Thumb state only.
+
+    python etmdecode.py capture.sr [baud] [trace_id]    sigrok session, UART on D0
+    python etmdecode.py swo.bin [trace_id]              raw SWO bytes
+
+An extra events.npy argument saves the events, stm32f4/python/cycleindex.py reads them.
+'''
+
+ETM_TRACE_ID = 1
+SWO_BAUD = 4000000
+FRAME_SYNC = b'\xff\xff\xff\x7f'
+A_SYNC = b'\x00\x00\x00\x00\x00\x80'
+
+# Event kinds
+ISYNC = 0
+BRANCH = 1
+TRIGGER = 2
+EXCEPTION_ENTRY = 3
+EXCEPTION_EXIT = 4
+KIND_NAMES = {ISYNC: 'I-sync', BRANCH: 'branch', TRIGGER: 'trigger',
+              EXCEPTION_ENTRY: 'exception entry', EXCEPTION_EXIT: 'exception exit'}
+
+EVENT_DTYPE = np.dtype([
+    # Byte offset of the packet in the ETM stream
+    ('offset', '<i8'),
+    ('kind', 'u1'),
+    ('address', '<u4'),
+    # Cycles (W atoms and cycle count packets) up to this event
+    ('cycle', '<u8'),
+    # E / N atoms (instructions that passed / failed their condition) since the last event
+    ('executed', '<u4'),
+    ('not_executed', '<u4'),
+    # Exception number of a branch into an exception handler, else -1
+    ('exception', '<i2'),
+])
+
+
+class UARTDecoder:
+    '''
+    8N1 UART, idle high, from a stream of logic samples (bool / 0-1 arrays)
+    '''
+    def __init__(self, samplerate, baud=SWO_BAUD):
+        self.period = samplerate / baud
+        if self.period < 3:
+            raise ValueError(f"{samplerate} samples/s is too slow for {baud} baud")
+        self.framing_errors = 0
+        self._carry = np.ones(1, dtype=bool)
+
+    def feed(self, samples):
+        line = np.concatenate([self._carry, np.asarray(samples, dtype=bool)])
+        edges = np.flatnonzero(line[:-1] & ~line[1:]) + 1
+        frame = 10 * self.period
+        # A start bit can't begin before the stop bit of the byte before is half way through,
+        # the next possible start after every edge, then one list lookup per byte
+        following = np.searchsorted(edges, edges + 9.5 * self.period).tolist()
+        fits = int(np.searchsorted(edges, len(line) - frame, side='right'))
+        chosen = []
+        index = 0
+        while index < fits:
+            chosen.append(index)
+            index = following[index]
+        starts = edges[chosen]
+        if len(starts):
+            centres = (starts[:, None] + (np.arange(1, 10) + 0.5)[None, :] * self.period).astype(np.int64)
+            bits = line[centres]
+            self.framing_errors += int((~bits[:, 8]).sum())
+            data = np.packbits(bits[:, :8], axis=1, bitorder='little')[:, 0].tobytes()
+        else:
+            data = b''
+        # From the high sample before a start bit that didn't fit, else just the last sample
+        cut = edges[index] - 1 if index < len(edges) else len(line) - 1
+        self._carry = line[cut:]
+        return data
+
+
+class TPIUDeframer:
+    '''
+    TPIU formatter frames to {trace ID: bytes}, IDs 0 (null) and 0x7F (reserved) are dropped
+    '''
+    def __init__(self):
+        self.synced = False
+        self.frames = 0
+        self.dropped = 0
+        self._carry = b''
+        self._id = 0
+
+    def _decode(self, frames):
+        frames = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 16)
+        even = frames[:, 0:15:2].astype(np.int16)
+        odd = np.concatenate([frames[:, 1:15:2], np.zeros((len(frames), 1), dtype=np.uint8)], axis=1).astype(np.int16)
+        aux = (frames[:, 15:16] >> np.arange(8, dtype=np.uint8)) & 1
+        is_id = (even & 1) == 1
+        even_value = np.where(is_id, even >> 1, (even & 0xFE) | aux)
+        # (kind, value) slots in stream order: 0 data, 1 ID change, 2 nothing
+        first_kind = is_id.astype(np.int8)
+        second_kind = np.zeros_like(first_kind)
+        second_kind[:, 7] = 2
+        # An ID change with its aux bit set takes effect after the odd byte that follows it
+        late = is_id & (aux == 1)
+        late[:, 7] = False
+        kinds = np.stack([np.where(late, second_kind, first_kind), np.where(late, first_kind, second_kind)], axis=2)
+        values = np.stack([np.where(late, odd, even_value), np.where(late, even_value, odd)], axis=2)
+        kinds, values = kinds.reshape(-1), values.reshape(-1)
+        changes = np.where(kinds == 1, np.arange(len(kinds)), -1)
+        last = np.maximum.accumulate(changes)
+        ids = np.where(last >= 0, values[np.maximum(last, 0)], self._id)
+        if (kinds == 1).any():
+            self._id = int(values[np.flatnonzero(kinds == 1)[-1]])
+        data = kinds == 0
+        out = {}
+        for trace_id in np.unique(ids[data]):
+            if trace_id in (0, 0x7F):
+                continue
+            out[int(trace_id)] = values[data & (ids == trace_id)].astype(np.uint8).tobytes()
+        return out
+
+    def feed(self, data):
+        buf = self._carry + bytes(data)
+        out = {}
+        position = 0
+        if not self.synced:
+            position = buf.find(FRAME_SYNC)
+            if position < 0:
+                self._carry = buf[-3:]
+                return out
+            self.synced = True
+        frames = []
+        while True:
+            sync = buf.find(FRAME_SYNC, position)
+            end = len(buf) if sync < 0 else sync
+            if sync == position:
+                position += len(FRAME_SYNC)
+                continue
+            count = (end - position) // 16
+            if sync >= 0 and (end - position) % 16:
+                # A sync that isn't on a frame boundary, the frames since the last one are suspect
+                self.dropped += (end - position) % 16
+            frames.append(buf[position:position + count * 16])
+            if sync < 0:
+                position += count * 16
+                break
+            position = sync + len(FRAME_SYNC)
+        self._carry = buf[position:]
+        frames = b''.join(frames)
+        if frames:
+            self.frames += len(frames) // 16
+            for trace_id, stream in self._decode(frames).items():
+                out[trace_id] = stream
+        return out
+
+
+def _pheader_table(cycle_accurate):
+    # (E atoms, N atoms, W cycles) of every P-header byte, zeros for other headers
+    table = np.zeros((256, 3), dtype=np.int64)
+    valid = np.zeros(256, dtype=bool)
+    for h in range(256):
+        if h & 0x81 != 0x80:
+            continue
+        atoms = None
+        if not cycle_accurate:
+            if h & 0x83 == 0x80:
+                atoms = ((h >> 2) & 0xF, (h >> 6) & 1, 0)
+            elif h & 0xF3 == 0x82:
+                n = ((h >> 3) & 1) + ((h >> 2) & 1)
+                atoms = (2 - n, n, 0)
+        elif h == 0x80:
+            atoms = (0, 0, 1)
+        elif h & 0x83 == 0x80:
+            # Every atom takes a cycle
+            e, n = (h >> 2) & 0xF, (h >> 6) & 1
+            atoms = (e, n, e + n)
+        elif h & 0xF3 == 0x82:
+            n = ((h >> 3) & 1) + ((h >> 2) & 1)
+            atoms = (2 - n, n, 1)
+        elif h & 0xA0 == 0xA0:
+            atoms = ((h >> 6) & 1, 0, ((h >> 2) & 7) + 1)
+        elif h & 0xFB == 0x92:
+            n = (h >> 2) & 1
+            atoms = (1 - n, n, 0)
+        if atoms is not None:
+            table[h] = atoms
+            valid[h] = True
+    return table, valid
+
+# Address bits a branch packet can replace: (first bit, last bit + 1, address byte it comes in)
+# The last address byte of a short packet with the alternative encoding only carries 6 bits
+ADDRESS_RANGES = [(1, 7, 0), (7, 13, 1), (13, 14, 1), (14, 20, 2), (20, 21, 2), (21, 27, 3), (27, 28, 3), (28, 32, 4)]
+PAD = 24
+WALK_BLOCK = 1024
+# Longest packet that can run into a block and still land on one of its walks
+WALK_OFFSETS = 8
+# Headers of the packets with a length field of their own: A-sync, cycle count, I-sync, timestamp
+VARIABLE = np.zeros(256, dtype=bool)
+VARIABLE[[0x00, 0x04, 0x08, 0x70, 0x42, 0x46]] = True
+SKIPPED = np.zeros(256, dtype=bool)
+SKIPPED[[0x00, 0x42, 0x46, 0x6E, 0x3C]] = True
+
+
+class ETMDecoder:
+    '''
+    ETMv3 packets to EVENT_DTYPE arrays, feed() the stream of one trace ID a chunk at a time
+    Nothing is decoded before the first A-sync, no addresses before the first I-sync
+
+    Packet lengths are worked out for every byte of a chunk at once (as if a packet started
+    there). The packets are then walked from WALK_OFFSETS starts in every WALK_BLOCK bytes,
+    all walks stepped together as arrays; a walk that lands on a byte another one already
+    claimed follows it from there, so only the joins between blocks are walked in Python.
+    P-headers, branches and cycle counts are decoded as arrays: atoms and cycles are cumsums,
+    and every address bit range comes from the last packet that carried it. I-syncs are
+    parsed one by one after the walk.
+
+    About 10-12 MB/s of ETM bytes on a few MB of synthetic trace fed in 64 KB - 1 MB chunks,
+    around twice the per-packet walk but not tens of MB/s: the length table, the lockstep walks
+    and the address ranges each cost about the same now.
+    '''
+    def __init__(self, cycle_accurate=True, context_id_bytes=0, alt_branch=True):
+        self.cycle_accurate = cycle_accurate
+        self.context_id_bytes = context_id_bytes
+        self.alt_branch = alt_branch
+        self.address = None
+        self.cycle = 0
+        self.executed = 0
+        self.not_executed = 0
+        self.offset = 0
+        self.synced = False
+        self.errors = 0
+        self.overflows = 0
+        self._atoms, pheader = _pheader_table(cycle_accurate)
+        # Length of the packets that are always the same length, by header
+        self._fixed = np.zeros(256, dtype=np.int32)
+        self._fixed[pheader] = 1
+        self._fixed[[0x0C, 0x66, 0x76, 0x7E]] = 1
+        self._fixed[0x6E] = 1 + context_id_bytes
+        self._fixed[0x3C] = 2
+        self._carry = b''
+
+    @staticmethod
+    def _varint(buf, j, limit=5):
+        value = 0
+        for k in range(limit):
+            b = buf[j]
+            j += 1
+            value |= (b & 0x7F) << (7 * k)
+            if not b & 0x80:
+                break
+        return value, j
+
+    def _lengths(self, b):
+        # Length of the packet that would start at every byte, 0 where none an ETM-M4 sends can
+        size = len(b)
+        index = np.arange(size, dtype=np.int32)
+        # Continuation bytes from each position on, the padding continues forever
+        run = np.minimum.accumulate(np.where(b & 0x80, np.int32(size), index)[::-1])[::-1] - index
+        branch_bytes = np.minimum(run + 1, 5)
+        # Exception bytes following a last address byte that says there are some
+        high = b >> 7
+        exception = np.zeros(size, dtype=np.uint8)
+        exception[:-2] = ((b[:-2] & 0x40) != 0) * (1 + high[1:-1] + high[1:-1] * high[2:])
+        exception_bytes = np.where(branch_bytes > (1 if self.alt_branch else 4),
+                                   exception[np.minimum(index + branch_bytes - 1, size - 3)], 0)
+        lengths = np.where(b & 1, branch_bytes + exception_bytes, self._fixed[b])
+        # The rest have a field of their own length, there are few of them
+        special = np.flatnonzero(VARIABLE[b])
+        header = b[special]
+        count = np.minimum(run[special + 1] + 1, 5)
+        lengths[special] = np.where(header == 0x04, 1 + count, 1 + np.minimum(run[special + 1] + 1, 9))
+        # I-sync: cycle count (0x70 only), context ID, info byte, address, then the address of a
+        # load / store in progress in branch address format
+        isync = (header == 0x08) | (header == 0x70)
+        info = np.minimum(special[isync] + 1 + self.context_id_bytes + np.where(header[isync] == 0x70, count[isync], 0), size - 1)
+        load_store = np.where(b[info] & 0x80, np.minimum(run[np.minimum(info + 5, size - 1)] + 1, 5), 0)
+        lengths[special[isync]] = info - special[isync] + 5 + load_store
+        # A-sync, any number of zeros then 0x80, zeros up to the end of the data continue in the next chunk
+        zeros = special[header == 0]
+        if len(zeros):
+            last = np.append(np.diff(zeros) != 1, True)
+            after = zeros[np.minimum.accumulate(np.where(last, np.arange(len(zeros)), len(zeros))[::-1])[::-1]] + 1
+            lengths[zeros] = np.where(after >= size - PAD, size, np.where(b[after] == 0x80, after + 1 - zeros, 0))
+        return lengths, branch_bytes, exception_bytes > 0
+
+    def _isync(self, buf, i):
+        # (address, cycle count) of the I-sync at i, the length table made sure all of it is there
+        j = i + 1
+        count = 0
+        if buf[i] == 0x70:
+            count, j = self._varint(buf, j)
+        j += self.context_id_bytes
+        if (buf[j] >> 5) & 3 == 2:
+            self.overflows += 1
+        return int.from_bytes(buf[j + 1:j + 5], 'little') & ~1, count
+
+    def _walks(self, walk, n):
+        # Every block of WALK_BLOCK bytes walked from each of its first WALK_OFFSETS bytes at once,
+        # one array step per packet: whichever byte the packet before a block ends on, one of
+        # its walks starts there. Walks from different bytes fall into step within a few packets,
+        # a walk reaching a byte another one has been on stops and follows that one from there.
+        # Returns the walk that was on every byte, and per walk where it stopped (past the end of
+        # its block, on a packet it can't step over or where it joined another) and the one it joined
+        blocks = n // WALK_BLOCK + 1
+        first = np.arange(blocks) * WALK_BLOCK
+        pos = (first[:, None] + np.arange(WALK_OFFSETS)).ravel()
+        end = np.repeat(first + WALK_BLOCK, WALK_OFFSETS)
+        owner = np.full(n + WALK_OFFSETS, -1, dtype=np.int32)
+        stops = pos.copy()
+        joins = np.full(len(pos), -1)
+        walker = np.arange(len(pos), dtype=np.int32)
+        while len(walker):
+            length = walk[pos]
+            live = (length > 0) & (pos < end)
+            claimed = owner[pos]
+            fresh = live & (claimed < 0)
+            owner[pos[fresh]] = walker[fresh]
+            # Several walks landing on the same byte together, the last one written keeps it
+            claimed = np.where(live, owner[pos], -1)
+            joined = live & (claimed != walker)
+            live &= ~joined
+            if not live.all():
+                done = ~live
+                stops[walker[done]] = pos[done]
+                joins[walker[joined]] = claimed[joined]
+                walker, pos, end, length = walker[live], pos[live], end[live], length[live]
+            pos = pos + length
+        return owner, stops.tolist(), joins.tolist()
+
+    def _walk(self, buf, walk):
+        # Packet starts, and where the walk ended
+        # walk is 0 for bytes that can't start a packet, -1 for packets that end in the next chunk
+        n = len(buf)
+        owner, stops, joins = self._walks(walk, n)
+        # The walk each byte is a packet start of, -1 for packets found one at a time
+        path = np.full(n, -2, dtype=np.int32)
+        i = 0
+        while i < n:
+            if not self.synced:
+                found = buf.find(A_SYNC, i)
+                if found < 0:
+                    i = max(i, n - len(A_SYNC) + 1)
+                    break
+                i = found + len(A_SYNC)
+                self.synced = True
+                continue
+            # The bulk of the stream, one block at a time
+            while True:
+                block, offset = divmod(i, WALK_BLOCK)
+                if offset < WALK_OFFSETS:
+                    walker = block * WALK_OFFSETS + offset
+                    while True:
+                        stop = stops[walker]
+                        path[i:stop] = walker
+                        i = stop
+                        if joins[walker] < 0:
+                            break
+                        walker = joins[walker]
+                else:
+                    # A long packet ran into the block, one packet at a time up to the next one
+                    length = int(walk[i])
+                    while length > 0 and i // WALK_BLOCK == block:
+                        owner[i] = path[i] = -1
+                        i += length
+                        length = int(walk[i])
+                if walk[i] <= 0:
+                    break
+            if walk[i] < 0 or i >= n:
+                # Packet continues in the next chunk
+                break
+            # Lost track of the packet boundaries, wait for the next A-sync
+            self.errors += 1
+            self.synced = False
+            i += 1
+        return np.flatnonzero(owner[:n] == path), i
+
+    def feed(self, data):
+        buf = self._carry + bytes(data)
+        base = self.offset - len(self._carry)
+        b = np.frombuffer(buf + b'\xff' * PAD, dtype=np.uint8)
+        lengths, branch_bytes, follows = self._lengths(b)
+        walk = np.where(np.arange(len(b)) + lengths <= len(buf), lengths, -1)
+        # Past the end of the chunk
+        walk[len(buf):] = 0
+        starts, end = self._walk(buf, walk)
+        self._carry = buf[end:]
+        self.offset = base + len(buf)
+        # A-syncs, timestamps and context IDs carry nothing an event needs
+        starts = starts[~SKIPPED[b[starts]]]
+        if not len(starts):
+            return np.zeros(0, dtype=EVENT_DTYPE)
+
+        header = b[starts]
+        is_isync = (header == 0x08) | (header == 0x70)
+        isyncs = [self._isync(buf, int(start)) for start in starts[is_isync]]
+        is_branch = ((header & 1) == 1) & ~is_isync
+        atoms = self._atoms[header] * (~is_isync)[:, None]
+        cycles = atoms[:, 2].copy()
+        # Cycle count packets
+        counted = (header == 0x04) & ~is_isync
+        if counted.any():
+            at = starts[counted]
+            size = lengths[at] - 1
+            value = np.zeros(len(at), dtype=np.int64)
+            for k in range(5):
+                value |= np.where(k < size, (b[at + 1 + k].astype(np.int64) & 0x7F) << (7 * k), 0)
+            cycles[counted] = value
+        if isyncs:
+            cycles[is_isync] = [count for _, count in isyncs]
+
+        # Address bits carried by each packet, I-syncs carry all of them
+        count = branch_bytes[starts]
+        full = (b[starts].astype(np.int64) & 0x7E)
+        for k in range(1, 4):
+            part = b[starts + k].astype(np.int64)
+            short = self.alt_branch & (count == k + 1)
+            full |= np.where(count > k, np.where(short, part & 0x3F, part & 0x7F), 0) << (7 * k)
+        full |= np.where(count == 5, b[starts + 4].astype(np.int64) & 0xF, 0) << 28
+        if isyncs:
+            full[is_isync] = [address for address, _ in isyncs]
+        address = np.zeros(len(starts), dtype=np.int64)
+        known = np.maximum.accumulate(is_isync) | (self.address is not None)
+        positions = np.arange(len(starts))
+        for low, high, byte in ADDRESS_RANGES:
+            mask = ((1 << high) - 1) & ~((1 << low) - 1)
+            carried = is_isync | (is_branch & (count > byte))
+            if self.alt_branch and high - low == 1:
+                # Top bit of a 7 bit group, missing from the short last byte
+                carried &= ~(is_branch & (count == byte + 1))
+            source = np.maximum.accumulate(np.where(carried, positions, -1))
+            address |= np.where(source >= 0, full[np.maximum(source, 0)], self.address or 0) & mask
+
+        kinds = np.full(len(starts), 255, dtype=np.int64)
+        kinds[is_branch & known] = BRANCH
+        kinds[is_isync] = ISYNC
+        kinds[header == 0x0C] = TRIGGER
+        kinds[header == 0x7E] = EXCEPTION_ENTRY
+        kinds[header == 0x76] = EXCEPTION_EXIT
+        event = kinds != 255
+        exception = np.full(len(starts), -1, dtype=np.int64)
+        raised = is_branch & follows[starts]
+        if raised.any():
+            at = starts[raised] + count[raised]
+            number = (b[at] >> 1) & 0xF
+            number = number | np.where(b[at] & 0x80, (b[at + 1] & 0x1F).astype(np.int64) << 4, 0)
+            exception[raised] = number
+
+        cycle = self.cycle + np.cumsum(cycles)
+        executed = np.cumsum(atoms[:, 0])
+        not_executed = np.cumsum(atoms[:, 1])
+        events = np.zeros(int(event.sum()), dtype=EVENT_DTYPE)
+        events['offset'] = base + starts[event]
+        events['kind'] = kinds[event]
+        events['address'] = address[event]
+        events['cycle'] = cycle[event]
+        events['exception'] = exception[event]
+        # Atoms since the event before, the first one also gets those left over from the last chunk
+        for field, total, carry in (('executed', executed, self.executed), ('not_executed', not_executed, self.not_executed)):
+            at_event = total[event]
+            events[field] = np.diff(np.concatenate([[-carry], at_event]))
+        last = np.flatnonzero(event)[-1] if event.any() else -1
+        self.executed = int(executed[-1] - (executed[last] if last >= 0 else -self.executed))
+        self.not_executed = int(not_executed[-1] - (not_executed[last] if last >= 0 else -self.not_executed))
+        self.cycle = int(cycle[-1])
+        if known[-1]:
+            self.address = int(address[-1])
+        return events
+
+
+def read_swo(path, chunk=1 << 20):
+    with open(path, 'rb') as infile:
+        while True:
+            data = infile.read(chunk)
+            if not data:
+                break
+            yield data
+
+'''
+Samples of one channel from a sigrok session (.sr), returns (samplerate, generator of bool arrays)
+'''
+def read_sigrok(path, channel=0):
+    archive = zipfile.ZipFile(path)
+    metadata = configparser.ConfigParser(interpolation=None)
+    metadata.read_string(archive.read('metadata').decode())
+    device = metadata[[name for name in metadata.sections() if name.startswith('device')][0]]
+    rate, _, unit = device['samplerate'].partition(' ')
+    samplerate = float(rate) * {'': 1, 'Hz': 1, 'kHz': 1e3, 'MHz': 1e6, 'GHz': 1e9}[unit]
+    unitsize = int(device.get('unitsize', 1))
+    capturefile = device.get('capturefile', 'logic-1')
+    names = sorted((name for name in archive.namelist() if name == capturefile or name.startswith(capturefile + '-')),
+                   key=lambda name: int(name.rsplit('-', 1)[1]) if name != capturefile else 0)
+    def samples():
+        for name in names:
+            raw = np.frombuffer(archive.read(name), dtype=f'<u{unitsize}')
+            yield (raw >> channel) & 1 == 1
+    return samplerate, samples()
+
+'''
+Raw sample dump (sigrok-cli -O binary), one unitsize word per sample
+'''
+def read_logic(path, channel=0, unitsize=1, chunk=1 << 24):
+    with open(path, 'rb') as infile:
+        while True:
+            data = infile.read(chunk * unitsize)
+            if not data:
+                break
+            yield (np.frombuffer(data, dtype=f'<u{unitsize}') >> channel) & 1 == 1
+
+'''
+Whole chain, byte chunks (framed SWO) to event arrays of one trace ID
+'''
+def decode_swo(chunks, trace_id=ETM_TRACE_ID, framed=True, **options):
+    deframer = TPIUDeframer() if framed else None
+    decoder = ETMDecoder(**options)
+    for data in chunks:
+        stream = deframer.feed(data).get(trace_id, b'') if framed else data
+        events = decoder.feed(stream)
+        if len(events):
+            yield events
+
+def decode_sigrok(path, baud=SWO_BAUD, channel=0, trace_id=ETM_TRACE_ID, **options):
+    samplerate, samples = read_sigrok(path, channel)
+    uart = UARTDecoder(samplerate, baud)
+    yield from decode_swo((uart.feed(chunk) for chunk in samples), trace_id, **options)
+
+
+def load_symbols(path):
+    '''
+    Sorted (addresses, names) of the functions in `arm-none-eabi-nm -n firmware.elf` output
+    '''
+    addresses, names = [], []
+    with open(path) as infile:
+        for line in infile:
+            parts = line.split()
+            if len(parts) == 3 and parts[1] in 'tTwW':
+                addresses.append(int(parts[0], 16))
+                names.append(parts[2])
+    order = np.argsort(addresses, kind='stable')
+    return np.array(addresses, dtype=np.int64)[order], np.array(names, dtype=object)[order]
+
+def symbolize(addresses, symbols):
+    # name+offset of the function containing every address
+    table, names = symbols
+    index = np.searchsorted(table, np.asarray(addresses, dtype=np.int64), side='right') - 1
+    return [f"{names[i]}+0x{int(a) - int(table[i]):x}" if i >= 0 else f"0x{int(a):08x}"
+            for a, i in zip(np.atleast_1d(addresses), np.atleast_1d(index))]
+
+
+def _frames(streams, sync_every=64):
+    # TPIU formatter frames for [(trace ID, bytes)]: an ID change then 14 data bytes per frame
+    # A short last frame is padded to an odd length with an ETM ignore packet (0x66), the
+    # null ID change after it has to be on an even byte
+    out = bytearray(FRAME_SYNC)
+    frames = 0
+    for trace_id, data in streams:
+        for start in range(0, len(data), 14):
+            part = data[start:start + 14]
+            if len(part) < 14 and len(part) % 2 == 0:
+                part += b'\x66'
+
+            frame = bytearray(16)
+            frame[0] = (trace_id << 1) | 1
+            for k in range(15):
+                position = k + 1
+                if position == 15:
+                    break
+                if k >= len(part):
+                    # The rest goes to the null ID
+                    if position % 2 == 0:
+                        frame[position] = 1
+                    continue
+                value = part[k]
+                if position % 2:
+                    frame[position] = value
+                else:
+                    frame[position] = value & 0xFE
+                    frame[15] |= (value & 1) << (position // 2)
+            out += frame
+            frames += 1
+            if frames % sync_every == 0:
+                out += FRAME_SYNC
+    return bytes(out)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+        sigrok = path.endswith('.sr')
+        output = [arg for arg in sys.argv[2:] if arg.endswith('.npy')]
+        numbers = [int(arg, 0) for arg in sys.argv[2:] if not arg.endswith('.npy')]
+        start = time.perf_counter()
+        if sigrok:
+            baud = numbers[0] if numbers else SWO_BAUD
+            chunks = decode_sigrok(path, baud, trace_id=numbers[1] if len(numbers) > 1 else ETM_TRACE_ID)
+        else:
+            chunks = decode_swo(read_swo(path), numbers[0] if numbers else ETM_TRACE_ID)
+        counts = {}
+        shown = 0
+        saved = []
+        for events in chunks:
+            if output:
+                saved.append(events)
+            for kind, count in zip(*np.unique(events['kind'], return_counts=True)):
+                counts[KIND_NAMES[int(kind)]] = counts.get(KIND_NAMES[int(kind)], 0) + int(count)
+            for event in events[:max(0, 20 - shown)]:
+                print(f"  {KIND_NAMES[int(event['kind'])]:16s} 0x{int(event['address']):08X} cycle {int(event['cycle'])}")
+            shown += len(events)
+        print(f"{counts} in {time.perf_counter() - start:.2f}s")
+        if output:
+            np.save(output[0], np.concatenate(saved) if saved else np.zeros(0, dtype=EVENT_DTYPE))
+        sys.exit()
+
+    # Synthetic round trip: ETM packets -> TPIU frames -> 4 Mbaud UART sampled at 24 MHz
+    rng = np.random.default_rng(0)
+    targets = (0x08000000 + rng.integers(0, 0x4000, 20000) * 2).astype(np.int64)
+    etm = bytearray(A_SYNC + bytes([0x08, 0x21]) + (0x08000000 | 1).to_bytes(4, 'little'))
+    for target in targets:
+        etm += bytes([0x80 | (3 << 2)])  # 3 E atoms, 3 cycles
+        # Full 5 byte Thumb branch address
+        etm += bytes([((target >> 0) & 0x7E) | 0x81, ((target >> 7) & 0x7F) | 0x80, ((target >> 14) & 0x7F) | 0x80,
+                      ((target >> 21) & 0x7F) | 0x80, 0x10 | ((target >> 28) & 0xF)])
+    swo = _frames([(ETM_TRACE_ID, bytes(etm)), (2, b'itm data')])
+    bits = np.unpackbits(np.frombuffer(swo, dtype=np.uint8)[:, None], axis=1, bitorder='little')
+    frames = np.concatenate([np.zeros((len(bits), 1), np.uint8), bits, np.ones((len(bits), 2), np.uint8)], axis=1)
+    samples = np.repeat(frames.reshape(-1), 6).astype(bool)
+    samples = np.concatenate([np.ones(100, bool), samples, np.ones(100, bool)])
+
+    start = time.perf_counter()
+    uart = UARTDecoder(24e6, SWO_BAUD)
+    raw = b''.join(uart.feed(samples[i:i + 1000003]) for i in range(0, len(samples), 1000003))
+    uart_time = time.perf_counter() - start
+    assert raw == swo, "UART round trip"
+    start = time.perf_counter()
+    events = np.concatenate(list(decode_swo(raw[i:i + 65537] for i in range(0, len(raw), 65537))))
+    decode_time = time.perf_counter() - start
+    assert np.array_equal(events['address'][1:], targets), "branch targets"
+    print(f"UART: {len(samples) / 1e6:.0f} MB of samples in {uart_time:.2f}s ({len(samples) / uart_time / 1e6:.0f} MB/s)")
+    print(f"TPIU + ETM: {len(raw) / 1e6:.2f} MB in {decode_time:.2f}s ({len(raw) / decode_time / 1e6:.1f} MB/s), "
+          f"{len(events)} events, last cycle {int(events['cycle'][-1])}")
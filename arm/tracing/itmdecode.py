@@ -0,0 +1,386 @@
+import numpy as np
+from etmdecode import UARTDecoder, TPIUDeframer, read_swo, read_sigrok, load_symbols, SWO_BAUD
+
+'''
+Streaming ITM / DWT decoder
+
+The DWT half of the trace setup is already there, enableETM writes DWT_CTRL = 0x40011a01:
+CYCCNT on, a PC sample every 1024 cycles (CYCTAP = 1, POSTPRESET = 0), exception trace on
+and SYNCTAP for periodic ITM syncs. The ITM only passes that on once it is enabled
+(regmap.enable_itm / etm.py enableITM: ITM_TCR ITMENA, TSENA, SYNCENA, DWTENA on TraceBusID
+ITM_TRACE_ID), through the same TPIU formatter as the ETM, so one SWO capture carries both.
+
+ITMDecoder turns the ITM byte stream into an event array (EVENT_DTYPE), a chunk at a time:
+stimulus port writes, DWT PC samples, exception entry / exit / return, event counter wraps,
+data trace, local and global timestamps and overflows. Packet lengths are worked out for
+every byte at once and only the walk from header to header is a Python loop. Local
+timestamps follow the packets they stamp, so events are held back until the timestamp after
+them arrives (flush() hands out the rest at the end), every event's time is the running
+local timestamp count and global the last full global timestamp. At most max_pending events
+wait, past that they go out with the time so far (counted in unstamped), so a stream without
+local timestamps (TSENA off, the ITM set up by the firmware) still streams, and
+timestamps=False doesn't hold anything back at all.
+
+pc_histogram counts the PC samples per address, or per function with an nm symbol table,
+with the first and last time each one was seen - where the boot ROM / bootloader spends its
+time and when, to aim ext_offset windows at.
+
+    python itmdecode.py capture.sr [baud] [trace_id] [symbols.txt]    sigrok session, UART on D0
+    python itmdecode.py swo.bin [trace_id] [symbols.txt]                raw SWO bytes
+'''
+
+ITM_TRACE_ID = 2
+PAD = 8
+
+# Event kinds
+STIMULUS = 0
+PC_SAMPLE = 1
+EXCEPTION = 2
+EVENT_COUNTER = 3
+DATA_TRACE = 4
+LOCAL_TS = 5
+GLOBAL_TS = 6
+OVERFLOW = 7
+EXTENSION = 8
+KIND_NAMES = {STIMULUS: 'stimulus', PC_SAMPLE: 'PC sample', EXCEPTION: 'exception', EVENT_COUNTER: 'event counter',
+              DATA_TRACE: 'data trace', LOCAL_TS: 'local timestamp', GLOBAL_TS: 'global timestamp',
+              OVERFLOW: 'overflow', EXTENSION: 'extension'}
+
+# Header classes
+_SKIP = 0
+_SOURCE = 1
+_CONTINUED = 2
+_SINGLE = 3
+_RESERVED = 4
+
+# DWT hardware source packet discriminators
+DWT_EVENT_COUNTER = 0
+DWT_EXCEPTION = 1
+DWT_PC_SAMPLE = 2
+# Exception packet functions
+EXCEPTION_ENTRY = 1
+EXCEPTION_EXIT = 2
+EXCEPTION_RETURN = 3
+
+EVENT_DTYPE = np.dtype([
+    # Byte offset of the packet in the ITM stream
+    ('offset', '<i8'),
+    ('kind', 'u1'),
+    # Stimulus port, DWT discriminator or extension / timestamp header bits
+    ('source', 'u1'),
+    ('size', 'u1'),
+    # Payload: stimulus value, PC, exception number, timestamp delta, ...
+    ('value', '<u4'),
+    # Exception function, event counter bits, timestamp relation, 1 for a PC sample while asleep
+    ('flags', 'u1'),
+    # Running local timestamp (in ITM_TCR TSPrescale ticks) and last global timestamp
+    ('time', '<u8'),
+    ('global', '<u8'),
+])
+
+
+def _header_table():
+    # (class, payload bytes for source packets / most continuation bytes) of every header byte
+    table = np.zeros((256, 2), dtype=np.int64)
+    for header in range(256):
+        if header in (0x00, 0x80):
+            # Sync: zeros then 0x80
+            table[header] = (_SKIP, 0)
+        elif header & 0x03:
+            table[header] = (_SOURCE, {1: 1, 2: 2, 3: 4}[header & 0x03])
+        elif header == 0x70:
+            table[header] = (_SINGLE, 0)
+        elif header & 0x0F == 0 and header & 0x80 == 0:
+            # Local timestamp format 2, the timestamp is in the header
+            table[header] = (_SINGLE, 0)
+        elif header & 0xCF == 0xC0:
+            table[header] = (_CONTINUED, 4)
+        elif header in (0x94, 0xB4):
+            table[header] = (_CONTINUED, 4 if header == 0x94 else 6)
+        elif header & 0x0B == 0x08:
+            table[header] = (_CONTINUED, 4) if header & 0x80 else (_SINGLE, 0)
+        else:
+            table[header] = (_RESERVED, 0)
+    return table
+
+
+class ITMDecoder:
+    '''
+    ITM byte stream chunks to event arrays, feed() as the bytes arrive, flush() at the end
+    '''
+    _table = _header_table()
+
+    def __init__(self, timestamps=True, max_pending=4096):
+        # timestamps=False for an ITM without TSENA, events go out with time 0 straight away
+        self.timestamps = timestamps
+        self.max_pending = max_pending
+        # Events that went out without waiting for their local timestamp
+        self.unstamped = 0
+        self.offset = 0
+        self.time = 0
+        self.global_time = 0
+        self.syncs = 0
+        self.errors = 0
+        self._carry = b''
+        self._pending = np.zeros(0, dtype=EVENT_DTYPE)
+
+    def _lengths(self, b):
+        kind, most = self._table[b, 0], self._table[b, 1]
+        positions = np.arange(len(b))
+        # Next byte without the continuation bit, at or after every position
+        stops = np.where(b & 0x80 == 0, positions, len(b))
+        stops = np.minimum.accumulate(stops[::-1])[::-1]
+        following = np.append(stops[1:], len(b)) - positions
+        lengths = np.ones(len(b), dtype=np.int64)
+        lengths = np.where(kind == _SOURCE, 1 + most, lengths)
+        continued = (kind == _CONTINUED) & (b & 0x80 != 0)
+        lengths = np.where(continued, 1 + np.minimum(following, most), lengths)
+        return lengths, kind
+
+    def _walk(self, lengths, end):
+        starts = []
+        append = starts.append
+        i = 0
+        while i < end:
+            step = lengths[i]
+            if i + step > end:
+                break
+            append(i)
+            i += step
+        return np.array(starts, dtype=np.int64), i
+
+    def feed(self, data):
+        buf = self._carry + bytes(data)
+        base = self.offset - len(self._carry)
+        b = np.frombuffer(buf + b'\x00' * PAD, dtype=np.uint8)
+        lengths, classes = self._lengths(b)
+        starts, end = self._walk(lengths.tolist(), len(buf))
+        self._carry = buf[end:]
+        self.offset = base + len(buf)
+
+        header = b[starts].astype(np.int64)
+        cls = classes[starts]
+        self.syncs += int(((header == 0x80) & (starts > 0) & (b[np.maximum(starts - 1, 0)] == 0)).sum())
+        self.errors += int((cls == _RESERVED).sum())
+        keep = (cls != _SKIP) & (cls != _RESERVED)
+        starts, header, cls, size = starts[keep], header[keep], cls[keep], lengths[starts[keep]] - 1
+
+        value = np.zeros(len(starts), dtype=np.int64)
+        source = cls == _SOURCE
+        for k in range(6):
+            part = b[starts + 1 + k].astype(np.int64)
+            value |= np.where(source & (k < size), part << (8 * k), 0)
+            value |= np.where(~source & (k < size), (part & 0x7F) << (7 * k), 0)
+
+        events = np.zeros(len(starts), dtype=EVENT_DTYPE)
+        events['offset'] = base + starts
+        events['size'] = size
+        kind = np.full(len(starts), EXTENSION, dtype=np.int64)
+        flags = np.zeros(len(starts), dtype=np.int64)
+        port = header >> 3
+        hardware = source & (header & 0x04 != 0)
+        kind[source & ~hardware] = STIMULUS
+        kind[hardware & (port == DWT_EVENT_COUNTER)] = EVENT_COUNTER
+        exception = hardware & (port == DWT_EXCEPTION)
+        kind[exception] = EXCEPTION
+        flags[exception] = (value[exception] >> 12) & 0x3
+        value[exception] &= 0x1FF
+        sample = hardware & (port == DWT_PC_SAMPLE)
+        kind[sample] = PC_SAMPLE
+        # A one byte PC sample is the core asleep
+        flags[sample & (size == 1)] = 1
+        value[sample & (size == 1)] = 0
+        kind[hardware & (port >= 8) & (port < 24)] = DATA_TRACE
+        events['source'] = np.where(source, port, (header >> 4) & 0x7)
+        local1 = header & 0xCF == 0xC0
+        local2 = (header & 0x8F == 0) & (header != 0x70)
+        kind[local1 | local2] = LOCAL_TS
+        flags[local1] = (header[local1] >> 4) & 0x3
+        value[local2] = header[local2] >> 4
+        kind[header == 0x70] = OVERFLOW
+        kind[(header == 0x94) | (header == 0xB4)] = GLOBAL_TS
+        events['kind'] = kind
+        events['value'] = value & 0xFFFFFFFF
+        events['flags'] = flags
+
+        # Global timestamps, 1 is bits 25:0 (fewer bytes when the high ones didn't change), 2 the bits above
+        global_time = np.full(len(events), -1, dtype=np.int64)
+        previous = self.global_time
+        for index in np.flatnonzero(kind == GLOBAL_TS):
+            bits = 7 * int(size[index])
+            if header[index] == 0x94:
+                low = (1 << min(bits, 26)) - 1
+                self.global_time = (self.global_time & ~low) | (int(value[index]) & low)
+            else:
+                # Up to bit 62, the 64 bit form's top bit doesn't fit the int64 columns
+                self.global_time = (self.global_time & ((1 << 26) - 1)) | ((int(value[index]) & ((1 << min(bits, 37)) - 1)) << 26)
+            global_time[index] = self.global_time
+        known = np.maximum.accumulate(np.where(global_time >= 0, np.arange(len(events)), -1))
+        events['global'] = np.where(known >= 0, global_time[np.maximum(known, 0)], previous)
+        # Hardware source IDs 3 - 7 and 24 and up are reserved
+        reserved = hardware & (((port > DWT_PC_SAMPLE) & (port < 8)) | (port >= 24))
+        self.errors += int(reserved.sum())
+        events = events[~reserved]
+
+        return self._stamp(np.concatenate([self._pending, events]))
+
+    # Events up to the last local timestamp get its running time, the rest wait for the next one,
+    # unless there are more than max_pending of them (or timestamps are off): those go out with
+    # the time so far
+    def _stamp(self, events):
+        local = events['kind'] == LOCAL_TS
+        done, rest = events[:0], events
+        if local.any():
+            time = self.time + np.cumsum(np.where(local, events['value'], 0).astype(np.int64))
+            positions = np.arange(len(events))
+            after = np.minimum.accumulate(np.where(local, positions, len(events))[::-1])[::-1]
+            last = np.flatnonzero(local)[-1]
+            events['time'] = time[np.minimum(after, last)]
+            self.time = int(time[last])
+            done, rest = events[:last + 1], events[last + 1:]
+        if not self.timestamps or len(rest) > self.max_pending:
+            rest['time'] = self.time
+            self.unstamped += len(rest) if self.timestamps else 0
+            done, rest = events, events[:0]
+        self._pending = rest
+        return done
+
+    def flush(self):
+        events = self._pending
+        events['time'] = self.time
+        self._pending = np.zeros(0, dtype=EVENT_DTYPE)
+        return events
+
+
+'''
+PC samples counted per address (rounded down to granularity bytes) or per function, most
+sampled first, with the first / last local timestamp each one was sampled at
+'''
+def pc_histogram(events, symbols=None, granularity=1):
+    samples = events[(events['kind'] == PC_SAMPLE) & (events['flags'] == 0)]
+    pcs = samples['value'].astype(np.int64)
+    if symbols is not None:
+        table, names = symbols
+        index = np.searchsorted(table, pcs, side='right') - 1
+        # Below the first symbol counts per address
+        key = np.where(index >= 0, table[np.maximum(index, 0)], pcs)
+    else:
+        key = pcs & ~(granularity - 1)
+    keys, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+    first = np.full(len(keys), np.iinfo(np.uint64).max, dtype=np.uint64)
+    last = np.zeros(len(keys), dtype=np.uint64)
+    np.minimum.at(first, inverse, samples['time'])
+    np.maximum.at(last, inverse, samples['time'])
+    order = np.argsort(-counts, kind='stable')
+    histogram = {
+        'address': keys[order],
+        'count': counts[order],
+        'fraction': counts[order] / max(len(pcs), 1),
+        'first': first[order],
+        'last': last[order],
+        'sleeping': int(((events['kind'] == PC_SAMPLE) & (events['flags'] == 1)).sum()),
+    }
+    if symbols is not None:
+        lookup = dict(zip(table.tolist(), names))
+        histogram['name'] = [lookup.get(int(address), f"0x{int(address):08X}") for address in histogram['address']]
+    return histogram
+
+'''
+Whole chain, byte chunks of SWO to ITM event arrays, framed=False for a TPIU with the
+formatter bypassed (TPI_FFCR = 0x100) where SWO carries the ITM alone
+'''
+def decode_swo(chunks, trace_id=ITM_TRACE_ID, framed=True, **options):
+    deframer = TPIUDeframer() if framed else None
+    decoder = ITMDecoder(**options)
+    for data in chunks:
+        events = decoder.feed(deframer.feed(data).get(trace_id, b'') if framed else data)
+        if len(events):
+            yield events
+    events = decoder.flush()
+    if len(events):
+        yield events
+
+def decode_sigrok(path, baud=SWO_BAUD, channel=0, trace_id=ITM_TRACE_ID, framed=True, **options):
+    samplerate, samples = read_sigrok(path, channel)
+    uart = UARTDecoder(samplerate, baud)
+    yield from decode_swo((uart.feed(chunk) for chunk in samples), trace_id, framed, **options)
+
+
+def _show(histogram, limit=15):
+    names = histogram.get('name')
+    for i in range(min(limit, len(histogram['address']))):
+        label = names[i] if names is not None else f"0x{int(histogram['address'][i]):08X}"
+        print(f"  {label:32s} {int(histogram['count'][i]):8d} {100 * histogram['fraction'][i]:6.2f}%  "
+              f"time {int(histogram['first'][i])} - {int(histogram['last'][i])}")
+    if histogram['sleeping']:
+        print(f"  (asleep for {histogram['sleeping']} samples)")
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from etmdecode import _frames
+    if len(sys.argv) > 1:
+        # trace_id 0: formatter bypassed, the capture is the ITM stream alone
+        path = sys.argv[1]
+        symbols = [load_symbols(arg) for arg in sys.argv[2:] if arg.endswith('.txt')]
+        numbers = [int(arg, 0) for arg in sys.argv[2:] if not arg.endswith('.txt')]
+        start = time.perf_counter()
+        if path.endswith('.sr'):
+            trace_id = numbers[1] if len(numbers) > 1 else ITM_TRACE_ID
+            chunks = decode_sigrok(path, numbers[0] if numbers else SWO_BAUD, trace_id=trace_id, framed=trace_id != 0)
+        else:
+            trace_id = numbers[0] if numbers else ITM_TRACE_ID
+            chunks = decode_swo(read_swo(path), trace_id, framed=trace_id != 0)
+        events = np.concatenate(list(chunks) or [np.zeros(0, dtype=EVENT_DTYPE)])
+        counts = {KIND_NAMES[int(kind)]: int(count) for kind, count in zip(*np.unique(events['kind'], return_counts=True))}
+        print(f"{counts} in {time.perf_counter() - start:.2f}s")
+        stimulus = events[events['kind'] == STIMULUS]
+        if len(stimulus):
+            text = bytes(stimulus['value'][(stimulus['source'] == 0) & (stimulus['size'] == 1)].astype(np.uint8))
+            print(f"Port 0: {text[:200].decode(errors='replace')!r}")
+        _show(pc_histogram(events, symbols[0] if symbols else None, granularity=1 if symbols else 16))
+        sys.exit()
+
+    # Synthetic boot: PC samples in three functions, exceptions, printf on port 0, timestamps,
+    # framed on ITM_TRACE_ID next to an ETM stream and decoded in odd sized chunks
+    def source(port, value, size, hardware=False):
+        return bytes([(port << 3) | (4 if hardware else 0) | {1: 1, 2: 2, 4: 3}[size]]) + value.to_bytes(size, 'little')
+
+    def continued(header, value, count):
+        payload = [(value >> (7 * k)) & 0x7F for k in range(count)]
+        return bytes([header] + [byte | (0x80 if k < count - 1 else 0) for k, byte in enumerate(payload)])
+
+    rng = np.random.default_rng(0)
+    functions = {'reset_handler': 0x08000100, 'flash_init': 0x08000400, 'check_rdp': 0x08000800}
+    weights = np.array([0.2, 0.3, 0.5])
+    itm = bytearray(b'\x00' * 5 + b'\x80') + continued(0x94, 123456, 4) + continued(0xB4, 2, 3)
+    expected = []
+    for n in range(30000):
+        name = list(functions)[rng.choice(3, p=weights)]
+        pc = functions[name] + 2 * int(rng.integers(0, 64))
+        expected.append(pc)
+        itm += source(DWT_PC_SAMPLE, pc, 4, hardware=True)
+        if n % 1000 == 0:
+            itm += source(DWT_EXCEPTION, 15 | (EXCEPTION_ENTRY << 12), 2, hardware=True)
+            itm += source(DWT_EXCEPTION, 15 | (EXCEPTION_RETURN << 12), 2, hardware=True)
+            itm += b''.join(source(0, byte, 1) for byte in b'boot\n')
+        if n % 5000 == 0:
+            itm += b'\x00' * 5 + b'\x80'
+        # 1024 cycle sample period, format 1 local timestamp
+        itm += continued(0xC0, 1024, 2)
+    itm += source(DWT_PC_SAMPLE, 0, 1, hardware=True) + b'\x10'
+    swo = _frames([(ITM_TRACE_ID, bytes(itm)), (1, b'\x00' * 5 + b'\x80' + b'\x66' * 64)])
+    start = time.perf_counter()
+    events = np.concatenate(list(decode_swo(swo[i:i + 4099] for i in range(0, len(swo), 4099))))
+    elapsed = time.perf_counter() - start
+    whole = np.concatenate(list(decode_swo([swo])))
+    assert np.array_equal(events, whole), "chunked decode"
+    samples = events[(events['kind'] == PC_SAMPLE) & (events['flags'] == 0)]
+    assert np.array_equal(samples['value'], expected), "PC samples"
+    assert np.array_equal(samples['time'], 1024 * np.arange(1, len(expected) + 1)), "local timestamps"
+    assert events['global'][-1] == (2 << 26) | 123456, "global timestamp"
+    print(f"{len(swo) / 1e3:.0f} KB of SWO in {elapsed:.2f}s ({len(swo) / elapsed / 1e6:.2f} MB/s), "
+          f"{len(events)} events, {int((events['kind'] == EXCEPTION).sum())} exception packets")
+    symbols = (np.array(list(functions.values()), dtype=np.int64), np.array(list(functions), dtype=object))
+    _show(pc_histogram(events, symbols))
@@ -0,0 +1,425 @@
+import struct
+
+'''
+Debug register programming, planned and verified
+
+etm.py used to make every register access its own gdb.inferiors()[0] lookup and memory
+round trip (two for setBit / clearBit, printing both), which adds up over a slow SWD probe
+every time trace is reconfigured between glitch runs. Here a configuration is declarative:
+a list of stages of operations (write, set_bits, clear_bits) on the registers etm.py and
+etm-dev.cfg name. Stages run in order, the order inside a stage doesn't matter. Planning it:
+- the registers set_bits / clear_bits need are read up front, in as few transfers as
+  possible, and only when their value isn't known from an earlier apply
+- writes of values the cache says are already there are dropped, as are all but the
+  last write to a register within a stage. Only whole word writes whose set bits all read
+  back are dropped, otherwise a reset since would go unnoticed by the check
+- writes to consecutive addresses are coalesced into one block transfer
+- every register touched is read back afterwards, a few spans of addresses, and the bits
+  that read back as written are checked
+Glitch runs reset the target between reconfigures, so when anything is cached DEMCR is read
+first: TRCENA gates everything else trace_config writes and only a power on reset clears it,
+if it doesn't read back as cached the cache is dropped before planning and the reconfigure
+costs what a cold one does, the DEMCR read standing in for the one set_bits needs. If the check still fails and writes were skipped the
+cache is dropped and everything is written again once, if it fails after that it is a
+VerifyError.
+
+The plan runs on a GDB inferior (GDBTarget, what etm.py uses) or comes out as a standalone
+GDB Python command or OpenOCD Tcl proc (OpenOCD 0.12 read_memory / write_memory):
+
+    python regmap.py gdb [acpr] > trace-gdb.py
+    python regmap.py tcl [acpr] > trace.tcl
+'''
+
+# Register addresses
+RCC_APB2ENR = 0x40021018
+AFIO_MAPR = 0x40010004
+# Debug MCU configuration register
+DBGMCU_CR = 0xe0042004
+# Debug Exception and Monitor Control Register; TRCENA enables access to the TPIU
+COREDEBUG_DEMCR = 0xe000edfc
+# TPIU Asynchronous Clock Prescaler Register
+TPI_ACPR = 0xe0040010
+# TPIU Selected Pin Protocol Register
+TPI_SPPR = 0xe00400f0
+# Formatter and flush control register
+TPI_FFCR = 0xe0040304
+# Device ID - if last bit is set, we have ETM enabled - Cortex M4 manual, page 106
+TPI_DEV_ID = 0xE0040FC8
+# Data Watchpoint and Trace Control Register - defined in ARMv7 Architecture Manual page 879
+DWT_CTRL = 0xe0001000
+# ITM Lock Access Register
+ITM_LAR = 0xe0000fb0
+# ITM Trace Control Register
+ITM_TCR = 0xe0000e80
+# ITM Trace Enable - Each bit corresponds to a stimulus port to enable
+ITM_TER = 0xe0000e00
+# ITM Trace Privilege Register - enabled various tracing ports
+ITM_TPR = 0xE0000E40
+ETM_LAR = 0xe0041fb0
+ETM_CR = 0xe0041000
+ETM_TRACEIDR = 0xe0041200
+ETM_TECR1 = 0xe0041024
+# etm-dev.cfg's name for it
+ETM_TSSR = ETM_TECR1
+ETM_FFRR = 0xe0041028
+ETM_FFLR = 0xe004102c
+# ETM Trigger Event Register
+ETM_TER = 0xe0041008
+ETM_TEE = 0xE0041020
+
+MASK32 = 0xFFFFFFFF
+
+# name: (address, bits that read back as written or None when it can't be checked, cacheable)
+REGISTERS = {
+    'RCC_APB2ENR': (RCC_APB2ENR, MASK32, True),
+    # SWJ_CFG is write only
+    'AFIO_MAPR': (AFIO_MAPR, 0xF8FFFFFF, True),
+    'DBGMCU_CR': (DBGMCU_CR, MASK32, True),
+    'COREDEBUG_DEMCR': (COREDEBUG_DEMCR, MASK32, True),
+    'TPI_ACPR': (TPI_ACPR, 0x1FFF, True),
+    'TPI_SPPR': (TPI_SPPR, 0x3, True),
+    'TPI_FFCR': (TPI_FFCR, 0x102, True),
+    'TPI_DEV_ID': (TPI_DEV_ID, None, False),
+    # NUMCOMP and the NO* feature bits are read only
+    'DWT_CTRL': (DWT_CTRL, 0x007FFFFF, True),
+    # Lock access registers are write only, reading gives the lock status
+    'ITM_LAR': (ITM_LAR, None, False),
+    # BUSY is read only
+    'ITM_TCR': (ITM_TCR, 0x007F0F1F, True),
+    'ITM_TER': (ITM_TER, MASK32, True),
+    'ITM_TPR': (ITM_TPR, 0xF, True),
+    'ETM_LAR': (ETM_LAR, None, False),
+    # Power down, branch output, programming and cycle accurate, the port size / mode fields
+    # read back as whatever the ETM supports
+    'ETM_CR': (ETM_CR, 0x1501, True),
+    'ETM_TRACEIDR': (ETM_TRACEIDR, 0x7F, True),
+    'ETM_TER': (ETM_TER, 0x1FFFF, True),
+    'ETM_TEE': (ETM_TEE, 0x1FFFF, True),
+    # The comparator selects read as zero where the ETM has no comparators
+    'ETM_TECR1': (ETM_TECR1, 0x02000000, True),
+    'ETM_FFRR': (ETM_FFRR, MASK32, True),
+    'ETM_FFLR': (ETM_FFLR, MASK32, True),
+}
+
+
+# Operations, (register, bits kept, bits set): new = (old & keep) | value
+def write(register, value):
+    return (register, 0, value & MASK32)
+
+def set_bits(register, mask):
+    return (register, MASK32, mask & MASK32)
+
+def clear_bits(register, mask):
+    return (register, MASK32 & ~mask, 0)
+
+
+'''
+etm.py's enableDBG / configureTPIU / enableETM as stages
+TRCENA has to be set before the TPIU / DWT / ETM can be written, the ETM_CR programming bit
+before the ETM is configured and cleared after
+'''
+def enable_dbg():
+    # TRACE_IOEN, TRCENA
+    return [[set_bits('DBGMCU_CR', 0x20), set_bits('COREDEBUG_DEMCR', 0x1000000)]]
+
+def configure_tpiu(acpr=15):
+    # Trace clock divider HCLK/(acpr+1), UART pin protocol, formatter on
+    return [[write('TPI_ACPR', acpr), write('TPI_SPPR', 2), write('TPI_FFCR', 0x102)]]
+
+def enable_etm():
+    return [
+        # 1/512 PC sampling, exception trace
+        [write('DWT_CTRL', 0x40011a01)],
+        [write('ETM_LAR', 0xC5ACCE55)],
+        [write('ETM_CR', 0x00201d0e)],
+        # TraceBusID 1, trigger event, trace enable event, trace start/stop
+        [write('ETM_TRACEIDR', 1), write('ETM_TER', 0x406F), write('ETM_TEE', 0x6F), write('ETM_TECR1', 1)],
+        # End of configuration
+        [write('ETM_CR', 0x191E)],
+    ]
+
+def enable_itm(trace_id=2, ports=0xFFFFFFFF, prescale=0):
+    # ITMENA, TSENA (local timestamps, HCLK / 1 << 2 * prescale), SYNCENA, DWTENA (PC samples,
+    # exception trace) on TraceBusID trace_id, itmdecode.py's ITM_TRACE_ID
+    return [
+        [write('ITM_LAR', 0xC5ACCE55)],
+        [write('ITM_TCR', (trace_id << 16) | (prescale << 8) | 0x0F), write('ITM_TER', ports)],
+    ]
+
+def trace_config(acpr=15):
+    return enable_dbg() + configure_tpiu(acpr) + enable_etm()
+
+
+class VerifyError(Exception):
+    pass
+
+
+def _resolve(initial, term):
+    name, keep, value = term
+    return ((initial.get(name, 0) & keep) | value) if keep else value
+
+
+class Plan:
+    '''
+    reads: (address, count, {name: word}) spans read before anything is written
+    blocks: (address, [(name, keep, value)]) writes in order, relative to the values read
+    checks: {name: (mask, (name, keep, value))} and check_spans, the read-back
+    '''
+    def __init__(self, reads, blocks, checks, check_spans, final, skipped):
+        self.reads = reads
+        self.blocks = blocks
+        self.checks = checks
+        self.check_spans = check_spans
+        self.final = final
+        self.skipped = skipped
+
+    @property
+    def writes(self):
+        return sum(len(terms) for _, terms in self.blocks)
+
+    @property
+    def transfers(self):
+        return len(self.reads) + len(self.blocks) + len(self.check_spans)
+
+
+class RegisterMap:
+    def __init__(self, target=None, registers=REGISTERS, max_gap=32, sentinels=('COREDEBUG_DEMCR',)):
+        self.target = target
+        self.registers = dict(registers)
+        self._by_address = {address: name for name, (address, _, _) in self.registers.items()}
+        # Addresses this far apart are read in one span, the words between are read and ignored
+        self.max_gap = max_gap
+        self.cache = {}
+        # Registers that lose their value on the resets that matter, read before planning
+        self.sentinels = sentinels
+        self.resets = 0
+
+    '''
+    Name of a register given by name or address, an address that isn't in the map is added
+    uncached and checked in full
+    '''
+    def name(self, register):
+        if isinstance(register, str):
+            if register not in self.registers:
+                raise KeyError(f"unknown register {register}")
+            return register
+        if register not in self._by_address:
+            name = f"REG_{register:08X}"
+            self.registers[name] = (register, MASK32, False)
+            self._by_address[register] = name
+        return self._by_address[register]
+
+    def invalidate(self, names=None):
+        for name in list(self.cache) if names is None else names:
+            self.cache.pop(name, None)
+
+    def _spans(self, names):
+        spans = []
+        for name in sorted(names, key=lambda name: self.registers[name][0]):
+            address = self.registers[name][0]
+            if spans and address - (spans[-1][0] + 4 * spans[-1][1]) <= self.max_gap:
+                start, _, members = spans[-1]
+                spans[-1] = (start, (address - start) // 4 + 1, members)
+            else:
+                spans.append((address, 1, {}))
+            spans[-1][2][name] = (address - spans[-1][0]) // 4
+        return spans
+
+    def plan(self, stages):
+        # Every register's value as (keep, value) of what it read before any write
+        state = {}
+        reads = []
+        blocks = []
+        skipped = 0
+        for stage in stages:
+            final = {}
+            for register, keep, value in stage:
+                name = self.name(register)
+                if name not in state:
+                    state[name] = (0, self.cache[name]) if name in self.cache else (MASK32, 0)
+                current = final.get(name, state[name])
+                final[name] = (current[0] & keep, (current[1] & keep) | value)
+            writes = []
+            for name, term in final.items():
+                address, mask, cacheable = self.registers[name]
+                # The read back has to be able to tell if the skipped write is missing
+                verifiable = not term[0] and mask is not None and not term[1] & ~mask
+                if cacheable and verifiable and term == state[name]:
+                    skipped += 1
+                    continue
+                if term[0] and name not in reads:
+                    reads.append(name)
+                writes.append((address, (name,) + term))
+                state[name] = term
+            for address, term in sorted(writes):
+                if blocks and blocks[-1][0] + 4 * len(blocks[-1][1]) == address:
+                    blocks[-1][1].append(term)
+                else:
+                    blocks.append((address, [term]))
+        checks = {name: (self.registers[name][1], (name,) + term)
+                  for name, term in state.items() if self.registers[name][1] is not None}
+        final = {name: term for name, term in state.items() if self.registers[name][2]}
+        return Plan(self._spans(reads), blocks, checks, self._spans(checks), final, skipped)
+
+    def _read(self, spans):
+        values = {}
+        for address, count, names in spans:
+            words = self.target.read(address, count)
+            for name, index in names.items():
+                values[name] = words[index]
+        return values
+
+    def _check_reset(self):
+        names = [name for name in self.sentinels if name in self.cache]
+        if not names:
+            return
+        values = self._read(self._spans(names))
+        if any((values[name] ^ self.cache[name]) & self.registers[name][1] for name in names):
+            self.invalidate()
+            self.resets += 1
+            # What was just read is current, set_bits on it needn't read it again
+            self.cache.update(values)
+
+    def apply(self, stages, verify=True, retry=True):
+        self._check_reset()
+        plan = self.plan(stages)
+        initial = self._read(plan.reads)
+        for address, terms in plan.blocks:
+            self.target.write(address, [_resolve(initial, term) for term in terms])
+        for name, term in plan.final.items():
+            self.cache[name] = _resolve(initial, (name,) + term)
+        if verify:
+            values = self._read(plan.check_spans)
+            bad = [(name, _resolve(initial, term), values[name]) for name, (mask, term) in plan.checks.items()
+                   if values[name] & mask != _resolve(initial, term) & mask]
+            if bad:
+                self.invalidate()
+                if retry and plan.skipped:
+                    return self.apply(stages, verify, retry=False)
+                raise VerifyError("registers did not read back as written: " + ", ".join(
+                    f"{name} wrote 0x{expected:08X} read 0x{value:08X}" for name, expected, value in bad))
+        return plan
+
+
+class GDBTarget:
+    '''
+    32 bit words through one GDB inferior, looked up once
+    '''
+    def __init__(self, inferior=None):
+        if inferior is None:
+            import gdb
+            inferior = gdb.selected_inferior()
+        self.inferior = inferior
+
+    def read(self, address, count):
+        return list(struct.unpack(f"<{count}I", self.inferior.read_memory(address, 4 * count).tobytes()))
+
+    def write(self, address, words):
+        self.inferior.write_memory(address, struct.pack(f"<{len(words)}I", *words))
+
+
+class MemoryTarget:
+    '''
+    Registers in a dict, counting transfers, for trying plans out without a probe
+    '''
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.transfers = 0
+
+    def read(self, address, count):
+        self.transfers += 1
+        return [self.values.get(address + 4 * i, 0) for i in range(count)]
+
+    def write(self, address, words):
+        self.transfers += 1
+        for i, word in enumerate(words):
+            self.values[address + 4 * i] = word
+
+
+def _expression(term, variable=lambda name: name):
+    name, keep, value = term
+    if not keep:
+        return f"0x{value:08X}"
+    if keep == MASK32:
+        return f"({variable(name)} | 0x{value:08X})" if value else variable(name)
+    return f"(({variable(name)} & 0x{keep:08X}) | 0x{value:08X})"
+
+def _masked(expression, mask):
+    return expression if mask == MASK32 else f"({expression} & 0x{mask:08X})"
+
+def gdb_command(plan, command='configureTrace'):
+    lines = [
+        "import gdb",
+        "import struct",
+        "",
+        "# Generated by regmap.py",
+        f"class {command}(gdb.Command):",
+        "    def __init__(self):",
+        f"        super({command}, self).__init__(\"{command}\", gdb.COMMAND_USER)",
+        "",
+        "    def invoke(self, args, from_tty):",
+        "        target = gdb.selected_inferior()",
+        "        def read(address, count):",
+        "            return struct.unpack(f\"<{count}I\", target.read_memory(address, 4 * count).tobytes())",
+    ]
+    for address, count, names in plan.reads:
+        lines.append(f"        words = read(0x{address:08X}, {count})")
+        lines += [f"        {name} = words[{index}]" for name, index in names.items()]
+    for address, terms in plan.blocks:
+        lines.append(f"        # {' '.join(term[0] for term in terms)}")
+        lines.append(f"        target.write_memory(0x{address:08X}, struct.pack(\"<{len(terms)}I\", "
+                     f"{', '.join(_expression(term) for term in terms)}))")
+    if plan.checks:
+        lines.append("        bad = []")
+        for address, count, names in plan.check_spans:
+            lines.append(f"        words = read(0x{address:08X}, {count})")
+            for name, index in names.items():
+                mask, term = plan.checks[name]
+                lines.append(f"        if {_masked(f'words[{index}]', mask)} != {_masked(_expression(term), mask)}:")
+                lines.append(f"            bad.append(\"{name}\")")
+        lines.append("        if bad:")
+        lines.append("            raise gdb.GdbError(\"registers did not read back as written: \" + \", \".join(bad))")
+    lines += ["", "", f"{command}()", ""]
+    return "\n".join(lines)
+
+def tcl_proc(plan, proc='configure_trace'):
+    variable = lambda name: f"${name}"
+    lines = ["# Generated by regmap.py, needs OpenOCD 0.12 read_memory / write_memory", f"proc {proc} {{}} {{"]
+    for address, count, names in plan.reads:
+        lines.append(f"    set words [read_memory 0x{address:08X} 32 {count}]")
+        lines += [f"    set {name} [lindex $words {index}]" for name, index in names.items()]
+    for address, terms in plan.blocks:
+        words = " ".join(_expression(term) if not term[1] else f"[expr {{{_expression(term, variable)}}}]"
+                         for term in terms)
+        lines.append(f"    write_memory 0x{address:08X} 32 [list {words}]    ;# {' '.join(term[0] for term in terms)}")
+    if plan.checks:
+        lines.append("    set bad {}")
+        for address, count, names in plan.check_spans:
+            lines.append(f"    set words [read_memory 0x{address:08X} 32 {count}]")
+            for name, index in names.items():
+                mask, term = plan.checks[name]
+                lines.append(f"    if {{{_masked(f'[lindex $words {index}]', mask)} != "
+                             f"{_masked(_expression(term, variable), mask)}}} {{ lappend bad {name} }}")
+        lines.append("    if {[llength $bad]} { error \"registers did not read back as written: $bad\" }")
+    lines += ["}", ""]
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import sys
+    acpr = int(sys.argv[2], 0) if len(sys.argv) > 2 else 15
+    if len(sys.argv) > 1 and sys.argv[1] in ('gdb', 'tcl'):
+        plan = RegisterMap().plan(trace_config(acpr))
+        print(gdb_command(plan) if sys.argv[1] == 'gdb' else tcl_proc(plan), end='')
+        sys.exit(0)
+    # Transfers on a simulated target: etm.py's three commands did 2 + 2 reads / writes for
+    # enableDBG, 3 writes for configureTPIU and 8 for enableETM, unverified
+    target = MemoryTarget({DWT_CTRL: 0x40000000})
+    registers = RegisterMap(target)
+    for run in ("first", "again", "after reset"):
+        if run == "after reset":
+            target.values = {DWT_CTRL: 0x40000000}
+        target.transfers = 0
+        plan = registers.apply(trace_config(acpr))
+        print(f"{run}: {plan.writes} words written in {len(plan.blocks)} blocks, {plan.skipped} skipped, {registers.resets} resets, "
+              f"{target.transfers} transfers verified (etm.py: 15 unverified)")
@@ -0,0 +1,157 @@
+import numpy as np
+from cwproject import open_project
+
+'''
+Trace alignment and averaging
+
+Boots don't line up sample for sample, the trigger jitters and the boot ROM takes a little
+longer some times. Every trace is aligned to a reference (vcap_ref in the notebook) by the
+normalized cross-correlation of one window of the reference against the same stretch of
+the trace, max_shift samples either way:
+- the correlation of a whole chunk of traces at every lag is one batched rfft / irfft
+- the normalization (the trace's std under the window at every lag) comes from cumsums
+Aligned traces are accumulated chunk by chunk into a per-sample mean and variance
+(Chan's parallel merge of Welford's statistics), samples shifted in from outside the
+trace don't count, so only one chunk is ever in memory. traces can be a memmapped .npy,
+cwproject's LazyArray or tracepack's PackedTraces.
+
+    python align.py ../traces/stm32f4-traces-vcap.cwp [traces]
+'''
+
+def _fft_size(n):
+    return 1 << int(np.ceil(np.log2(n)))
+
+def _window(reference, window):
+    start, stop = window
+    ref = np.asarray(reference[start:stop], dtype=np.float64)
+    ref = ref - ref.mean()
+    norm = np.sqrt((ref ** 2).sum())
+    if norm == 0:
+        raise ValueError(f"reference window {window} is flat, nothing to align on")
+    return ref / norm
+
+'''
+Shift and correlation of every trace in a chunk, shift > 0 means the trace runs late
+The traces' stretch is padded with its edge values where the window is near either end
+'''
+def chunk_shifts(chunk, ref, start, max_shift):
+    chunk = np.atleast_2d(np.asarray(chunk, dtype=np.float64))
+    length = len(ref)
+    lo, hi = start - max_shift, start + length + max_shift
+    stretch = chunk[:, max(lo, 0):min(hi, chunk.shape[1])]
+    stretch = np.pad(stretch, ((0, 0), (max(-lo, 0), max(hi - chunk.shape[1], 0))), mode='edge')
+    size = _fft_size(stretch.shape[1] + length)
+    lags = 2 * max_shift + 1
+    # sum(ref * stretch[k:k + length]) at every lag k, ref is zero mean so the trace's mean drops out
+    dot = np.fft.irfft(np.fft.rfft(stretch, size, axis=1) * np.conj(np.fft.rfft(ref, size)), size, axis=1)[:, :lags]
+    csum = np.concatenate([np.zeros((len(stretch), 1)), np.cumsum(stretch, axis=1)], axis=1)
+    csum2 = np.concatenate([np.zeros((len(stretch), 1)), np.cumsum(stretch ** 2, axis=1)], axis=1)
+    total = csum[:, length:length + lags] - csum[:, :lags]
+    total2 = csum2[:, length:length + lags] - csum2[:, :lags]
+    spread = np.sqrt(np.maximum(total2 - total ** 2 / length, 0))
+    corr = dot / np.where(spread > 0, spread, np.inf)
+    best = corr.argmax(axis=1)
+    return best - max_shift, corr[np.arange(len(best)), best]
+
+def find_shifts(traces, reference, window, max_shift=1000, chunk=64):
+    ref = _window(reference, window)
+    shifts = np.zeros(len(traces), dtype=np.int64)
+    corr = np.zeros(len(traces))
+    lo, hi = max(window[0] - max_shift, 0), window[1] + max_shift
+    for first in range(0, len(traces), chunk):
+        # Only the columns around the window are read
+        part = np.asarray(traces[first:first + chunk, lo:hi])
+        shifts[first:first + chunk], corr[first:first + chunk] = chunk_shifts(part, ref, window[0] - lo, max_shift)
+    return shifts, corr
+
+'''
+Traces moved back by their shifts, sample i of the output is sample i + shift of the input
+Samples from past either end are fill
+'''
+def shift_traces(chunk, shifts, fill=np.nan):
+    chunk = np.atleast_2d(np.asarray(chunk, dtype=np.float64))
+    index = np.arange(chunk.shape[1])[None, :] + np.asarray(shifts)[:, None]
+    inside = (index >= 0) & (index < chunk.shape[1])
+    out = np.take_along_axis(chunk, np.clip(index, 0, chunk.shape[1] - 1), axis=1)
+    out[~inside] = fill
+    return out
+
+
+class RunningStats:
+    '''
+    Per-sample count / mean / variance over batches of traces, nan samples are skipped
+    '''
+    def __init__(self, points):
+        self.count = np.zeros(points, dtype=np.int64)
+        self.mean = np.zeros(points)
+        self.m2 = np.zeros(points)
+
+    def add(self, batch):
+        valid = ~np.isnan(batch)
+        count = valid.sum(axis=0)
+        values = np.where(valid, batch, 0)
+        mean = values.sum(axis=0) / np.maximum(count, 1)
+        m2 = (np.where(valid, batch - mean, 0) ** 2).sum(axis=0)
+        total = self.count + count
+        delta = mean - self.mean
+        scale = np.where(total > 0, count / np.maximum(total, 1), 0)
+        self.mean += delta * scale
+        self.m2 += m2 + delta ** 2 * self.count * scale
+        self.count = total
+
+    def variance(self, ddof=0):
+        return np.where(self.count > ddof, self.m2 / np.maximum(self.count - ddof, 1), np.nan)
+
+
+'''
+Align every trace to the reference and average them
+
+reference is a trace (or a row number in traces), window the (start, stop) samples of the
+reference to correlate on, pick a busy stretch that is in every boot. Traces that correlate
+below min_corr at their best shift are left out of the mean / variance.
+'''
+def align(traces, reference, window, max_shift=1000, chunk=64, min_corr=None, ddof=0):
+    if isinstance(reference, (int, np.integer)):
+        reference = traces[int(reference)]
+    ref = _window(reference, window)
+    n, points = len(traces), traces.shape[1]
+    shifts = np.zeros(n, dtype=np.int64)
+    corr = np.zeros(n)
+    stats = RunningStats(points)
+    for first in range(0, n, chunk):
+        part = np.asarray(traces[first:first + chunk], dtype=np.float64)
+        part_shifts, part_corr = chunk_shifts(part, ref, window[0], max_shift)
+        shifts[first:first + len(part)], corr[first:first + len(part)] = part_shifts, part_corr
+        keep = part_corr >= min_corr if min_corr is not None else np.ones(len(part), dtype=bool)
+        if keep.any():
+            stats.add(shift_traces(part[keep], part_shifts[keep]))
+    return {
+        'shifts': shifts,
+        'corr': corr,
+        'used': corr >= min_corr if min_corr is not None else np.ones(n, dtype=bool),
+        'mean': stats.mean,
+        'variance': stats.variance(ddof),
+        # Traces that cover each sample once aligned
+        'count': stats.count,
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    # Jittered, noisy copies of the stock vcap trace, the recovered shifts should undo the jitter
+    path = sys.argv[1] if len(sys.argv) > 1 else "../traces/stm32f4-traces-vcap.cwp"
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    stock = np.asarray(open_project(path).traces[0])
+    rng = np.random.default_rng(0)
+    jitter = rng.integers(-400, 400, n)
+    traces = np.stack([np.roll(stock, s) for s in jitter]) + rng.normal(0, 0.002, (n, len(stock)))
+    window = (39000, 41000)
+    start = time.perf_counter()
+    result = align(traces, stock, window, max_shift=500)
+    elapsed = time.perf_counter() - start
+    print(f"{n} x {len(stock)} aligned in {elapsed:.2f}s ({elapsed / n * 1000:.2f}ms per trace)")
+    print(f"Shifts recovered: {int((result['shifts'] == jitter).sum())}/{n}, worst corr {result['corr'].min():.3f}")
+    inner = result['count'] == n
+    print(f"Mean vs stock, max error {np.abs(result['mean'][inner] - stock[inner]).max():.5f}, "
+          f"noise std {np.sqrt(np.median(result['variance'][inner])):.5f} (added 0.00200)")
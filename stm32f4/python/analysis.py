@@ -1,12 +1,41 @@
 import os
 import sys
+import re
+import mmap
+import numpy as np
 
 GLITCH_RESULTS = {
     0 : 'BOOT_MODE',
     1 : 'SWD_ENABLE',
     2 : 'FLASH_READ',
+    3 : 'NORMAL',
+    4 : 'MUTE',
 }
 
+# Result codes that count as a successful glitch
+SUCCESS_RESULTS = (0, 1, 2)
+
+# Columnar layout for parsed results, one row per glitch
+GLITCH_DTYPE = np.dtype([
+    ('x', np.float64),
+    ('y', np.float64),
+    ('z', np.float64),
+    ('offset', np.int32),
+    ('result', np.uint8),
+])
+
+# Matches both the christmas-presents style lines:
+#   Boot SWD Bypass! Glitch! X: 183.8 - Y: 86.5 Ext Offset: 7800
+# and the lines that stm32f4-3d.py writes through the GDBG logger:
+#   ... [DEBUG]  RDP2_RDP1 X: 184.6 - Y: 86.8 Offset: 7800
+GLITCH_LINE = re.compile(
+    rb'(?:Boot (SWD )?Bypass! Glitch! X: ([-+.\deE]+) - Y: ([-+.\deE]+) Ext Offset: (-?\d+))'
+    rb'|(?:RDP2_RDP1 X: ([-+.\deE]+) - Y: ([-+.\deE]+) Offset: (-?\d+))'
+)
+
+# Default read size for the streaming parser, memory use is bounded by this
+CHUNK_SIZE = 1 << 22
+
 class GlitchResult:
 
     def __init__(self,x,y,z,offset,result):
@@ -34,39 +63,98 @@ def parse_results(result_path):
                                              result))
     return glitches
 
+def _matches_to_array(matches):
+    rows = np.zeros(len(matches), dtype=GLITCH_DTYPE)
+    if len(matches) == 0:
+        return rows
+    # Both alternatives are merged column-wise, the unused groups come back empty
+    swd, x, y, offset, rx, ry, roffset = zip(*matches)
+    rows['x'] = np.array([a or b for a, b in zip(x, rx)]).astype(np.float64)
+    rows['y'] = np.array([a or b for a, b in zip(y, ry)]).astype(np.float64)
+    rows['offset'] = np.array([a or b for a, b in zip(offset, roffset)]).astype(np.int32)
+    rows['result'] = np.array([len(s) != 0 for s in swd], dtype=np.uint8)
+    return rows
+
+'''
+Stream a glitch log in fixed size chunks, yields GLITCH_DTYPE arrays
+Only one chunk of the file is held in memory at any point
+'''
+def iter_results(result_path, chunk_size=CHUNK_SIZE):
+    tail = b''
+    with open(result_path, 'rb') as infile:
+        while True:
+            block = infile.read(chunk_size)
+            if not block:
+                break
+            block = tail + block
+            # Only parse complete lines, carry the rest over to the next read
+            cut = block.rfind(b'\n') + 1
+            tail = block[cut:]
+            rows = _matches_to_array(GLITCH_LINE.findall(block, 0, cut))
+            if len(rows):
+                yield rows
+    if tail:
+        rows = _matches_to_array(GLITCH_LINE.findall(tail))
+        if len(rows):
+            yield rows
+
+'''
+Same as iter_results, but scans a memory mapped view of the log instead of reading it
+'''
+def iter_results_mmap(result_path, chunk_size=CHUNK_SIZE):
+    with open(result_path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            start = 0
+            size = len(view)
+            while start < size:
+                end = view.find(b'\n', min(start + chunk_size, size) - 1)
+                end = size if end == -1 else end + 1
+                rows = _matches_to_array(GLITCH_LINE.findall(view, start, end))
+                if len(rows):
+                    yield rows
+                start = end
+
+'''
+Parse a full log into a single structured array, columns are x, y, z, offset and result
+'''
+def parse_results_array(result_path, use_mmap=False, chunk_size=CHUNK_SIZE):
+    reader = iter_results_mmap if use_mmap else iter_results
+    chunks = list(reader(result_path, chunk_size))
+    if not chunks:
+        return np.zeros(0, dtype=GLITCH_DTYPE)
+    return np.concatenate(chunks)
+
+def to_array(glitches):
+    rows = np.zeros(len(glitches), dtype=GLITCH_DTYPE)
+    for i, glitch in enumerate(glitches):
+        rows[i] = (glitch.x, glitch.y, glitch.z, glitch.offset, glitch.result)
+    return rows
+
 '''
 Answer the following
 - How many boot mode glitches vs SWD glitches?
 - For each, which regions were more reliable?
 - For each, which offsets were more reliable?
 
+The numbers come from stats.campaign_stats, this only prints the summary
 '''
 def GenerateStats(glitches):
-    boot_glitches = []
-    swd_glitches = []
-    for glitch in glitches:
-        swd_glitches.append(glitch) if glitch.result == 1 else boot_glitches.append(glitch)
-    print(f"Boot Mode Glitches Total: {len(boot_glitches)}")
-    print(f"SWD Glitches Total: {len(swd_glitches)}")
-    ext_offsets = {}
-    for glitch in boot_glitches:
-        if glitch.offset not in ext_offsets:
-            ext_offsets[glitch.offset] = 1
-        else:
-            ext_offsets[glitch.offset]+=1
-    test = sorted(ext_offsets, key=ext_offsets.get, reverse=True)
-    print(f"Top 5 EXT Offsets for Boot Mode Bypass: {test[0:5]}")
-    ext_offsets = {}
-    for glitch in swd_glitches:
-        if glitch.offset not in ext_offsets:
-            ext_offsets[glitch.offset] = 1
-        else:
-            ext_offsets[glitch.offset]+=1
-    test = sorted(ext_offsets, key=ext_offsets.get, reverse=True)
-    print(f"Top 5 EXT Offsets for SWD Enable: {test[0:5]}")
+    import stats
+    if not isinstance(glitches, np.ndarray):
+        glitches = to_array(glitches)
+    summary = stats.campaign_stats(glitches, k=5)
+    print(f"Boot Mode Glitches Total: {summary['counts']['BOOT_MODE']}")
+    print(f"SWD Glitches Total: {summary['counts']['SWD_ENABLE']}")
+    boot_top = summary['top_offsets'].get('BOOT_MODE', ([], []))[0]
+    print(f"Top 5 EXT Offsets for Boot Mode Bypass: {list(map(int, boot_top))}")
+    swd_top = summary['top_offsets'].get('SWD_ENABLE', ([], []))[0]
+    print(f"Top 5 EXT Offsets for SWD Enable: {list(map(int, swd_top))}")
+    return summary
 
 
 
 if __name__ == "__main__":
-    glitches = parse_results(sys.argv[1])
+    glitches = parse_results_array(sys.argv[1])
     GenerateStats(glitches)
@@ -0,0 +1,88 @@
+import logging
+import sys
+import stm32bl
+import timing
+from rig import HardwareRig, configure_edge_trigger
+from scanplan import ScanPlan, frange
+from simulator import SimulatedTarget
+
+'''
+Campaign throughput benchmark on the simulated rig (see simulator.py)
+
+Runs the RDP2 loop (power cycle glitch, bootloader probe) and the RDP1 loop (edge triggered
+glitch on READ_MEMORY) through the real rig / campaign code against the emulated devices,
+and reports attempts per second plus the latency of every step of an attempt, from the
+timing.py spans in campaign.py and inside the drivers.
+
+    python bench.py [attempts] [boot_wait]
+
+boot_wait defaults to the rig's, set it to 0 to see the loop overhead alone.
+'''
+
+
+def throughput(campaign):
+    return f"  {campaign.attempts} attempts in {campaign.elapsed:.2f}s, {campaign.attempts_per_second:.2f} attempts/s"
+
+def bench_rdp2(rig, attempts):
+    plan = ScanPlan(["ext_offset", "x", "y", "tries"], {
+        "ext_offset": range(7800, 7826),
+        "x": frange(184.4, 184.8, .1),
+        "y": frange(86.6, 87.0, .1),
+        "tries": [1],
+    })
+    settings = [dict(zip(plan.parameters, setting)) for setting in plan.glitch_values()][:attempts]
+    results = rig.run(settings)
+    return sum(result == 0 for result in results)
+
+def bench_rdp1(rig, sim, attempts, page_size=0x100):
+    configure_edge_trigger(rig.scope)
+    settings = [{'ext_offset': offset} for offset in range(400, 600)]
+    address = sim.config['flash_base']
+    pages = 0
+    done = 0
+    while done < attempts:
+        # Stand in for the RDP2 bypass, that part is measured on its own
+        if not rig.in_bootloader:
+            sim.enter_bootloader()
+        results, page = rig.read_page(settings[done % len(settings):][:attempts - done], address, page_size)
+        done += len(results)
+        if page is not None:
+            start = address - sim.config['flash_base']
+            assert page == sim.flash[start:start + page_size], "page read back wrong"
+            pages += 1
+            address += page_size
+    return pages
+
+
+if __name__ == "__main__":
+    attempts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    config = {}
+    if len(sys.argv) > 2:
+        config['boot_wait'] = float(sys.argv[2])
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.DEBUG)
+    sim = SimulatedTarget({'seed': 1})
+    rig = HardwareRig(dict(sim.rig_config(), **config), scope=sim.scope)
+    rig.in_bootloader = False
+    try:
+        stm32bl.reset_latency()
+        timing.enable()
+        found = bench_rdp2(rig, attempts)
+        print(f"RDP2 loop: {found} bootloader entries")
+        print(throughput(rig.campaign))
+        stm32bl.log_latency_histograms(logger)
+        print(timing.format_summary())
+        stm32bl.reset_latency()
+        timing.enable()
+
+        rig.campaign.attempts = 0
+        rig.campaign.elapsed = 0.0
+        pages = bench_rdp1(rig, sim, attempts)
+        print(f"RDP1 loop: {pages} pages read")
+        print(throughput(rig.campaign))
+        stm32bl.log_latency_histograms(logger)
+        print(timing.format_summary())
+    finally:
+        rig.close()
+        sim.close()
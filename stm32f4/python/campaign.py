@@ -0,0 +1,113 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import timing
+
+'''
+Concurrent campaign loop
+
+Each device gets its own single worker thread, so commands to one device stay in order
+while the devices themselves run side by side:
+- printer: G0 moves confirmed with "ok" and M400
+- pico: arming the PicoEMP
+- scope: capture while the target is being probed
+- probe: bootloader probing over the UART
+
+Per attempt the only sync points are: the head is in place and the PicoEMP is armed before
+the glitch is fired, and the probe result is in before the next attempt fires. The move to
+the next position is started as soon as the glitch has fired, so it overlaps with the probe.
+'''
+
+def _spanned(name, function, setting):
+    # Times a step on the device thread it runs on, not the wait for it
+    with timing.span(name):
+        return function(setting)
+
+
+class Campaign:
+    def __init__(self, printer=None, pico=None):
+        self.printer = printer
+        self.pico = pico
+        self.printer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='printer')
+        self.pico_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pico')
+        self.scope_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scope')
+        self.probe_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='probe')
+        self.attempts = 0
+        self.elapsed = 0.0
+        # Runs can nest (RDP1 falls back to RDP2), only the outer one counts time
+        self._depth = 0
+
+    def move_to(self, position):
+        if self.printer is None or position is None:
+            return None
+        return self.printer_pool.submit(self.printer.move, *position)
+
+    def arm(self):
+        if self.pico is None:
+            return None
+        return self.pico_pool.submit(self.pico.arm)
+
+    '''
+    Run attempts until settings runs out or on_result returns True
+
+    position(setting) -> (x, y, z) for the probe head, or None to stay put
+    prepare(setting)  -> main thread setup (ext_offset, glitch_hp/lp, ...) overlapped with motion and arming
+    fire(setting)     -> main thread, arms the scope / power cycles the target
+    probe(setting)    -> probe thread, returns the attempt result
+    capture(setting)  -> optional, scope thread, runs alongside the probe (eg scope.capture())
+    on_result(setting, result, captured) -> return True to stop
+
+    Returns the (setting, result) that stopped the run, or None
+    '''
+    def run(self, settings, position, prepare, fire, probe, capture=None, on_result=None):
+        start = time.monotonic()
+        self._depth += 1
+        settings = iter(settings)
+        setting = next(settings, None)
+        move = self.move_to(position(setting)) if setting is not None else None
+        try:
+            while setting is not None:
+                timing.next_attempt()
+                armed = self.arm()
+                with timing.span('campaign.prepare'):
+                    prepare(setting)
+                # prepare may have moved the head (eg a nested RDP2 run), this is a no-op otherwise
+                move = self.move_to(position(setting))
+                with timing.span('campaign.wait_move'):
+                    if move is not None:
+                        move.result()
+                with timing.span('campaign.wait_arm'):
+                    if armed is not None:
+                        armed.result()
+
+                with timing.span('campaign.fire'):
+                    fire(setting)
+                probed = self.probe_pool.submit(_spanned, 'campaign.probe', probe, setting)
+                captured = self.scope_pool.submit(_spanned, 'campaign.capture', capture, setting) if capture else None
+
+                # The glitch has fired, the head is free to travel while the target is probed
+                next_setting = next(settings, None)
+                if next_setting is not None:
+                    move = self.move_to(position(next_setting))
+
+                with timing.span('campaign.wait_probe'):
+                    result = probed.result()
+                    trace = captured.result() if captured is not None else None
+                self.attempts += 1
+                with timing.span('campaign.on_result'):
+                    stop = on_result is not None and on_result(setting, result, trace)
+                if stop:
+                    return setting, result
+                setting = next_setting
+            return None
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.elapsed += time.monotonic() - start
+
+    @property
+    def attempts_per_second(self):
+        return self.attempts / self.elapsed if self.elapsed else 0.0
+
+    def close(self):
+        for pool in (self.printer_pool, self.pico_pool, self.scope_pool, self.probe_pool):
+            pool.shutdown(wait=True)
@@ -0,0 +1,123 @@
+import itertools
+import json
+import os
+import time
+
+'''
+Campaign checkpoints
+
+The position of a running campaign is kept in a small JSON file next to the logs: the
+phase, how many attempts of the current RDP2 / RDP1 sweep are done, the flash address being
+read and the PicoEMP / scope config. It is rewritten after every attempt by writing a temp
+file and os.replace()ing it over the old one, so a crash leaves either the old or the new
+checkpoint and never a torn one. That is a single small write per attempt, attempts take
+hundreds of milliseconds.
+
+A restarted run loads the checkpoint and skip()s every sweep past the attempts it already
+ran. Plans are resumed by index (ScanPlan.glitch_values(start)), anything else is sliced.
+The scope glitch settings are saved per phase once its trigger is set up, restore_devices()
+puts them back after the resumed run's own setup so a campaign keeps the settings it started
+with, and reports where they differ from what the script configured.
+'''
+
+# Device settings saved with the checkpoint, ext_offset isn't one, every attempt sets its own
+SCOPE_GLITCH_FIELDS = ('clk_src', 'output', 'trigger_src', 'repeat', 'width', 'offset')
+PICO_FIELDS = ('armed', 'external_hvp_active', 'timeout_disabled')
+
+
+class Checkpoint:
+    def __init__(self, path, sync=False):
+        self.path = path
+        # fsync every save, only needed to survive power loss, a crashed process can't tear os.replace
+        self.sync = sync
+        self.state = {}
+        self.resumed = False
+        # Phases whose device settings were put back already, only the first setup of each is resumed
+        self._restored = set()
+        if os.path.exists(path):
+            with open(path) as infile:
+                self.state = json.load(infile)
+            self.resumed = True
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **values):
+        self.state.update(values)
+        self.save()
+
+    def save(self):
+        self.state['saved'] = time.time()
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as outfile:
+            json.dump(self.state, outfile)
+            if self.sync:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        os.replace(tmp, self.path)
+
+    '''
+    Index of the next attempt to run in the sweep called name
+    '''
+    def position(self, name):
+        return self.state.get('sweeps', {}).get(name, 0)
+
+    def advance(self, name, count=1, **values):
+        sweeps = self.state.setdefault('sweeps', {})
+        sweeps[name] = sweeps.get(name, 0) + count
+        self.update(**values)
+
+    def reset(self, name):
+        self.state.setdefault('sweeps', {})[name] = 0
+        self.save()
+
+    '''
+    Settings for the sweep called name, starting at the first attempt that hasn't run.
+    source is a ScanPlan (resumed by index) or anything with glitch_values() / any iterable.
+    '''
+    def skip(self, name, source):
+        start = self.position(name)
+        if hasattr(source, 'glitch_values'):
+            try:
+                return source.glitch_values(start=start)
+            except TypeError:
+                source = source.glitch_values()
+        return itertools.islice(source, start, None)
+
+    def save_devices(self, phase, pico=None, scope=None):
+        if pico is not None:
+            self.state['pico'] = {field: getattr(pico, field) for field in PICO_FIELDS}
+        if scope is not None:
+            self.state.setdefault('scope', {})[phase] = {field: getattr(scope.glitch, field) for field in SCOPE_GLITCH_FIELDS}
+        self.save()
+
+    '''
+    Put the settings saved for phase back on the devices, once per phase and only on a resumed
+    run. Returns {field: (configured, saved)} for every one that differed
+    '''
+    def restore_devices(self, phase, pico=None, scope=None):
+        changed = {}
+        if not self.resumed or phase in self._restored:
+            return changed
+        self._restored.add(phase)
+        saved = self.state.get('pico', {})
+        if pico is not None:
+            for field, method in (('timeout_disabled', pico.disable_timeout), ('external_hvp_active', pico.external_hvp),
+                                  ('armed', pico.arm)):
+                if saved.get(field) and not getattr(pico, field):
+                    changed[f"pico.{field}"] = (False, True)
+                    method()
+        saved = self.state.get('scope', {}).get(phase, {})
+        if scope is not None:
+            for field, value in saved.items():
+                configured = getattr(scope.glitch, field)
+                if configured != value:
+                    changed[f"scope.glitch.{field}"] = (configured, value)
+                    setattr(scope.glitch, field, value)
+        return changed
+
+
+if __name__ == "__main__":
+    import sys
+    # Show where a campaign will pick up
+    print(json.dumps(Checkpoint(sys.argv[1]).state, indent=2))
@@ -0,0 +1,148 @@
+import numpy as np
+from analysis import GLITCH_RESULTS
+from resultstore import RESULT_NORMAL, RESULT_MUTE
+
+'''
+Power trace outcome classifier
+
+The boot ROM, the bootloader and the user firmware each leave their own shape in the power
+trace the Husky captures during reboot_flush (see images/stock-power-trace.png). Each trace
+is reduced to an activity envelope (the standard deviation of every block of samples, the
+switching noise of whatever code is running, which also soaks up a little trigger jitter),
+z-normalized, and correlated against a template per outcome with a single matrix product,
+so a whole batch is classified in one go.
+
+Labels are result codes: BOOT_MODE (0) for the bootloader, NORMAL (3) for a normal boot,
+MUTE (4) for a trace with no activity at all (crashed / held in reset), UNKNOWN (-1) for
+anything that doesn't match a template well enough. Only NORMAL and MUTE are confident
+enough to skip the UART probe, everything else gets probed.
+
+Templates are learnt from attempts the probe has already labelled, fit() them from the
+calibration traces and save() them for the next run.
+'''
+
+UNKNOWN = -1
+BOOT_MODE = 0
+LABEL_NAMES = {**GLITCH_RESULTS, UNKNOWN: 'UNKNOWN'}
+
+
+class TraceClassifier:
+    def __init__(self, block=256, min_corr=None, mute_level=None):
+        # Samples per envelope point
+        self.block = block
+        # Lowest correlation with the NORMAL template that still counts as a normal boot
+        self.min_corr = min_corr
+        # Mean activity (in trace units) below which the target is MUTE
+        self.mute_level = mute_level
+        self.labels = np.zeros(0, dtype=np.int8)
+        self.templates = None
+
+    def envelope(self, traces):
+        traces = np.atleast_2d(traces)
+        points = traces.shape[1] // self.block
+        blocks = np.asarray(traces[:, :points * self.block], dtype=np.float32)
+        return blocks.reshape(len(traces), points, self.block).std(axis=2)
+
+    @staticmethod
+    def _normalize(envelopes):
+        # z-normalized envelopes and the mean activity of each one
+        level = envelopes.mean(axis=1, keepdims=True)
+        centred = envelopes - level
+        std = centred.std(axis=1, keepdims=True)
+        return centred / np.where(std > 0, std, 1), level[:, 0]
+
+    '''
+    Build a template per label from traces that were labelled by the probe, labels are result codes
+    With no min_corr / mute_level given, they are set from the spread of the NORMAL traces
+    '''
+    def fit(self, traces, labels):
+        return self.fit_envelopes(self.envelope(traces), labels)
+
+    '''
+    fit() on envelopes collected with envelope(), a campaign keeps these instead of whole traces
+    '''
+    def fit_envelopes(self, envelopes, labels):
+        labels = np.asarray(labels)
+        normalized, level = self._normalize(np.asarray(envelopes, dtype=np.float32))
+        self.labels = np.unique(labels[labels >= 0]).astype(np.int8)
+        templates = np.stack([normalized[labels == label].mean(axis=0) for label in self.labels])
+        self.templates, _ = self._normalize(templates)
+        normal = labels == RESULT_NORMAL
+        if normal.any():
+            if self.min_corr is None:
+                corr = normalized[normal] @ self.templates[self.labels == RESULT_NORMAL][0] / normalized.shape[1]
+                # A little below the worst normal boot seen, so the odd noisy one still skips the probe
+                self.min_corr = float(np.percentile(corr, 1)) - 0.05
+            if self.mute_level is None:
+                self.mute_level = float(np.percentile(level[normal], 1)) * 0.25
+        return self
+
+    '''
+    Correlation of every trace with every template, shape (traces, templates), and the mean activity
+    '''
+    def scores(self, traces):
+        normalized, level = self._normalize(self.envelope(traces))
+        return normalized @ self.templates.T / normalized.shape[1], level
+
+    def classify(self, traces):
+        corr, level = self.scores(traces)
+        best = np.argmax(corr, axis=1)
+        labels = self.labels[best].astype(np.int8)
+        if self.min_corr is not None:
+            labels[corr[np.arange(len(best)), best] < self.min_corr] = UNKNOWN
+        # A quiet trace that matches none of the templates, a quiet bootloader still counts as one
+        if self.mute_level is not None:
+            labels[(labels == UNKNOWN) & (level < self.mute_level)] = RESULT_MUTE
+        return labels
+
+    def should_probe(self, labels):
+        return ~np.isin(labels, (RESULT_NORMAL, RESULT_MUTE))
+
+    def save(self, path):
+        np.savez(path, block=self.block, labels=self.labels, templates=self.templates,
+                 min_corr=np.nan if self.min_corr is None else self.min_corr,
+                 mute_level=np.nan if self.mute_level is None else self.mute_level)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        min_corr = float(data['min_corr'])
+        mute_level = float(data['mute_level'])
+        classifier = cls(int(data['block']),
+                         None if np.isnan(min_corr) else min_corr,
+                         None if np.isnan(mute_level) else mute_level)
+        classifier.labels = data['labels']
+        classifier.templates = data['templates']
+        return classifier
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    # Synthetic check around the stock vcap trace: jittered normal boots, a bootloader boot that
+    # goes quiet after the boot ROM, and mute targets that never come out of reset
+    path = sys.argv[1] if len(sys.argv) > 1 else "../traces/stm32f4-traces-vcap_data/traces/2023.05.10-18.03.34_0traces.npy"
+    stock = np.load(path, mmap_mode='r')[0]
+    rng = np.random.default_rng(0)
+    n = 200
+    activity = stock - np.median(stock)
+    def batch(kind):
+        shift = rng.integers(-32, 32, n)
+        traces = np.stack([np.roll(stock, s) for s in shift]) + rng.normal(0, 0.002, (n, len(stock)))
+        if kind == BOOT_MODE:
+            cut = len(stock) // 3
+            traces[:, cut:] = np.median(stock) + 0.4 * np.roll(activity, -cut)[:len(stock) - cut]
+        elif kind == RESULT_MUTE:
+            traces = np.median(stock) + rng.normal(0, 0.0003, (n, len(stock)))
+        return np.round((traces + 0.5) * 4096) / 4096 - 0.5
+    kinds = [RESULT_NORMAL, BOOT_MODE, RESULT_MUTE]
+    train = {kind: batch(kind) for kind in kinds}
+    classifier = TraceClassifier().fit(np.concatenate([train[RESULT_NORMAL][:50], train[BOOT_MODE][:5]]),
+                                       [RESULT_NORMAL] * 50 + [BOOT_MODE] * 5)
+    for kind in kinds:
+        traces = batch(kind)
+        start = time.perf_counter()
+        labels = classifier.classify(traces)
+        elapsed = (time.perf_counter() - start) / n * 1000
+        counts = {LABEL_NAMES[int(label)]: int(count) for label, count in zip(*np.unique(labels, return_counts=True))}
+        print(f"{LABEL_NAMES[kind]:10s} -> {counts}, probed {int(classifier.should_probe(labels).sum())}/{n}, {elapsed:.3f}ms per trace")
@@ -0,0 +1,187 @@
+import configparser
+import glob
+import os
+import numpy as np
+
+'''
+ChipWhisperer trace projects without chipwhisperer
+
+cw.open_project() loads every segment's traces, textin, keylist, ... into memory. Here the
+.cwp file and the config_*.cfg segment files are only parsed, every segment's arrays are
+opened with np.load(mmap_mode='r') the first time they are used, and all segments show up
+as one lazily concatenated array:
+
+    project = open_project("../traces/stm32f4-traces-vcap.cwp")
+    project.traces.shape     # (traces, points), nothing read yet
+    project.traces[0, 39900:39932]
+    for chunk in project.traces.chunks(256): ...
+
+Arrays saved with dtype=object (textin / keylist when the capture had none) can't be
+memory mapped, those are loaded in full when first touched. records is only on disk for
+projects written by tracesink.py, the result store record of every trace.
+'''
+
+SEGMENT_ARRAYS = ('traces', 'textin', 'textout', 'keylist', 'knownkey', 'records')
+
+
+class Segment:
+    def __init__(self, cfg_path):
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(cfg_path)
+        section = config['Trace Config']
+        self.path = cfg_path
+        self.directory = os.path.dirname(cfg_path)
+        self.prefix = section['prefix']
+        self.num_traces = int(section.get('numTraces', 0))
+        self.num_points = int(section.get('numPoints', 0))
+        self.date = section.get('date')
+        self.config = dict(section)
+        self._arrays = {}
+
+    def array_path(self, name):
+        return os.path.join(self.directory, f"{self.prefix}{name}.npy")
+
+    def array(self, name):
+        if name not in self._arrays:
+            path = self.array_path(name)
+            if name == 'traces' and self.config.get('format') == 'int16':
+                # int16 ADC codes, decoded chunk by chunk - see tracepack.py
+                from tracepack import PackedTraces, PACK_SUFFIX
+                self._arrays[name] = PackedTraces(os.path.join(self.directory, f"{self.prefix}{PACK_SUFFIX}"))
+                return self._arrays[name]
+            try:
+                self._arrays[name] = np.load(path, mmap_mode='r')
+            except ValueError:
+                # Object arrays are pickled, they can only be loaded whole
+                self._arrays[name] = np.load(path, allow_pickle=True)
+            # A segment still being written (tracesink.py) is preallocated past numTraces
+            if len(self._arrays[name]) > self.num_traces:
+                self._arrays[name] = self._arrays[name][:self.num_traces]
+        return self._arrays[name]
+
+    def __len__(self):
+        return self.num_traces
+
+
+class LazyArray:
+    '''
+    The named array of every segment, concatenated along the first axis on access only
+    '''
+    def __init__(self, segments, name):
+        self.segments = segments
+        self.name = name
+        self.bounds = np.cumsum([0] + [len(segment) for segment in segments])
+
+    def _part(self, index):
+        return self.segments[index].array(self.name)
+
+    @property
+    def shape(self):
+        if not self.segments:
+            return (0,)
+        return (int(self.bounds[-1]),) + self._part(0).shape[1:]
+
+    @property
+    def dtype(self):
+        return self._part(0).dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return int(self.bounds[-1])
+
+    def __getitem__(self, key):
+        rows, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(rows, (int, np.integer)):
+            row = int(rows) + len(self) if rows < 0 else int(rows)
+            if not 0 <= row < len(self):
+                raise IndexError(f"index {rows} is out of bounds for {len(self)} traces")
+            segment = int(np.searchsorted(self.bounds, row, side='right')) - 1
+            return self._part(segment)[(row - self.bounds[segment],) + rest]
+        if isinstance(rows, slice) and (rows.step or 1) == 1:
+            start, stop, _ = rows.indices(len(self))
+            parts = []
+            for segment in range(len(self.segments)):
+                lo, hi = max(start, self.bounds[segment]), min(stop, self.bounds[segment + 1])
+                if lo < hi:
+                    part = self._part(segment)
+                    parts.append(part[(slice(lo - self.bounds[segment], hi - self.bounds[segment]),) + rest])
+            if len(parts) == 1:
+                return parts[0]
+            return np.concatenate(parts) if parts else self._part(0)[(slice(0, 0),) + rest]
+        # Fancy indexing, gathered segment by segment in the requested order
+        rows = np.arange(len(self))[rows]
+        segment_of = np.searchsorted(self.bounds, rows, side='right') - 1
+        out = None
+        for segment in np.unique(segment_of):
+            pick = segment_of == segment
+            values = self._part(segment)[(rows[pick] - self.bounds[segment],) + rest]
+            if out is None:
+                out = np.empty((len(rows),) + values.shape[1:], dtype=values.dtype)
+            out[pick] = values
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return np.asarray(data, dtype=dtype) if dtype is not None else np.asarray(data)
+
+    def chunks(self, size=256):
+        # Consecutive blocks of rows, never larger than size and never spanning two segments
+        for segment in range(len(self.segments)):
+            part = self._part(segment)
+            for start in range(0, len(part), size):
+                yield part[start:start + size]
+
+
+class Project:
+    def __init__(self, path, include_disabled=False):
+        self.path = path
+        config = configparser.ConfigParser(strict=False, interpolation=None)
+        if not config.read(path):
+            raise FileNotFoundError(f"no project file {path}")
+        self.config = config
+        base = os.path.dirname(os.path.abspath(path))
+        cfg_paths = []
+        if config.has_section('Trace Management'):
+            manager = config['Trace Management']
+            for key, cfg_path in manager.items():
+                if not key.startswith('tracefile'):
+                    continue
+                enabled = manager.get('enabled' + key[len('tracefile'):], 'True') == 'True'
+                if enabled or include_disabled:
+                    cfg_paths.append(os.path.join(base, cfg_path))
+        if not cfg_paths:
+            # Projects that were copied around without their trace list, take every segment on disk
+            data_dir = os.path.splitext(os.path.abspath(path))[0] + '_data'
+            cfg_paths = sorted(glob.glob(os.path.join(data_dir, 'traces', 'config_*.cfg')))
+        if not cfg_paths:
+            raise ValueError(f"{path} has no trace segments")
+        self.segments = [Segment(cfg_path) for cfg_path in cfg_paths]
+        for name in SEGMENT_ARRAYS:
+            setattr(self, name, LazyArray(self.segments, name))
+
+    @property
+    def waves(self):
+        # Same name as the chipwhisperer project attribute
+        return self.traces
+
+    def __len__(self):
+        return len(self.traces)
+
+
+def open_project(path, include_disabled=False):
+    return Project(path, include_disabled)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    start = time.perf_counter()
+    project = open_project(sys.argv[1] if len(sys.argv) > 1 else "../traces/stm32f4-traces-vcap.cwp",
+                           include_disabled=True)
+    print(f"Opened in {(time.perf_counter() - start) * 1000:.1f}ms")
+    for segment in project.segments:
+        print(f"  {segment.prefix}: {segment.num_traces} traces x {segment.num_points} points ({segment.date})")
+    print(f"traces {project.traces.shape} {project.traces.dtype}")
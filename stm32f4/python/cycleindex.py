@@ -0,0 +1,163 @@
+import os
+import sys
+import numpy as np
+# etmdecode.py writes the event files this reads, block addresses to names with its symbols
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'arm', 'tracing'))
+from etmdecode import load_symbols, symbolize
+from analysis import SUCCESS_RESULTS
+from resultstore import load, PHASE_RDP2
+
+'''
+Cycle to PC index
+
+A cycle accurate ETM trace (arm/tracing/etm.py enableETM, decoded and saved with
+etmdecode.py) gives the CPU cycle of every branch and I-sync and the address execution
+carries on from. Between two of those the core runs straight through one basic block,
+so a sorted array of block start cycles answers "what was running at cycle c" with one
+np.searchsorted, for any number of cycles at once.
+
+ext_offset counts scope clock cycles (30 MHz clkgen, rig.py) from the trigger, the STM32F4
+boots from the 16 MHz HSI: cycle = trigger_cycle + (ext_offset + latency) * cycles_per_offset,
+where trigger_cycle is where the scope trigger (reset for RDP2) sits in the ETM trace and
+latency covers the PicoEMP / glitch path delay. With that, campaign records join against
+the index in one pass (join, block_stats) and a block of interest maps back to the handful
+of ext_offsets that land in it (offsets_for).
+
+    python cycleindex.py boot-events.npy [store] [cycles_per_offset] [latency]
+'''
+
+# etmdecode event kinds that carry an address
+ISYNC = 0
+BRANCH = 1
+HSI_FREQ = 16e6
+CLKGEN_FREQ = 30e6
+CYCLES_PER_OFFSET = HSI_FREQ / CLKGEN_FREQ
+
+BLOCK_DTYPE = np.dtype([
+    ('start', '<i8'),
+    ('end', '<i8'),
+    ('address', '<u4'),
+    # Instructions (E + N atoms) executed in the block
+    ('instructions', '<u4'),
+])
+
+
+class CycleIndex:
+    def __init__(self, blocks, cycles_per_offset=CYCLES_PER_OFFSET, latency=0):
+        self.blocks = blocks
+        self.cycles_per_offset = cycles_per_offset
+        self.latency = latency
+
+    '''
+    Blocks from an etmdecode event array, cycles counted from trigger_cycle (default the first I-sync)
+    '''
+    @classmethod
+    def from_events(cls, events, trigger_cycle=None, **options):
+        events = events[np.isin(events['kind'], (ISYNC, BRANCH))]
+        if trigger_cycle is None:
+            trigger_cycle = int(events['cycle'][events['kind'] == ISYNC][0]) if (events['kind'] == ISYNC).any() else 0
+        cycle = events['cycle'].astype(np.int64) - trigger_cycle
+        blocks = np.zeros(len(events), dtype=BLOCK_DTYPE)
+        blocks['start'] = cycle
+        # The last block runs until the trace stops
+        blocks['end'] = np.append(cycle[1:], cycle[-1] + 1) if len(cycle) else cycle
+        blocks['address'] = events['address']
+        # An event's atoms are the ones executed since the event before, ie in the previous block
+        atoms = (events['executed'] + events['not_executed']).astype(np.int64)
+        blocks['instructions'] = np.append(atoms[1:], 0) if len(atoms) else atoms
+        return cls(blocks, **options)
+
+    @classmethod
+    def load(cls, path, **options):
+        return cls.from_events(np.load(path), **options)
+
+    def cycles(self, offsets):
+        return np.round((np.asarray(offsets, dtype=np.float64) + self.latency) * self.cycles_per_offset).astype(np.int64)
+
+    '''
+    Index of the block running at every cycle, -1 outside the trace
+    '''
+    def block_at(self, cycles):
+        cycles = np.asarray(cycles)
+        if not len(self.blocks):
+            # No I-sync or branch in the trace
+            return np.full(cycles.shape, -1, dtype=np.int64)
+        index = np.searchsorted(self.blocks['start'], cycles, side='right') - 1
+        inside = (index >= 0) & (cycles < self.blocks['end'][np.maximum(index, 0)])
+        return np.where(inside, index, -1)
+
+    def address_at(self, cycles):
+        return self.address_of(self.block_at(cycles))
+
+    '''
+    Address of every block index from block_at, 0 for -1
+    '''
+    def address_of(self, index):
+        index = np.asarray(index)
+        if not len(self.blocks):
+            return np.zeros(index.shape, dtype=self.blocks['address'].dtype)
+        return np.where(index >= 0, self.blocks['address'][np.maximum(index, 0)], 0)
+
+    '''
+    Campaign records (resultstore / analysis arrays) with the block and address their ext_offset lands in
+    '''
+    def join(self, records):
+        index = self.block_at(self.cycles(records['offset']))
+        joined = np.zeros(len(records), dtype=records.dtype.descr + [('block', '<i8'), ('address', '<u4')])
+        for name in records.dtype.names:
+            joined[name] = records[name]
+        joined['block'] = index
+        joined['address'] = self.address_of(index)
+        return joined
+
+    '''
+    Attempts, successes and rate per block address, most successes first
+    '''
+    def block_stats(self, records, success=SUCCESS_RESULTS):
+        joined = self.join(records)
+        joined = joined[joined['block'] >= 0]
+        addresses, inverse = np.unique(joined['address'], return_inverse=True)
+        attempts = np.bincount(inverse, minlength=len(addresses))
+        successes = np.bincount(inverse, weights=np.isin(joined['result'], success), minlength=len(addresses)).astype(np.int64)
+        order = np.lexsort((-attempts, -successes))
+        return {
+            'address': addresses[order],
+            'attempts': attempts[order],
+            'successes': successes[order],
+            'rate': successes[order] / np.maximum(attempts[order], 1),
+        }
+
+    '''
+    ext_offsets (within offset_range) that land in a block starting at one of the addresses
+    Every time the block runs counts, a loop body shows up once per iteration
+    '''
+    def offsets_for(self, addresses, offset_range):
+        offsets = np.arange(*offset_range)
+        hit = self.block_at(self.cycles(offsets))
+        wanted = (hit >= 0) & np.isin(self.address_of(hit), np.atleast_1d(addresses))
+        return offsets[wanted]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    index = CycleIndex.load(sys.argv[1],
+                            cycles_per_offset=float(sys.argv[3]) if len(sys.argv) > 3 else CYCLES_PER_OFFSET,
+                            latency=float(sys.argv[4]) if len(sys.argv) > 4 else 0)
+    if not len(index.blocks):
+        print(f"No I-sync or branch events in {sys.argv[1]}")
+        sys.exit(1)
+    print(f"{len(index.blocks)} blocks over {int(index.blocks['end'][-1])} cycles")
+    # What the current RDP2 sweep (stm32f4-3d.py RDP2_BP_START / END) lands in
+    sweep = (7800, 7826)
+    for offset, block in zip(range(*sweep), index.block_at(index.cycles(np.arange(*sweep)))):
+        if block >= 0:
+            print(f"  ext_offset {offset}: block 0x{int(index.blocks['address'][block]):08X}")
+    if len(sys.argv) > 2:
+        records = load(sys.argv[2])
+        stats = index.block_stats(records[records['phase'] == PHASE_RDP2])
+        print("Blocks by successes:")
+        for address, attempts, successes in list(zip(stats['address'], stats['attempts'], stats['successes']))[:10]:
+            window = index.offsets_for(address, (0, int(records['offset'].max()) + 1))
+            print(f"  0x{int(address):08X}: {successes}/{attempts}, ext_offsets {window[:8].tolist()}{'...' if len(window) > 8 else ''}")
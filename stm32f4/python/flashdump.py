@@ -0,0 +1,125 @@
+import os
+import struct
+import numpy as np
+
+'''
+Resumable flash dump
+
+Pages go straight into one preallocated, memory mapped image file and a coverage map
+next to it (<image>.pages) records which pages have been read. The coverage byte is only
+set after the page data has been flushed, so after a crash every page marked as read is
+valid and the dump picks up at the first missing page.
+'''
+
+PAGES_MAGIC = b'FDMP'
+# magic, base address, size, page size
+PAGES_HEADER = struct.Struct('<4sIII')
+
+class FlashDump:
+    def __init__(self, path, base=0x8000000, size=1024*256, page_size=0x100):
+        if size % page_size:
+            raise ValueError(f"Dump size 0x{size:X} is not a multiple of the page size 0x{page_size:X}")
+        self.path = path
+        self.pages_path = path + '.pages'
+        self.base = base
+        self.size = size
+        self.page_size = page_size
+        self.num_pages = size // page_size
+
+        header = PAGES_HEADER.pack(PAGES_MAGIC, base, size, page_size)
+        if os.path.exists(self.pages_path):
+            with open(self.pages_path, 'rb') as infile:
+                if infile.read(PAGES_HEADER.size) != header:
+                    raise ValueError(f"{self.pages_path} belongs to a different dump layout")
+        else:
+            with open(self.pages_path, 'wb') as ofile:
+                ofile.write(header)
+                ofile.write(bytes(self.num_pages))
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            # Preallocate the whole image, unread pages stay 0xFF like erased flash
+            with open(path, 'wb') as ofile:
+                ofile.write(b'\xff' * size)
+            with open(self.pages_path, 'r+b') as ofile:
+                ofile.seek(PAGES_HEADER.size)
+                ofile.write(bytes(self.num_pages))
+
+        self.image = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size,))
+        self.pages = np.memmap(self.pages_path, dtype=np.uint8, mode='r+',
+                               offset=PAGES_HEADER.size, shape=(self.num_pages,))
+
+    def page_index(self, address):
+        index, rem = divmod(address - self.base, self.page_size)
+        if rem or not 0 <= index < self.num_pages:
+            raise ValueError(f"0x{address:X} is not a page address in this dump")
+        return index
+
+    def page_address(self, index):
+        return self.base + index * self.page_size
+
+    def has_page(self, address):
+        return bool(self.pages[self.page_index(address)])
+
+    def write_page(self, address, data):
+        index = self.page_index(address)
+        if len(data) != self.page_size:
+            raise ValueError(f"Page 0x{address:X} needs {self.page_size} bytes, got {len(data)}")
+        start = index * self.page_size
+        self.image[start:start + self.page_size] = np.frombuffer(data, dtype=np.uint8)
+        self.image.flush()
+        # Only mark the page once its data is on disk
+        self.pages[index] = 1
+        self.pages.flush()
+
+    def missing_pages(self):
+        return np.flatnonzero(self.pages == 0)
+
+    '''
+    Addresses of the pages still to be read, in order
+    The glitch search only has to target these
+    '''
+    def missing_addresses(self):
+        return self.base + self.missing_pages() * self.page_size
+
+    def next_missing(self, address=None):
+        start = 0 if address is None else self.page_index(address)
+        missing = np.flatnonzero(self.pages[start:] == 0)
+        if len(missing) == 0:
+            missing = np.flatnonzero(self.pages[:start] == 0)
+            if len(missing) == 0:
+                return None
+            return self.page_address(int(missing[0]))
+        return self.page_address(start + int(missing[0]))
+
+    @property
+    def pages_read(self):
+        return int(np.count_nonzero(self.pages))
+
+    @property
+    def complete(self):
+        return bool(self.pages.all())
+
+    '''
+    Missing pages as (start address, end address) ranges, handy for logging
+    '''
+    def missing_ranges(self):
+        missing = self.missing_pages()
+        if len(missing) == 0:
+            return []
+        breaks = np.flatnonzero(np.diff(missing) != 1)
+        starts = np.concatenate(([missing[0]], missing[breaks + 1]))
+        ends = np.concatenate((missing[breaks], [missing[-1]]))
+        return [(self.page_address(int(s)), self.page_address(int(e)) + self.page_size) for s, e in zip(starts, ends)]
+
+    def close(self):
+        self.image.flush()
+        self.pages.flush()
+
+
+if __name__ == "__main__":
+    import sys
+    base = int(sys.argv[2], 0) if len(sys.argv) > 2 else 0x8000000
+    size = int(sys.argv[3], 0) if len(sys.argv) > 3 else 1024*256
+    dump = FlashDump(sys.argv[1], base, size)
+    print(f"{dump.pages_read}/{dump.num_pages} pages read")
+    for start, end in dump.missing_ranges():
+        print(f"Missing: 0x{start:08X} - 0x{end:08X}")
@@ -0,0 +1,179 @@
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+
+'''
+GlitchController pickles without chipwhisperer
+
+Graphing.ipynb / PyPlot-Examples.ipynb unpickle gc-pickle-*.pickle (a chipwhisperer
+GlitchResults: groups, parameters and _result_dict, {(ext_offset, x, y, tries): {'total',
+'success', 'normal', ...}}), which needs chipwhisperer importable, then rebuild lists one
+row at a time. Here the pickle is read once with the chipwhisperer classes swapped for a
+plain state holder, turned into one array per column (the same keys res_dict_of_lists
+gives: parameters, groups, total) and saved as .npy files under a cache directory named
+after the pickle's SHA-1. Every later load hashes the file and memory maps the columns:
+
+    results = load_results("../notebooks/logs/gc-pickle-stm32f4-20.7mm.pickle")
+    results['x'][results['success'] > 0]
+    dimension_histogram(results, 'ext_offset')
+
+load_all concatenates any number of pickles, with a 'source' column saying which one each
+row came from. The dicts go straight into pd.DataFrame().
+
+    python gcload.py ../notebooks/logs/gc-pickle-*.pickle
+'''
+
+CACHE_DIR = '.gc-cache'
+ORDER_FILE = '_columns.npy'
+
+
+class _State:
+    # Stand in for chipwhisperer's classes, keeps whatever state the pickle sets
+    def __setstate__(self, state):
+        self.__dict__.update(state if isinstance(state, dict) else {'state': state})
+
+
+class _ResultsUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module.split('.')[0] == 'chipwhisperer':
+            return type(name, (_State,), {})
+        return super().find_class(module, name)
+
+
+def _file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _column(values):
+    values = np.asarray(values)
+    # Integer parameters stay integers, coordinates come out float64
+    if values.dtype == object:
+        values = values.astype(np.float64)
+    return values
+
+'''
+Columns of a GlitchResults state, parameters first then groups then total like res_dict_of_lists
+Any other numeric per point value (success_rate, ...) comes along too
+'''
+def results_columns(results):
+    parameters = list(results.parameters)
+    groups = list(results.groups)
+    points = list(results._result_dict.items())
+    columns = {}
+    keys = np.array([key for key, _ in points], dtype=object).reshape(len(points), len(parameters))
+    for i, name in enumerate(parameters):
+        columns[name] = _column(keys[:, i].tolist() if len(points) else np.zeros(0))
+    names = groups + ['total']
+    for _, value in points[:1]:
+        names += [name for name in value if name not in names and isinstance(value[name], (int, float))]
+    for name in names:
+        columns[name] = _column([value.get(name, 0) for _, value in points] if points else np.zeros(0, dtype=np.int64))
+    return columns
+
+def read_pickle(path):
+    with open(path, 'rb') as infile:
+        return results_columns(_ResultsUnpickler(infile).load())
+
+
+def _cache_path(path, cache_dir):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR)
+    return os.path.join(cache_dir, _file_hash(path))
+
+def _save(columns, directory):
+    # Written next to the final directory and renamed into place, a half written cache is never seen
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=parent)
+    for name, values in columns.items():
+        np.save(os.path.join(staging, f"{name}.npy"), values, allow_pickle=False)
+    np.save(os.path.join(staging, ORDER_FILE), np.array(list(columns), dtype=str))
+    try:
+        os.rename(staging, directory)
+    except OSError:
+        # Someone else cached the same file first
+        shutil.rmtree(staging, ignore_errors=True)
+
+'''
+{column: array} of one GlitchController pickle, memory mapped from the cache after the first load
+'''
+def load_results(path, cache_dir=None):
+    directory = _cache_path(path, cache_dir)
+    order_path = os.path.join(directory, ORDER_FILE)
+    if not os.path.exists(order_path):
+        _save(read_pickle(path), directory)
+    names = np.load(order_path).tolist()
+    return {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in names}
+
+'''
+Several pickles (paths or glob patterns) as one set of columns, plus 'source', the index
+into the returned list of paths. Columns missing from some pickles (z) are filled with nan.
+'''
+def load_all(patterns, cache_dir=None):
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    paths = [path for pattern in patterns for path in (sorted(glob.glob(pattern)) or [pattern])]
+    parts = [load_results(path, cache_dir) for path in paths]
+    names = []
+    for part in parts:
+        names += [name for name in part if name not in names]
+    columns = {}
+    for name in names:
+        pieces = [part[name] if name in part else np.full(len(next(iter(part.values()))), np.nan) for part in parts]
+        columns[name] = np.concatenate(pieces) if pieces else np.zeros(0)
+    columns['source'] = np.repeat(np.arange(len(parts)), [len(next(iter(part.values()))) for part in parts])
+    return columns, paths
+
+
+'''
+Distinct values of a column and how many points with that value hit the group (success by
+default), what GenDimensionData counted one row at a time. weights='success' sums the group
+counts instead of counting points, decimals rounds float coordinates first.
+'''
+def dimension_histogram(results, dimension, group='success', weights=None, decimals=None):
+    if dimension not in results:
+        return None
+    hit = np.asarray(results[group]) > 0
+    values = np.asarray(results[dimension])[hit]
+    if decimals is not None:
+        values = np.round(values, decimals)
+    keys, inverse = np.unique(values, return_inverse=True)
+    counts = np.bincount(inverse, weights=np.asarray(results[weights])[hit] if weights else None,
+                         minlength=len(keys))
+    return keys, counts.astype(np.int64) if weights is None else counts
+
+'''
+Rows that hit the group and rows that didn't, GenXYData's success_* / norm_* as arrays
+'''
+def split(results, group='success'):
+    hit = np.asarray(results[group]) > 0
+    return ({name: np.asarray(values)[hit] for name, values in results.items()},
+            {name: np.asarray(values)[~hit] for name, values in results.items()})
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    patterns = sys.argv[1:] or [os.path.join(os.path.dirname(os.path.abspath(__file__)), "../notebooks/logs/gc-pickle-*.pickle")]
+    for run in ("cold", "warm"):
+        if run == "cold":
+            for path in [p for pattern in patterns for p in glob.glob(pattern)]:
+                shutil.rmtree(_cache_path(path, None), ignore_errors=True)
+        start = time.perf_counter()
+        results, paths = load_all(patterns)
+        print(f"{run}: {len(paths)} pickles, {len(results['source'])} points in {(time.perf_counter() - start) * 1000:.1f}ms")
+    start = time.perf_counter()
+    histograms = {name: dimension_histogram(results, name) for name in ('x', 'y', 'ext_offset', 'tries')}
+    print(f"Histograms in {(time.perf_counter() - start) * 1000:.2f}ms")
+    for index, path in enumerate(paths):
+        mine = results['source'] == index
+        print(f"  {os.path.basename(path)}: {int(mine.sum())} points, {int(results['success'][mine].sum())} successes")
+    keys, counts = histograms['ext_offset']
+    print("Successes per ext_offset: " + ", ".join(f"{int(k)}: {int(c)}" for k, c in zip(keys, counts)))
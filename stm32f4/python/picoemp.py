@@ -1,55 +1,114 @@
 import serial
 import time
+import timing
 
 # Note - pulled from: https://github.com/KULeuven-COSIC/SimpleLink-FI/blob/main/notebooks/5_ChipSHOUTER-PicoEMP.ipynb
+# Replies are read until the expected firmware string shows up instead of sleeping a fixed
+# amount, and the armed / HVP state is tracked so repeated arm() calls cost nothing.
 
 class ChipShouterPicoEMP:
-    def __init__(self, port='/dev/ttyACM0'):
-        self.pico = serial.Serial(port, 115200)
+    def __init__(self, port='/dev/ttyACM0', reply_timeout=2.0):
+        # Short read timeout, this is only the polling granularity for read_until
+        self.pico = serial.Serial(port, 115200, timeout=0.01)
+        # Deadline for any single command reply
+        self.reply_timeout = reply_timeout
+        self.armed = False
+        self.external_hvp_active = False
+        self.timeout_disabled = False
+        self._arm_pending = False
         self.pico.write(b'\r\n')
-        time.sleep(0.1)
-        ret = self.pico.read(self.pico.in_waiting)
+        ret = self.read_until(b'PicoEMP Commands', 1.0)
         if b'PicoEMP Commands' in ret:
             print('Connected to ChipSHOUTER PicoEMP!')
         else:
             raise OSError('Could not connect to ChipShouter PicoEMP :(')
 
+    '''
+    Read until expect has been received or the deadline passes, whatever was read is returned
+    With expect=None, read until the device has been quiet for idle seconds
+    '''
+    def read_until(self, expect, timeout=None, idle=0.05):
+        deadline = time.monotonic() + (timeout or self.reply_timeout)
+        buf = b''
+        last_rx = time.monotonic()
+        while time.monotonic() < deadline:
+            chunk = self.pico.read(max(1, self.pico.in_waiting))
+            if chunk:
+                buf += chunk
+                last_rx = time.monotonic()
+                if expect is not None and expect in buf:
+                    break
+            elif expect is None and buf and time.monotonic() - last_rx >= idle:
+                break
+        return buf
+
+    @timing.timed('pico.command')
+    def command(self, cmd, expect, timeout=None):
+        # Drop anything stale so an old reply can't satisfy this one
+        self.pico.reset_input_buffer()
+        self.pico.write(cmd + b'\r\n')
+        ret = self.read_until(expect, timeout)
+        if expect is not None and expect not in ret:
+            raise OSError(f"PicoEMP did not answer {cmd.decode()}: {ret}")
+        return ret
+
     def disable_timeout(self):
-        self.pico.write(b'disable_timeout\r\n')
-        time.sleep(1)
-        assert b'Timeout disabled!' in self.pico.read(self.pico.in_waiting)
-        
-    def arm(self):
+        self.command(b'disable_timeout', b'Timeout disabled!')
+        self.timeout_disabled = True
+
+    '''
+    Arm the device, this is a no-op if it is already armed unless force is set
+    If the firmware may have dropped the armed state (timeout, reset), use force=True
+    '''
+    @timing.timed('pico.arm')
+    def arm(self, force=False):
+        self.arm_async(force)
+        self.wait_armed()
+
+    '''
+    Send the arm command without waiting for the reply, so it can overlap with the
+    scope and printer setup. Call wait_armed() before the glitch is fired.
+    '''
+    def arm_async(self, force=False):
+        if (self.armed and not force) or self._arm_pending:
+            return
+        self.pico.reset_input_buffer()
         self.pico.write(b'arm\r\n')
-        time.sleep(1)
-        assert b'Device armed' in self.pico.read(self.pico.in_waiting)
-        
+        self._arm_pending = True
+
+    @timing.timed('pico.wait_armed')
+    def wait_armed(self, timeout=None):
+        if not self._arm_pending:
+            return
+        self._arm_pending = False
+        ret = self.read_until(b'Device armed', timeout)
+        if b'Device armed' not in ret:
+            self.armed = False
+            raise OSError(f"PicoEMP did not arm: {ret}")
+        self.armed = True
+
     def disarm(self):
-        self.pico.write(b'disarm\r\n')
-        time.sleep(1)
-        assert b'Device disarmed!' in self.pico.read(self.pico.in_waiting)
-        
+        self.wait_armed()
+        self.command(b'disarm', b'Device disarmed!')
+        self.armed = False
+
     def external_hvp(self):
-        self.pico.write(b'external_hvp\r\n')
-        time.sleep(1)
-        assert b'External HVP mode active' in self.pico.read(self.pico.in_waiting)
+        self.command(b'external_hvp', b'External HVP mode active')
+        self.external_hvp_active = True
 
     def fast_trigger(self):
-        self.pico.write(b'fast_trigger\r\n')
-        time.sleep(.5)
-        
+        self.command(b'fast_trigger', None)
+
     def print_status(self):
-        self.pico.write(b'status\r\n')
-        time.sleep(1)
-        print(self.pico.read(self.pico.in_waiting).decode('utf-8'))
-    
+        print(self.command(b'status', None).decode('utf-8'))
+
     def setup_external_control(self):
-        self.disable_timeout()
-        self.external_hvp()
+        if not self.timeout_disabled:
+            self.disable_timeout()
+        if not self.external_hvp_active:
+            self.external_hvp()
         self.print_status()
 
 def wait_for_hv():
     while scope.io.tio_states[2] != 0:
         time.sleep(0.1)
-
-
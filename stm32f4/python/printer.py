@@ -0,0 +1,66 @@
+import serial
+import time
+import timing
+
+'''
+G-code driver for the 3D printer gantry that carries the EM probe
+
+Every line is confirmed by the firmware's "ok" before the next one goes out, and
+moves can wait for the motion to actually finish (M400) instead of just being queued.
+The last commanded position is tracked so moves to where the head already is are skipped.
+'''
+
+class GCodePrinter:
+    def __init__(self, port, baud_rate=115200, timeout=1, ok_timeout=30):
+        self.ser = serial.Serial(port, baud_rate, timeout=timeout)
+        # Longest we wait for an "ok", M400 only answers once the move is done
+        self.ok_timeout = ok_timeout
+        self.position = [None, None, None]
+        # Drop the boot banner and anything left over from an earlier session
+        self.ser.reset_input_buffer()
+
+    def send(self, line, timeout=None):
+        self.ser.write(line.encode() + b'\r\n')
+        deadline = time.monotonic() + (timeout or self.ok_timeout)
+        replies = []
+        while time.monotonic() < deadline:
+            reply = self.ser.readline()
+            if not reply:
+                continue
+            if reply.startswith(b'ok'):
+                return replies
+            if reply.startswith(b'Error') or reply.startswith(b'!!'):
+                raise OSError(f"Printer rejected {line}: {reply}")
+            # busy: processing, echo: etc
+            replies.append(reply)
+        raise OSError(f"Printer did not acknowledge {line}")
+
+    @timing.timed('printer.wait_for_moves')
+    def wait_for_moves(self):
+        self.send('M400')
+
+    def at(self, x=None, y=None, z=None):
+        for axis, value in enumerate((x, y, z)):
+            if value is not None and (self.position[axis] is None or abs(self.position[axis] - value) > 1e-6):
+                return False
+        return True
+
+    '''
+    Move to (x, y, z), axes left as None keep their position
+    Returns False without sending anything when the head is already there
+    '''
+    @timing.timed('printer.move')
+    def move(self, x=None, y=None, z=None, wait=True):
+        if self.at(x, y, z):
+            return False
+        words = [f"{axis}{value}" for axis, value in zip('XYZ', (x, y, z)) if value is not None]
+        self.send('G0 ' + ' '.join(words))
+        for axis, value in enumerate((x, y, z)):
+            if value is not None:
+                self.position[axis] = value
+        if wait:
+            self.wait_for_moves()
+        return True
+
+    def close(self):
+        self.ser.close()
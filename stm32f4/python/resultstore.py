@@ -0,0 +1,149 @@
+import os
+import struct
+import time
+import numpy as np
+import analysis
+
+'''
+Append only attempt store
+
+Every glitch attempt is written as one fixed width little endian record behind a small
+header, so the file can be opened with np.memmap and used as a structured array without
+parsing or copying. Field names match analysis.GLITCH_DTYPE so stats.campaign_stats
+works on a loaded store directly.
+
+Records are appended with a single os.write on an O_APPEND descriptor, a crash can only
+ever leave a partial record at the very end, which is dropped the next time the store
+is opened.
+'''
+
+STORE_MAGIC = b'GLST'
+STORE_VERSION = 1
+# magic, version, record size, header size
+STORE_HEADER = struct.Struct('<4sHHI')
+HEADER_SIZE = 16
+
+# Campaign phases
+PHASE_RDP2 = 0
+PHASE_RDP1 = 1
+
+# Attempt that ran but had no visible effect, GLITCH_RESULTS[3]
+RESULT_NORMAL = 3
+# No sign of life in the power trace (crashed or held in reset), GLITCH_RESULTS[4]
+RESULT_MUTE = 4
+
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+    ('z', '<f8'),
+    ('offset', '<i4'),
+    ('tries', '<u2'),
+    ('phase', 'u1'),
+    ('result', 'u1'),
+])
+RECORD = struct.Struct('<ddddiHBB')
+assert RECORD.size == RECORD_DTYPE.itemsize
+
+
+class ResultStore:
+    def __init__(self, path, sync_every=0):
+        self.path = path
+        # fsync after this many records, 0 leaves it to the OS
+        self.sync_every = sync_every
+        self._pending = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            os.write(self.fd, STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, RECORD.size, HEADER_SIZE).ljust(HEADER_SIZE, b'\0'))
+            os.fsync(self.fd)
+            size = HEADER_SIZE
+        else:
+            check_header(os.pread(self.fd, HEADER_SIZE, 0), path)
+        # Drop a torn record left behind by a crash mid write
+        torn = (size - HEADER_SIZE) % RECORD.size
+        if torn:
+            os.ftruncate(self.fd, size - torn)
+        self.count = (size - torn - HEADER_SIZE) // RECORD.size
+
+    def append(self, offset, x=0.0, y=0.0, z=0.0, tries=0, phase=PHASE_RDP2, result=RESULT_NORMAL, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        os.write(self.fd, RECORD.pack(timestamp, x, y, z, offset, tries, phase, result))
+        self.count += 1
+        if self.sync_every:
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self.sync()
+
+    def extend(self, records):
+        records = np.asarray(records, dtype=RECORD_DTYPE)
+        os.write(self.fd, records.tobytes())
+        self.count += len(records)
+
+    def sync(self):
+        os.fsync(self.fd)
+        self._pending = 0
+
+    def close(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def check_header(header, path):
+    magic, version, record_size, header_size = STORE_HEADER.unpack_from(header)
+    if magic != STORE_MAGIC or header_size != HEADER_SIZE:
+        raise ValueError(f"{path} is not a glitch result store")
+    if version != STORE_VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path} has unsupported store version {version} (record size {record_size})")
+
+'''
+Memory map a store as a read only structured array, no records are copied
+Records appended after this call are not visible, call it again to pick them up
+'''
+def load(path):
+    with open(path, 'rb') as infile:
+        check_header(infile.read(HEADER_SIZE), path)
+        size = os.fstat(infile.fileno()).st_size
+    count = (size - HEADER_SIZE) // RECORD.size
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+'''
+Convert a text glitch log (see analysis.parse_results_array) into a store
+'''
+def import_log(log_path, store_path, phase=PHASE_RDP2):
+    with ResultStore(store_path) as store:
+        for rows in analysis.iter_results(log_path):
+            records = np.zeros(len(rows), dtype=RECORD_DTYPE)
+            for name in analysis.GLITCH_DTYPE.names:
+                records[name] = rows[name]
+            records['phase'] = phase
+            store.extend(records)
+        return len(store)
+
+
+if __name__ == "__main__":
+    import sys
+    import stats
+    if sys.argv[1].endswith('.glitchstore'):
+        records = load(sys.argv[1])
+    else:
+        store_path = os.path.splitext(sys.argv[1])[0] + '.glitchstore'
+        if not os.path.exists(store_path):
+            import_log(sys.argv[1], store_path)
+        records = load(store_path)
+    print(f"{len(records)} attempts")
+    print(stats.result_counts(records))
@@ -0,0 +1,243 @@
+import time
+import numpy as np
+import stm32bl
+from stm32bl import send_command, BootloaderCommand, read_memory
+from picoemp import ChipShouterPicoEMP
+from printer import GCodePrinter
+from campaign import Campaign
+from resultstore import RESULT_NORMAL
+import timing
+
+'''
+One glitching rig: a Husky, a PicoEMP, a printer gantry and the target's bootloader UART
+
+The scope helpers used to live in stm32f4-3d.py and talk to a module level scope, they
+take the scope explicitly now so several rigs (or a simulated one) can share the code.
+Device paths come from a config dict instead of being fixed at import time.
+'''
+
+DEFAULT_RIG = {
+    'name': 'rig0',
+    # Husky serial number, None picks the only one connected
+    'scope_sn': None,
+    'pico': "/dev/serial/by-id/usb-Raspberry_Pi_Pico_E661640843604326-if00",
+    'printer': "/dev/serial/by-id/usb-1a86_USB_Serial-if00-port0",
+    'uart': stm32bl.port,
+    'z': 20.8,
+    # Time for the target to come out of reset before the bootloader is probed
+    'boot_wait': .3,
+}
+
+def hotspot_probability(named, center, width, peak):
+    # Gaussian success probability around center, parameters missing from named are ignored
+    exponent = sum(((named[p] - c) / width[p]) ** 2 for p, c in center.items() if p in named)
+    return peak * np.exp(-exponent)
+
+@timing.timed()
+def detect_bootloader(attempts=1):
+    response = send_command(BootloaderCommand(0x7F))
+    while response != b'\x79':
+        response = send_command(BootloaderCommand(0x7F))
+        attempts -= 1
+        if attempts == 0:
+            return False
+    return True
+
+@timing.timed()
+def reboot_flush(scope):            
+    scope.io.target_pwr = False
+    time.sleep(.1)
+    scope.arm()
+    scope.io.target_pwr = True
+
+
+@timing.timed()
+def configure_reset_trigger(scope):
+    scope.reset_fpga()
+    scope.default_setup()
+    time.sleep(.1)
+    scope.glitch.enabled = True   
+    try:
+        scope.clock.clkgen_freq = 30e6
+        scope.glitch.clk_src = "pll"
+    except ValueError as noresp:
+        pass
+    while not scope.glitch.mmcm_locked:
+        scope.reset_fpga()
+        scope.default_setup()
+        scope.glitch.resetDCMs(keepPhase=False)
+        scope.glitch.enabled = True   
+        try:
+            scope.clock.clkgen_freq = 30e6
+            scope.glitch.clk_src = "pll"
+        except ValueError as asinine:
+            pass
+        time.sleep(.1)
+        pass
+    scope.trigger.triggers = "tio4"
+    scope.glitch.trigger_src = "ext_single" # glitch only after scope.arm() called
+    scope.glitch.output = "enable_only" # glitch_out = clk ^ glitch
+    scope.glitch.repeat = 500
+    scope.glitch.width = 40
+    scope.glitch.offset = -45
+    scope.io.glitch_trig_mcx = 'glitch'
+    scope.io.hs2 = "glitch"
+
+
+@timing.timed()
+def configure_edge_trigger(scope):
+    #scope.reset_fpga()
+    #scope.default_setup()
+    time.sleep(.1)
+    scope.glitch.enabled = True
+    try:
+        scope.clock.clkgen_freq = 30e6
+        scope.glitch.clk_src = "pll"
+    except ValueError as noresp:
+        pass
+    while not scope.glitch.mmcm_locked:
+        #scope.reset_fpga()
+        #scope.default_setup()
+        scope.glitch.resetDCMs(keepPhase=False)
+        scope.glitch.enabled = True   
+        try:
+            scope.clock.clkgen_freq = 30e6
+            scope.glitch.clk_src = "pll"
+        except ValueError as asinine:
+            pass
+        time.sleep(.1)
+        pass
+    scope.trigger.module = 'edge_counter'
+    scope.trigger.triggers = "tio1"
+    scope.trigger.edges = 11
+    scope.io.glitch_trig_mcx = 'glitch'
+    scope.glitch.trigger_src = "ext_single" # glitch only after scope.arm() called
+    scope.glitch.output = "enable_only" # glitch_out = clk ^ glitch
+    scope.glitch.repeat = 500
+    scope.glitch.width = 40
+    scope.glitch.offset = -45
+    scope.io.hs2 = "glitch"
+
+
+@timing.timed()
+def soft_reset(scope):
+    scope.io.nrst = False  
+    time.sleep(.05)
+    scope.io.nrst = 'high_z'
+
+
+class HardwareRig:
+    '''
+    scope can be passed in instead of connecting to a Husky (eg simulator.MockScope)
+    '''
+    def __init__(self, config, scope=None):
+        self.config = dict(DEFAULT_RIG, **config)
+        self.name = self.config['name']
+        if scope is not None:
+            self.scope = scope
+        elif self.config['scope_sn']:
+            import chipwhisperer as cw
+            self.scope = cw.scope(sn=self.config['scope_sn'])
+        else:
+            import chipwhisperer as cw
+            self.scope = cw.scope()
+        self.scope.adc.lo_gain_errors_disabled = True
+        self.scope.adc.clip_errors_disabled = True
+        stm32bl.connect(self.config['uart'])
+        self.pico = ChipShouterPicoEMP(self.config['pico'])
+        self.pico.setup_external_control()
+        self.printer = GCodePrinter(self.config['printer'], timeout=1)
+        self.campaign = Campaign(self.printer, self.pico)
+        configure_reset_trigger(self.scope)
+
+    def _prepare(self, named):
+        self.scope.glitch.ext_offset = named['ext_offset']
+        self.scope.io.glitch_hp = False
+        self.scope.io.glitch_hp = True
+        self.scope.io.glitch_lp = False
+        self.scope.io.glitch_lp = True
+
+    def _probe(self, named):
+        time.sleep(self.config['boot_wait'])
+        return detect_bootloader(attempts=2)
+
+    '''
+    Run RDP2 style attempts (power cycle glitch, bootloader probe) for a list of named settings
+    Returns a result code per attempt
+    '''
+    def run(self, settings):
+        results = []
+        z = self.config['z']
+        self.campaign.run(settings,
+                          position=lambda named: (named.get('x'), named.get('y'), named.get('z', z)),
+                          prepare=self._prepare,
+                          fire=lambda named: reboot_flush(self.scope),
+                          probe=self._probe,
+                          on_result=lambda named, found, trace: results.append(0 if found else RESULT_NORMAL))
+        return results
+
+    def _read_prepare(self, named):
+        soft_reset(self.scope)
+        self.in_bootloader = detect_bootloader(attempts=2)
+        self._prepare(named)
+
+    def _read_probe(self, named, address, size):
+        # Lost the bootloader in the reset, there is nothing to read until RDP2 is bypassed again
+        if not self.in_bootloader:
+            return None
+        return read_memory(address, size - 1, self.scope)
+
+    '''
+    Run RDP1 style attempts (edge triggered glitch on the read command) until a page is read
+    Returns the result codes and the page, or None if it wasn't read. Also stops when the target
+    drops out of the bootloader, self.in_bootloader tells the two apart
+    '''
+    def read_page(self, settings, address, size=0x100):
+        results = []
+        page = []
+        def on_result(named, data, trace):
+            if data is not None and len(data) == size:
+                page.append(data)
+            results.append(2 if page else RESULT_NORMAL)
+            return bool(page) or not self.in_bootloader
+        self.in_bootloader = True
+        self.campaign.run(settings,
+                          position=lambda named: (None, None, named.get('z', self.config['z'])),
+                          prepare=self._read_prepare,
+                          fire=lambda named: self.scope.arm(),
+                          probe=lambda named: self._read_probe(named, address, size),
+                          capture=lambda named: self.scope.capture(),
+                          on_result=on_result)
+        return results, page[0] if page else None
+
+    def close(self):
+        self.campaign.close()
+        self.printer.close()
+
+
+class SimRig:
+    '''
+    Stand in rig for scheduler tests: each attempt takes attempt_time seconds and succeeds
+    with a Gaussian hotspot probability around center (ext_offset, x, y)
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.name = config.get('name', 'sim')
+        self.attempt_time = config.get('attempt_time', 0.01)
+        self.center = config.get('center', {'ext_offset': 7800, 'x': 183.9, 'y': 86.7})
+        self.width = config.get('width', {'ext_offset': 15.0, 'x': 0.15, 'y': 0.15})
+        self.peak = config.get('peak', 0.3)
+        self.rng = np.random.default_rng(config.get('seed'))
+
+    def probability(self, named):
+        return hotspot_probability(named, self.center, self.width, self.peak)
+
+    def run(self, settings):
+        results = []
+        for named in settings:
+            time.sleep(self.attempt_time)
+            results.append(0 if self.rng.random() < self.probability(named) else RESULT_NORMAL)
+        return results
+
+    def close(self):
+        pass
@@ -0,0 +1,133 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from cwproject import open_project
+
+'''
+SAD reference window finder
+
+The Husky SAD trigger compares the last 32 ADC samples (top 8 bits of the 12 bit code)
+against scope.SAD.reference and fires when the sum of absolute differences drops below
+scope.SAD.threshold. A good reference is a stretch of the boot trace that matches itself
+(in every recorded boot) well below the threshold, and nothing else in the trace comes
+close, so the trigger fires once per boot and in the same place.
+
+Candidate windows are picked where the trace is busiest (flat stretches match everywhere),
+the SAD of each candidate against every position of every trace is computed with a sliding
+window view in batches, and candidates are ranked by the margin between their worst self
+match and their best match anywhere else. The recommended threshold sits in the middle.
+
+    python sadfind.py ../traces/stm32f4-traces-vcap.cwp [top]
+'''
+
+SAD_LENGTH = 32
+RESULT_DTYPE = np.dtype([
+    ('offset', '<i8'),
+    ('threshold', '<i4'),
+    ('margin', '<i4'),
+    ('self_sad', '<i4'),
+    ('other_sad', '<i4'),
+    ('fires', '<i4'),
+])
+
+def sad_samples(traces):
+    # What the SAD block sees: the top 8 bits of the 12 bit ADC code, traces are code / 4096 - 0.5
+    codes = np.round((np.asarray(traces, dtype=np.float64) + 0.5) * 4096)
+    return (np.clip(codes, 0, 4095).astype(np.int16) >> 4)
+
+'''
+SAD of every reference against every window of every trace, shape (references, traces, positions)
+Position i is the window starting at sample i. batch bounds the size of the intermediate array
+'''
+def sliding_sad(samples, references, batch=1 << 24):
+    samples = np.atleast_2d(samples)
+    references = np.atleast_2d(references).astype(np.int16)
+    windows = sliding_window_view(samples, SAD_LENGTH, axis=1)
+    out = np.empty((len(references), len(samples), windows.shape[1]), dtype=np.int32)
+    step = max(1, batch // (windows.shape[1] * SAD_LENGTH))
+    for trace in range(len(samples)):
+        for start in range(0, len(references), step):
+            refs = references[start:start + step]
+            out[start:start + step, trace] = np.abs(windows[trace][None] - refs[:, None]).sum(axis=2)
+    return out
+
+'''
+The count busiest windows of a trace, at most one per spacing samples
+'''
+def candidate_windows(samples, count=256, spacing=64):
+    activity = np.abs(np.diff(samples.astype(np.int32)))
+    csum = np.concatenate([[0], np.cumsum(activity)])
+    score = csum[SAD_LENGTH - 1:] - csum[:len(csum) - SAD_LENGTH + 1]
+    blocks = len(score) // spacing
+    best = score[:blocks * spacing].reshape(blocks, spacing).argmax(axis=1) + np.arange(blocks) * spacing
+    best = best[np.argsort(score[best])[::-1][:count]]
+    return np.sort(best)
+
+def _runs(below, exclusion):
+    # Separate groups of positions below the threshold, matches closer than exclusion are one event
+    hits = np.flatnonzero(below)
+    if len(hits) == 0:
+        return hits
+    return hits[np.concatenate([[True], np.diff(hits) > exclusion])]
+
+'''
+Rank reference windows taken from traces[reference], every trace is treated as another boot
+
+search is how far (in samples) the same event may wander between boots, exclusion is how
+close to its own match a window still counts as that match. Returns RESULT_DTYPE rows,
+best margin first, only windows whose recommended threshold fires once in every trace.
+'''
+def find_windows(traces, reference=0, count=256, spacing=64, search=2000, exclusion=SAD_LENGTH, min_margin=8):
+    samples = sad_samples(traces)
+    samples = np.atleast_2d(samples)
+    offsets = candidate_windows(samples[reference], count, spacing)
+    references = sliding_window_view(samples[reference], SAD_LENGTH)[offsets]
+    sad = sliding_sad(samples, references)
+    positions = np.arange(sad.shape[2])
+
+    # Best match near the candidate's own position in every trace
+    near = np.abs(positions[None, :] - offsets[:, None]) <= search
+    near_sad = np.where(near[:, None, :], sad, np.iinfo(np.int32).max)
+    match = near_sad.argmin(axis=2)
+    self_sad = near_sad.min(axis=2).max(axis=1)
+    # Best match anywhere else
+    away = np.abs(positions[None, None, :] - match[:, :, None]) > exclusion
+    other_sad = np.where(away, sad, np.iinfo(np.int32).max).min(axis=2).min(axis=1)
+
+    margin = other_sad - self_sad
+    threshold = self_sad + np.maximum(margin // 2, 1)
+    fires = np.array([max(len(_runs(sad[i, t] < threshold[i], exclusion)) for t in range(len(samples)))
+                      for i in range(len(offsets))])
+
+    result = np.zeros(len(offsets), dtype=RESULT_DTYPE)
+    result['offset'] = offsets
+    result['threshold'] = threshold
+    result['margin'] = margin
+    result['self_sad'] = self_sad
+    result['other_sad'] = other_sad
+    result['fires'] = fires
+    result = result[(margin >= min_margin) & (fires == 1)]
+    return result[np.argsort(-result['margin'], kind='stable')]
+
+'''
+How a given reference / threshold pair behaves on the traces, eg the one hard coded in the notebook
+'''
+def check_window(traces, offset, threshold, reference=0, exclusion=SAD_LENGTH):
+    samples = np.atleast_2d(sad_samples(traces))
+    sad = sliding_sad(samples, samples[reference, offset:offset + SAD_LENGTH])[0]
+    return [(_runs(row < threshold, exclusion) + SAD_LENGTH - 1).tolist() for row in sad]
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    path = sys.argv[1] if len(sys.argv) > 1 else "../traces/stm32f4-traces-vcap.cwp"
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    traces = open_project(path).traces
+    start = time.perf_counter()
+    result = find_windows(traces)
+    print(f"{len(result)} usable windows in {time.perf_counter() - start:.1f}s, best {top}:")
+    for row in result[:top]:
+        print(f"  trace_offset = {row['offset']:6d}  threshold = {row['threshold']:4d}  "
+              f"(self {row['self_sad']}, nearest other {row['other_sad']}, margin {row['margin']})")
+    # The notebook's reference, where it fires (sample index of the trigger) in every trace
+    print(f"Notebook trace_offset 39900 threshold 60 fires at {check_window(traces, 39900, 60)}")
@@ -0,0 +1,108 @@
+import warnings
+import numpy as np
+from sadfind import SAD_LENGTH, sad_samples, sliding_sad
+from cwproject import open_project
+
+'''
+Offline SAD trigger replay
+
+Replays what the Husky SAD trigger would have done on recorded boots for a whole range of
+scope.SAD.threshold values in one pass. The trigger fires on the first sample where the SAD
+of the last 32 samples against the reference is below the threshold, one trigger per arm.
+
+For every trace the SAD profile is computed once, then for all thresholds at once:
+- the first trigger position comes from a running minimum of the profile (searchsorted)
+- the number of separate crossings comes from a difference array over threshold values,
+  a dip from SAD a to b (b < a) crosses every threshold in (b, a]
+Traces are read in chunks from the memory mapped project (cwproject.py), so the corpus can
+be larger than RAM.
+
+A trigger is a hit when it lands within tolerance of where the reference matches that boot
+best, early is a trigger anywhere else before that (a false trigger), missed means the
+threshold never fired. jitter is the spread of hit positions across boots.
+
+    python sadsim.py ../traces/stm32f4-traces-vcap.cwp 39900 [max_threshold]
+'''
+
+def replay(traces, reference, thresholds=None, tolerance=SAD_LENGTH, chunk=64):
+    reference = np.asarray(reference)
+    if reference.dtype.kind == 'f':
+        reference = sad_samples(reference)
+    if thresholds is None:
+        thresholds = np.arange(1, 256)
+    thresholds = np.asarray(thresholds, dtype=np.int64)
+    top = int(thresholds.max()) + 2
+
+    n = len(traces)
+    position = np.full((n, len(thresholds)), -1, dtype=np.int64)
+    crossings = np.zeros((n, len(thresholds)), dtype=np.int64)
+    event = np.zeros(n, dtype=np.int64)
+    for start in range(0, n, chunk):
+        samples = sad_samples(traces[start:start + chunk])
+        sad = sliding_sad(samples, reference)[0]
+        for row, profile in enumerate(sad, start):
+            event[row] = profile.argmin()
+            # First position below each threshold, the running minimum only ever goes down
+            running = np.minimum.accumulate(profile)
+            first = np.searchsorted(-running, -thresholds, side='right')
+            position[row] = np.where(first < len(profile), first, -1)
+            # Dips from the previous sample, position 0 dips from infinity
+            prev = np.concatenate([[top], np.minimum(profile[:-1], top)])
+            low = np.minimum(profile, top)
+            dips = low < prev
+            counts = (np.bincount(low[dips] + 1, minlength=top + 2)
+                      - np.bincount(prev[dips] + 1, minlength=top + 2))
+            crossings[row] = np.cumsum(counts)[thresholds]
+
+    fired = position >= 0
+    hit = fired & (np.abs(position - event[:, None]) <= tolerance)
+    early = fired & ~hit
+    with warnings.catch_warnings():
+        # Thresholds with no hits at all get a nan jitter
+        warnings.simplefilter('ignore', RuntimeWarning)
+        jitter = np.nanstd(np.where(hit, position, np.nan), axis=0)
+    return {
+        'thresholds': thresholds,
+        # Sample where the trigger fires, the last sample of the matching window
+        'position': np.where(fired, position + SAD_LENGTH - 1, -1),
+        'hits': hit.sum(axis=0),
+        'early': early.sum(axis=0),
+        'missed': (~fired).sum(axis=0),
+        'crossings': crossings,
+        # Crossings past the first one, what a re-armed or free running trigger would also see
+        'extra': np.maximum(crossings - 1, 0).sum(axis=0),
+        'jitter': jitter,
+    }
+
+'''
+Middle of the widest run of thresholds that hit on every trace with no false triggers
+Returns None if there is no such threshold
+'''
+def best_threshold(report, clean_extra=True):
+    good = (report['hits'] == len(report['position'])) & (report['early'] == 0)
+    if clean_extra:
+        good &= report['extra'] == 0
+    if not good.any():
+        return None
+    edges = np.diff(np.concatenate([[0], good.astype(np.int8), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    widest = np.argmax(ends - starts)
+    return int(report['thresholds'][(starts[widest] + ends[widest] - 1) // 2])
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    path = sys.argv[1] if len(sys.argv) > 1 else "../traces/stm32f4-traces-vcap.cwp"
+    offset = int(sys.argv[2]) if len(sys.argv) > 2 else 39900
+    max_threshold = int(sys.argv[3]) if len(sys.argv) > 3 else 512
+    traces = open_project(path).traces
+    reference = sad_samples(traces[0, offset:offset + SAD_LENGTH])
+    start = time.perf_counter()
+    report = replay(traces, reference, np.arange(1, max_threshold + 1))
+    elapsed = time.perf_counter() - start
+    print(f"{len(traces)} traces x {max_threshold} thresholds in {elapsed:.2f}s")
+    for i in np.linspace(0, max_threshold - 1, 17).astype(int):
+        print(f"  threshold {report['thresholds'][i]:4d}: hits {report['hits'][i]} early {report['early'][i]} "
+              f"missed {report['missed'][i]} extra {report['extra'][i]} jitter {report['jitter'][i]:.1f}")
+    print(f"Recommended threshold: {best_threshold(report)}")
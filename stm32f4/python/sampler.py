@@ -0,0 +1,235 @@
+import itertools
+import numpy as np
+import analysis
+
+'''
+Adaptive hotspot seeking search
+
+Instead of sweeping the whole grid, every cell of the (ext_offset, x, y, z) grid gets a
+Beta belief built from its own and its neighbours' successes and failures, so one attempt
+teaches the sampler about the cells around it too. Each attempt draws a sample from every cell's
+belief and glitches the best one (Thompson sampling), with a small share of uniformly
+random picks on top so cold regions still get explored. Beliefs are seeded from earlier
+campaigns and updated after every attempt.
+
+AdaptiveSampler.glitch_values() yields settings in GlitchController parameter order,
+call update() with each result before asking for the next one.
+'''
+
+# Grid parameter -> column name in analysis.GLITCH_DTYPE / resultstore records
+RECORD_FIELDS = {'ext_offset': 'offset', 'x': 'x', 'y': 'y', 'z': 'z'}
+
+'''
+Load an "offset,code" file such as logs/bootloader-offsets.txt, every line is a success
+'''
+def load_offsets(path):
+    data = np.loadtxt(path, delimiter=',', dtype=np.int64, ndmin=2)
+    records = np.zeros(len(data), dtype=analysis.GLITCH_DTYPE)
+    records['offset'] = data[:, 0]
+    return records
+
+def nearest_index(grid, values):
+    # Index of the closest grid value, -1 when the value is more than half a step outside the grid
+    grid = np.asarray(grid, dtype=np.float64)
+    order = np.argsort(grid)
+    sorted_grid = grid[order]
+    pos = np.clip(np.searchsorted(sorted_grid, values), 1, max(len(grid) - 1, 1))
+    left = sorted_grid[pos - 1]
+    right = sorted_grid[np.minimum(pos, len(grid) - 1)]
+    pick = np.where(np.abs(values - left) <= np.abs(values - right), pos - 1, pos)
+    pick = np.minimum(pick, len(grid) - 1)
+    step = np.min(np.diff(sorted_grid)) if len(grid) > 1 else 1.0
+    outside = np.abs(sorted_grid[pick] - values) > step / 2 + 1e-9
+    return np.where(outside, -1, order[pick])
+
+def kernel(passes):
+    # Binomial kernel, the same as passes rounds of [1/4, 1/2, 1/4]
+    k = np.ones(1)
+    for _ in range(passes):
+        k = np.convolve(k, [0.25, 0.5, 0.25])
+    return k
+
+def smooth(counts, passes=1):
+    # Spread counts to neighbouring cells along every axis, mass past the grid edge is dropped
+    k = kernel(passes)
+    half = len(k) // 2
+    for axis in range(counts.ndim):
+        # mode='same' gives len(k) values on an axis shorter than the kernel, crop 'full' instead
+        full = np.apply_along_axis(np.convolve, axis, counts, k, mode='full')
+        counts = np.take(full, np.arange(half, half + counts.shape[axis]), axis=axis)
+    return counts
+
+
+class AdaptiveSampler:
+    def __init__(self, parameters, values, explore=0.05, smoothing=2, strength=2.0, success=analysis.SUCCESS_RESULTS, seed=None):
+        self.parameters = list(parameters)
+        self.values = {name: list(values[name]) for name in self.parameters}
+        # tries is just a repeat counter, it isn't a search dimension
+        self.axes = [p for p in self.parameters if p != 'tries']
+        self.shape = tuple(len(self.values[p]) for p in self.axes)
+        # Raw per cell counts, neighbouring cells share them through smooth() when sampling
+        self.hits = np.zeros(self.shape)
+        self.misses = np.zeros(self.shape)
+        self.explore = explore
+        self.smoothing = smoothing
+        # Pseudo counts of the prior, its mean tracks the overall success rate
+        self.strength = strength
+        self.success = success
+        self.rng = np.random.default_rng(seed)
+        self.attempts = 0
+        self.successes = 0
+        self._lookup = [{v: i for i, v in enumerate(self.values[p])} for p in self.axes]
+        # Smoothed counts are kept up to date by stamping the kernel around every update
+        self.kernel = kernel(smoothing)
+        self.smooth_hits = np.zeros(self.shape)
+        self.smooth_misses = np.zeros(self.shape)
+
+    @classmethod
+    def from_glitch_controller(cls, gc, **kwargs):
+        seen = [dict() for _ in gc.parameters]
+        for setting in gc.glitch_values():
+            for column, value in zip(seen, setting):
+                column.setdefault(value, None)
+        return cls(gc.parameters, {name: list(column) for name, column in zip(gc.parameters, seen)}, **kwargs)
+
+    '''
+    Seed the beliefs from earlier results (parse_results_array, resultstore.load, load_offsets)
+
+    axes picks the grid parameters the records carry, by default every grid parameter with a
+    matching column. Axes the records don't cover are spread evenly, so an offsets-only file
+    boosts those offsets at every position. weight is the pseudo count per record.
+    '''
+    def seed(self, records, axes=None, weight=1.0):
+        if axes is None:
+            axes = [p for p in self.axes if RECORD_FIELDS.get(p) in records.dtype.names]
+        if not axes or len(records) == 0:
+            return
+        index = np.stack([nearest_index(self.values[p], records[RECORD_FIELDS[p]]) for p in axes])
+        inside = (index >= 0).all(axis=0)
+        is_success = np.isin(records['result'], self.success)
+
+        sub_shape = tuple(len(self.values[p]) for p in axes)
+        hits = np.zeros(sub_shape)
+        misses = np.zeros(sub_shape)
+        np.add.at(hits, tuple(index[:, inside & is_success]), weight)
+        np.add.at(misses, tuple(index[:, inside & ~is_success]), weight)
+
+        # Broadcast over the axes the records don't have, sharing the counts out evenly
+        spread = int(np.prod([n for p, n in zip(self.axes, self.shape) if p not in axes]))
+        order = [axes.index(p) if p in axes else None for p in self.axes]
+        view = tuple(slice(None) if o is not None else np.newaxis for o in order)
+        perm = [o for o in order if o is not None]
+        hits = np.broadcast_to(np.transpose(hits, perm)[view] / spread, self.shape)
+        misses = np.broadcast_to(np.transpose(misses, perm)[view] / spread, self.shape)
+        self.hits += hits
+        self.misses += misses
+        self.smooth_hits += smooth(hits, self.smoothing)
+        self.smooth_misses += smooth(misses, self.smoothing)
+
+    def _cell(self, setting):
+        named = dict(zip(self.parameters, setting))
+        return tuple(lookup[named[p]] for p, lookup in zip(self.axes, self._lookup))
+
+    def _stamp(self, target, cell):
+        # Add the smoothing kernel centred on cell, clipped at the grid edges
+        half = len(self.kernel) // 2
+        region = []
+        weights = np.ones(())
+        for i, n in zip(cell, self.shape):
+            lo, hi = max(i - half, 0), min(i + half + 1, n)
+            region.append(slice(lo, hi))
+            weights = np.multiply.outer(weights, self.kernel[lo - i + half:hi - i + half])
+        target[tuple(region)] += weights
+
+    def update(self, setting, result):
+        cell = self._cell(setting)
+        # Campaign probes return a bool, stored records carry a result code
+        hit = bool(result) if isinstance(result, (bool, np.bool_)) else result in self.success
+        if hit:
+            self.hits[cell] += 1
+            self._stamp(self.smooth_hits, cell)
+            self.successes += 1
+        else:
+            self.misses[cell] += 1
+            self._stamp(self.smooth_misses, cell)
+        self.attempts += 1
+
+    def posterior(self):
+        hits = self.hits.sum()
+        mean = (hits + 1) / (hits + self.misses.sum() + 2)
+        return self.strength * mean + self.smooth_hits, self.strength * (1 - mean) + self.smooth_misses
+
+    def next_setting(self):
+        if self.rng.random() < self.explore:
+            flat = int(self.rng.integers(self.hits.size))
+        else:
+            # Normal approximation of the Beta draw, rng.beta is several times slower on big grids
+            alpha, beta = self.posterior()
+            total = alpha + beta
+            mean = alpha / total
+            std = np.sqrt(mean * (1 - mean) / (total + 1))
+            draw = mean + std * self.rng.standard_normal(self.shape, dtype=np.float32)
+            flat = int(np.argmax(draw))
+        cell = np.unravel_index(flat, self.shape)
+        named = {p: self.values[p][i] for p, i in zip(self.axes, cell)}
+        if 'tries' in self.parameters:
+            named['tries'] = self.values['tries'][0]
+        return tuple(named[p] for p in self.parameters)
+
+    '''
+    Yield settings until max_attempts, or until target successes have been reported via update()
+    '''
+    def glitch_values(self, max_attempts=None, target=None):
+        count = itertools.count() if max_attempts is None else range(max_attempts)
+        for _ in count:
+            if target is not None and self.successes >= target:
+                return
+            yield self.next_setting()
+
+    def success_rate(self):
+        # Posterior mean per cell, same shape as the grid
+        alpha, beta = self.posterior()
+        return alpha / (alpha + beta)
+
+
+if __name__ == "__main__":
+    # Compare against a full grid sweep on a synthetic hotspot around the christmas-presents cluster
+    import sys
+    rng = np.random.default_rng(1)
+    values = {
+        'ext_offset': list(range(7750, 7850)),
+        'x': [round(183.0 + 0.1 * i, 1) for i in range(21)],
+        'y': [round(86.0 + 0.1 * i, 1) for i in range(15)],
+        'tries': [1],
+    }
+    def hit(setting):
+        offset, x, y, _ = setting
+        p = 0.3 * np.exp(-((x - 183.9) / 0.15) ** 2 - ((y - 86.7) / 0.15) ** 2 - ((offset - 7800) / 15.0) ** 2)
+        return rng.random() < p
+    target = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    # Axes shorter than the kernel (the single position RDP2 grid), seeding smooths the same as update stamps
+    for n in range(1, 5):
+        small = {'ext_offset': list(range(7800, 7826)), 'x': [184.6 + 0.1 * i for i in range(n)], 'y': [86.8], 'tries': [1]}
+        seeded = AdaptiveSampler(list(small), small)
+        stamped = AdaptiveSampler(list(small), small)
+        records = np.zeros(1, dtype=analysis.GLITCH_DTYPE)
+        records['offset'], records['x'], records['y'] = 7810, small['x'][n // 2], 86.8
+        records['result'] = analysis.SUCCESS_RESULTS[0]
+        seeded.seed(records)
+        stamped.update((7810, small['x'][n // 2], 86.8, 1), True)
+        assert np.allclose(seeded.smooth_hits, stamped.smooth_hits), n
+
+    grid = list(itertools.product(*values.values()))
+    rng.shuffle(grid)
+    found = 0
+    for n, setting in enumerate(grid, 1):
+        found += hit(setting)
+        if found >= target:
+            break
+    print(f"Grid sweep: {n} attempts for {found} successes")
+
+    sampler = AdaptiveSampler(list(values), values, seed=2)
+    for setting in sampler.glitch_values(max_attempts=len(grid), target=target):
+        sampler.update(setting, hit(setting))
+    print(f"Adaptive: {sampler.attempts} attempts for {sampler.successes} successes")
@@ -0,0 +1,189 @@
+import itertools
+import numpy as np
+
+'''
+Travel optimized scan ordering
+
+GlitchController.glitch_values() walks itertools.product over its parameters in the order
+they were declared, with ext_offset first the head moves on nearly every attempt. A ScanPlan
+visits each (x, y, z) position once, runs every ext_offset / tries combination there and
+orders the positions to keep gantry travel short. glitch_values() yields tuples in the same
+parameter order as the GlitchController it replaces, so the campaign hooks don't change.
+'''
+
+POSITION_PARAMS = ('x', 'y', 'z')
+
+class GantryModel:
+    def __init__(self, speed=50.0, accel=500.0, settle=0.05):
+        # mm/s, mm/s^2 and seconds to let the head stop ringing after a move
+        self.speed = speed
+        self.accel = accel
+        self.settle = settle
+
+    '''
+    Time for a batch of moves, deltas is an (n, axes) array of per axis distances
+    Each axis follows a trapezoid (or triangle) profile, the slowest axis sets the move time
+    '''
+    def move_time(self, deltas):
+        d = np.abs(np.atleast_2d(deltas))
+        ramp = self.speed ** 2 / self.accel
+        t = np.where(d < ramp, 2 * np.sqrt(d / self.accel), d / self.speed + self.speed / self.accel)
+        t = t.max(axis=1)
+        return np.where(t > 0, t + self.settle, 0.0)
+
+    def path_time(self, points):
+        if len(points) < 2:
+            return 0.0
+        return float(self.move_time(np.diff(points, axis=0)).sum())
+
+
+def frange(start, stop, step):
+    # Inclusive float range, rounded so 183.79999999999995 style drift doesn't creep in
+    count = int(np.floor((stop - start) / step + 1e-9)) + 1
+    return [round(start + i * step, 10) for i in range(max(count, 0))]
+
+def serpentine(shape):
+    # Boustrophedon over a regular grid, every odd row (at every level) runs backwards
+    # so consecutive positions are always neighbours. Returns flat indices into the grid
+    if len(shape) == 0:
+        return np.zeros(1, dtype=np.intp)
+    inner = serpentine(shape[1:])
+    stride = len(inner)
+    rows = [row * stride + (inner if row % 2 == 0 else inner[::-1]) for row in range(shape[0])]
+    return np.concatenate(rows) if rows else inner[:0]
+
+def nearest_neighbour(points, start=0):
+    n = len(points)
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=np.intp)
+    current = start
+    for i in range(n):
+        order[i] = current
+        visited[current] = True
+        if i == n - 1:
+            break
+        dist = np.abs(points - points[current]).max(axis=1)
+        dist[visited] = np.inf
+        current = int(np.argmin(dist))
+    return order
+
+def two_opt(points, order, model, max_passes=5):
+    # Classic 2-opt over segment reversals, each pass vectorized over the second cut
+    order = order.copy()
+    n = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            a, b = points[order[i - 1]], points[order[i]]
+            c = points[order[i + 1:]]
+            d = points[order[np.minimum(np.arange(i + 2, n + 1), n - 1)]]
+            last = np.arange(i + 1, n) == n - 1
+            before = model.move_time(b - a) + np.where(last, 0.0, model.move_time(d - c))
+            after = model.move_time(c - a) + np.where(last, 0.0, model.move_time(d - b))
+            gain = before - after
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-9:
+                j += i + 1
+                order[i:j + 1] = order[i:j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+class ScanPlan:
+    def __init__(self, parameters, values, order='serpentine', model=None):
+        self.parameters = list(parameters)
+        self.values = {name: list(values[name]) for name in self.parameters}
+        self.model = model or GantryModel()
+        self.position_params = [p for p in POSITION_PARAMS if p in self.parameters]
+        self.other_params = [p for p in self.parameters if p not in self.position_params]
+
+        grid = [self.values[p] for p in self.position_params]
+        points = list(itertools.product(*grid))
+        self.grid_points = np.array(points, dtype=np.float64).reshape(len(points), len(grid))
+        self.positions = self.grid_points[self._order(order)]
+        self.per_position = int(np.prod([len(self.values[p]) for p in self.other_params]))
+
+    '''
+    Build a plan from a configured GlitchController, its glitch_values() is walked once
+    to collect the values for every parameter
+    '''
+    @classmethod
+    def from_glitch_controller(cls, gc, order='serpentine', model=None):
+        seen = [dict() for _ in gc.parameters]
+        for setting in gc.glitch_values():
+            for column, value in zip(seen, setting):
+                column.setdefault(value, None)
+        values = {name: list(column) for name, column in zip(gc.parameters, seen)}
+        return cls(gc.parameters, values, order, model)
+
+    def _order(self, order):
+        n = len(self.grid_points)
+        if n < 2 or order == 'grid' or not self.position_params:
+            return np.arange(n)
+        if order == 'serpentine':
+            return serpentine([len(self.values[p]) for p in self.position_params])
+        if order == 'tsp':
+            tour = nearest_neighbour(self.grid_points)
+            # 2-opt is quadratic per pass, only worth it on smaller windows
+            if n <= 2000:
+                tour = two_opt(self.grid_points, tour, self.model)
+            return tour
+        raise ValueError(f"Unknown scan order {order}")
+
+    def __len__(self):
+        return len(self.positions) * self.per_position
+
+    '''
+    Yield settings in GlitchController parameter order, every ext_offset / tries combination
+    is run at a position before the head moves on. start skips straight to that attempt.
+    '''
+    def glitch_values(self, start=0):
+        others = list(itertools.product(*[self.values[p] for p in self.other_params]))
+        first_pos, first_other = divmod(start, max(self.per_position, 1))
+        for pos_index in range(first_pos, len(self.positions)):
+            position = dict(zip(self.position_params, self.positions[pos_index].tolist()))
+            for other in others[first_other:]:
+                setting = dict(position)
+                setting.update(zip(self.other_params, other))
+                yield tuple(setting[p] for p in self.parameters)
+            first_other = 0
+
+    def baseline_points(self):
+        # Positions in the order a GlitchController would visit them (itertools.product
+        # over the parameters as declared), one row per attempt
+        shape = [len(self.values[p]) for p in self.parameters]
+        index = np.indices(shape).reshape(len(shape), -1)
+        columns = [np.asarray(self.values[p], dtype=np.float64)[index[self.parameters.index(p)]] for p in self.position_params]
+        return np.stack(columns, axis=1)
+
+    '''
+    Estimated motion time for the GlitchController order against this plan
+    '''
+    def report(self):
+        if not self.position_params:
+            return {'attempts': len(self), 'baseline_time': 0.0, 'planned_time': 0.0, 'saved_time': 0.0, 'moves': 0}
+        baseline = self.model.path_time(self.baseline_points())
+        planned = self.model.path_time(self.positions)
+        return {
+            'attempts': len(self),
+            'positions': len(self.positions),
+            'moves': len(self.positions) - 1,
+            'baseline_time': baseline,
+            'planned_time': planned,
+            'saved_time': baseline - planned,
+        }
+
+
+if __name__ == "__main__":
+    import sys
+    # Example: the G3D test firmware window
+    plan = ScanPlan(["ext_offset", "x", "y", "z", "tries"], {
+        "ext_offset": range(8, 20),
+        "x": frange(172, 179, .1),
+        "y": frange(103, 109, .1),
+        "z": frange(20.7, 21.2, .1),
+        "tries": range(1, 6),
+    }, order=sys.argv[1] if len(sys.argv) > 1 else 'serpentine')
+    print(plan.report())
@@ -0,0 +1,170 @@
+import json
+import queue
+import time
+import multiprocessing as mp
+import numpy as np
+from resultstore import ResultStore, RECORD_DTYPE, PHASE_RDP2
+from analysis import SUCCESS_RESULTS
+
+'''
+Multi rig campaign scheduler
+
+One ScanPlan is cut into work units (a contiguous run of attempts, by default everything at
+one probe position) and every rig runs in its own worker process with its own device config.
+Workers pull the next unit from a shared queue as soon as they finish one, so a faster rig
+simply ends up doing more units. Results stream back to the parent, which merges them into
+a single ResultStore. If a worker dies or its rig raises, its unfinished unit goes back on the
+queue for the other rigs, if none are left run() raises.
+
+Rig classes (rig.HardwareRig, rig.SimRig) are built inside the worker from their config,
+so nothing touches hardware in the parent process.
+'''
+
+def load_rigs(path):
+    with open(path) as infile:
+        return json.load(infile)
+
+def make_units(plan, unit_size=None):
+    unit_size = unit_size or max(plan.per_position, 1)
+    return [(start, min(start + unit_size, len(plan))) for start in range(0, len(plan), unit_size)]
+
+def worker(rig_class, config, plan, work, results, stop):
+    name = config['name']
+    rig = None
+    try:
+        # Inside the try, a rig that fails to open still reports its exit
+        rig = rig_class(config)
+        while not stop.is_set():
+            try:
+                unit = work.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if unit is None:
+                break
+            results.put(('start', name, unit, None))
+            start, end = unit
+            settings = []
+            for setting in plan.glitch_values(start):
+                settings.append(dict(zip(plan.parameters, setting)))
+                if len(settings) == end - start:
+                    break
+            codes = rig.run(settings)
+            results.put(('done', name, unit, (time.time(), settings, codes)))
+    finally:
+        if rig is not None:
+            rig.close()
+        results.put(('exit', name, None, None))
+
+
+class Scheduler:
+    def __init__(self, plan, rigs, store_path, rig_class=None, unit_size=None, phase=PHASE_RDP2):
+        if rig_class is None:
+            from rig import HardwareRig
+            rig_class = HardwareRig
+        self.plan = plan
+        self.rigs = rigs
+        self.rig_class = rig_class
+        self.store_path = store_path
+        self.units = make_units(plan, unit_size)
+        self.phase = phase
+        self.ctx = mp.get_context('spawn')
+        # Per rig bookkeeping, units done, attempts and successes
+        self.rig_stats = {config['name']: {'units': 0, 'attempts': 0, 'successes': 0} for config in rigs}
+
+    def _records(self, timestamp, settings, codes):
+        records = np.zeros(len(settings), dtype=RECORD_DTYPE)
+        records['timestamp'] = timestamp
+        for name, column in (('ext_offset', 'offset'), ('x', 'x'), ('y', 'y'), ('z', 'z'), ('tries', 'tries')):
+            if name in self.plan.parameters:
+                records[column] = [named[name] for named in settings]
+        records['phase'] = self.phase
+        records['result'] = codes
+        return records
+
+    '''
+    Run every unit across the rigs, stop_after ends the campaign early after that many successes
+    Returns the per rig statistics
+    '''
+    def run(self, stop_after=None):
+        work = self.ctx.Queue()
+        results = self.ctx.Queue()
+        stop = self.ctx.Event()
+        for unit in self.units:
+            work.put(unit)
+        procs = {}
+        for config in self.rigs:
+            proc = self.ctx.Process(target=worker, name=config['name'],
+                                    args=(self.rig_class, config, self.plan, work, results, stop))
+            proc.start()
+            procs[config['name']] = proc
+
+        in_flight = {}
+        remaining = len(self.units)
+        successes = 0
+        # Timed from the first unit picked up, spawning workers and opening devices isn't counted
+        start = None
+        with ResultStore(self.store_path) as store:
+            while remaining and procs:
+                try:
+                    kind, name, unit, payload = results.get(timeout=0.5)
+                except queue.Empty:
+                    # Requeue the unit of any worker that died without reporting back
+                    for name, proc in list(procs.items()):
+                        if not proc.is_alive():
+                            if name in in_flight:
+                                work.put(in_flight.pop(name))
+                            del procs[name]
+                    continue
+                if kind == 'start':
+                    in_flight[name] = unit
+                    start = start or time.monotonic()
+                elif kind == 'done':
+                    in_flight.pop(name, None)
+                    timestamp, settings, codes = payload
+                    store.extend(self._records(timestamp, settings, codes))
+                    hits = int(np.isin(codes, SUCCESS_RESULTS).sum())
+                    successes += hits
+                    stats = self.rig_stats[name]
+                    stats['units'] += 1
+                    stats['attempts'] += len(codes)
+                    stats['successes'] += hits
+                    remaining -= 1
+                    if stop_after is not None and successes >= stop_after:
+                        break
+                elif kind == 'exit':
+                    # A worker whose rig raised exits with its unit unfinished
+                    if name in in_flight:
+                        work.put(in_flight.pop(name))
+                    procs.pop(name, None)
+        stop.set()
+        for _ in procs:
+            work.put(None)
+        for proc in procs.values():
+            proc.join(timeout=5)
+        self.elapsed = time.monotonic() - start if start else 0.0
+        self.attempts = sum(stats['attempts'] for stats in self.rig_stats.values())
+        if remaining and not procs:
+            raise RuntimeError(f"every rig exited with {remaining} of {len(self.units)} units left undone")
+        return self.rig_stats
+
+
+if __name__ == "__main__":
+    import sys
+    import os
+    import tempfile
+    from scanplan import ScanPlan, frange
+    from rig import SimRig
+    # Simulated rigs with different speeds, throughput should scale with the number of rigs
+    plan = ScanPlan(["ext_offset", "x", "y", "tries"], {
+        "ext_offset": range(7790, 7810),
+        "x": frange(183.7, 184.1, .1),
+        "y": frange(86.5, 86.9, .1),
+        "tries": [1],
+    })
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for n in range(1, count + 1):
+        rigs = [{'name': f"sim{i}", 'attempt_time': 0.01 * (1 + i / 2), 'seed': i} for i in range(n)]
+        path = os.path.join(tempfile.mkdtemp(), 'sched.glitchstore')
+        sched = Scheduler(plan, rigs, path, rig_class=SimRig)
+        stats = sched.run()
+        print(f"{n} rigs: {sched.attempts} attempts in {sched.elapsed:.2f}s ({sched.attempts / sched.elapsed:.0f}/s) {stats}")
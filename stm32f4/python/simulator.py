@@ -0,0 +1,380 @@
+import os
+import select
+import threading
+import time
+import tty
+import numpy as np
+from scanplan import GantryModel
+from rig import hotspot_probability
+
+'''
+Hardware free stand ins for the rig
+
+Each serial device is emulated behind a pseudo terminal, so the real drivers (stm32bl,
+picoemp.ChipShouterPicoEMP, printer.GCodePrinter) open the pty path like any USB serial port
+and run unchanged:
+- BootloaderEmulator: STM32 UART bootloader, 0x7F sync, GET, GET_VERSION, GET_ID, READ_MEMORY
+- PicoEMPEmulator: the PicoEMP serial shell
+- PrinterEmulator: G-code with "ok" replies, moves take as long as scanplan.GantryModel says
+MockScope stands in for the Husky, power cycling or resetting the target through it is what
+lands glitches. SimulatedTarget wires them together: whether a glitch works is drawn from
+a hotspot probability over the scope ext_offset and the printer position.
+'''
+
+SIM_DEFAULTS = {
+    # RDP2: power cycle glitch that lands the target in the bootloader
+    'rdp2_center': {'ext_offset': 7810, 'x': 184.6, 'y': 86.8},
+    'rdp2_width': {'ext_offset': 8.0, 'x': 0.2, 'y': 0.2},
+    'rdp2_peak': 0.3,
+    # RDP1: glitch on the read command that lets READ_MEMORY through
+    'rdp1_center': {'ext_offset': 500},
+    'rdp1_width': {'ext_offset': 40.0},
+    'rdp1_peak': 0.2,
+    # Chance the target is still in the bootloader after an nRST reset
+    'reset_keeps_bootloader': 0.98,
+    'flash_base': 0x8000000,
+    'flash_size': 1024 * 256,
+    # Device latencies in seconds
+    'uart_reply': 0.0002,
+    'arm_time': 0.005,
+    'capture_time': 0.002,
+    'seed': None,
+}
+
+
+class PtyDevice:
+    '''
+    A serial device behind a pty, port is the path to open. Subclasses implement feed(data)
+    and answer with write()
+    '''
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            self.feed(data)
+
+    def feed(self, data):
+        raise NotImplementedError
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class LineDevice(PtyDevice):
+    def __init__(self):
+        self._line = b''
+        super().__init__()
+
+    def feed(self, data):
+        self._line += data
+        while b'\n' in self._line:
+            line, self._line = self._line.split(b'\n', 1)
+            self.line(line.strip().decode(errors='replace'))
+
+    def line(self, line):
+        raise NotImplementedError
+
+
+class BootloaderEmulator(PtyDevice):
+    ACK = b'\x79'
+    NACK = b'\x1f'
+    COMMANDS = bytes([0x00, 0x01, 0x02, 0x11, 0x21, 0x31, 0x43, 0x63, 0x73, 0x82, 0x92])
+
+    '''
+    flash is the bytes served by READ_MEMORY at base. read_allowed() is asked on every
+    READ_MEMORY command, with RDP set that is the glitch decision
+    '''
+    def __init__(self, flash, base, read_allowed, reply_delay=0.0):
+        self.flash = flash
+        self.base = base
+        self.read_allowed = read_allowed
+        self.reply_delay = reply_delay
+        # The target only talks while it is running the bootloader
+        self.active = False
+        self._pending = b''
+        self._state = 'command'
+        self._address = None
+        super().__init__()
+
+    def reset(self, bootloader):
+        self.active = bootloader
+        self._pending = b''
+        self._state = 'command'
+
+    def reply(self, data):
+        if self.reply_delay:
+            time.sleep(self.reply_delay)
+        self.write(data)
+
+    def feed(self, data):
+        if not self.active:
+            return
+        self._pending += data
+        while self._pending:
+            if not self._step():
+                break
+
+    def _take(self, n):
+        if len(self._pending) < n:
+            return None
+        data, self._pending = self._pending[:n], self._pending[n:]
+        return data
+
+    def _step(self):
+        # Returns False when more bytes are needed
+        if self._state == 'command':
+            if self._pending[0] == 0x7F:
+                self._take(1)
+                self.reply(self.ACK)
+                return True
+            pair = self._take(2)
+            if pair is None:
+                return False
+            if pair[0] ^ pair[1] != 0xFF:
+                self.reply(self.NACK)
+            elif pair[0] == 0x00:
+                self.reply(self.ACK + bytes([len(self.COMMANDS), 0x31]) + self.COMMANDS + self.ACK)
+            elif pair[0] == 0x01:
+                self.reply(self.ACK + b'\x31\x00\x00' + self.ACK)
+            elif pair[0] == 0x02:
+                self.reply(self.ACK + b'\x01\x04\x13' + self.ACK)
+            elif pair[0] == 0x11 and self.read_allowed():
+                self._state = 'address'
+                self.reply(self.ACK)
+            else:
+                self.reply(self.NACK)
+            return True
+        if self._state == 'address':
+            data = self._take(5)
+            if data is None:
+                return False
+            xsum = data[0] ^ data[1] ^ data[2] ^ data[3]
+            address = int.from_bytes(data[:4], 'big')
+            if xsum != data[4] or not self.base <= address < self.base + len(self.flash):
+                self._state = 'command'
+                self.reply(self.NACK)
+            else:
+                self._address = address
+                self._state = 'length'
+                self.reply(self.ACK)
+            return True
+        if self._state == 'length':
+            data = self._take(2)
+            if data is None:
+                return False
+            self._state = 'command'
+            if data[0] ^ data[1] != 0xFF:
+                self.reply(self.NACK)
+            else:
+                start = self._address - self.base
+                self.reply(self.ACK + bytes(self.flash[start:start + data[0] + 1]))
+            return True
+        return False
+
+
+class PicoEMPEmulator(LineDevice):
+    def __init__(self, arm_time=0.0):
+        self.arm_time = arm_time
+        self.armed = False
+        self.external_hvp = False
+        self.timeout_disabled = False
+        super().__init__()
+
+    def line(self, line):
+        if line == '':
+            self.write(b'PicoEMP Commands:\r\n- arm\r\n- disarm\r\n- pulse\r\n- status\r\n'
+                       b'- enable_timeout\r\n- disable_timeout\r\n- fast_trigger\r\n- external_hvp\r\n')
+        elif line == 'arm':
+            time.sleep(self.arm_time)
+            self.armed = True
+            self.write(b'Device armed!\r\n')
+        elif line == 'disarm':
+            self.armed = False
+            self.write(b'Device disarmed!\r\n')
+        elif line == 'disable_timeout':
+            self.timeout_disabled = True
+            self.write(b'Timeout disabled!\r\n')
+        elif line == 'external_hvp':
+            self.external_hvp = True
+            self.write(b'External HVP mode active\r\n')
+        elif line == 'fast_trigger':
+            self.write(b'Fast trigger active\r\n')
+        elif line == 'status':
+            self.write(f"Status:\r\n- Armed: {self.armed}\r\n- Charged: {self.armed}\r\n"
+                       f"- Timeout active: {not self.timeout_disabled}\r\n"
+                       f"- External HVP: {self.external_hvp}\r\n".encode())
+        else:
+            self.write(b'Unknown command\r\n')
+
+
+class PrinterEmulator(LineDevice):
+    def __init__(self, model=None):
+        self.model = model or GantryModel()
+        self.position = [0.0, 0.0, 0.0]
+        # Moves queue up like in the firmware, M400 answers once the last one is done
+        self.busy_until = time.monotonic()
+        self.moves = 0
+        super().__init__()
+
+    def line(self, line):
+        words = line.split()
+        if not words:
+            return
+        if words[0] in ('G0', 'G1'):
+            target = list(self.position)
+            for word in words[1:]:
+                if word[0] in 'XYZ':
+                    target['XYZ'.index(word[0])] = float(word[1:])
+            duration = float(self.model.move_time(np.subtract(target, self.position))[0])
+            self.busy_until = max(self.busy_until, time.monotonic()) + duration
+            self.position = target
+            self.moves += 1
+        elif words[0] == 'M400':
+            time.sleep(max(self.busy_until - time.monotonic(), 0))
+        elif words[0] == 'M114':
+            self.write("X:{:.2f} Y:{:.2f} Z:{:.2f}\n".format(*self.position).encode())
+        self.write(b'ok\n')
+
+
+class _Settings:
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+class _ScopeIO:
+    def __init__(self, target):
+        self._target = target
+        self._target_pwr = True
+        self._nrst = 'high_z'
+        self.glitch_hp = True
+        self.glitch_lp = True
+        self.glitch_trig_mcx = 'glitch'
+        self.hs2 = 'glitch'
+        self.tio_states = (1, 1, 0, 1)
+
+    @property
+    def target_pwr(self):
+        return self._target_pwr
+
+    @target_pwr.setter
+    def target_pwr(self, value):
+        if value and not self._target_pwr:
+            self._target.power_on()
+        self._target_pwr = value
+
+    @property
+    def nrst(self):
+        return self._nrst
+
+    @nrst.setter
+    def nrst(self, value):
+        if value == 'high_z' and self._nrst is False:
+            self._target.reset()
+        self._nrst = value
+
+
+class MockScope:
+    '''
+    Just enough of a Husky for rig.py and stm32f4-3d.py: glitch / io / trigger / clock / adc
+    settings, arm(), capture() and a flat trace
+    '''
+    def __init__(self, target, capture_time=0.0, samples=5000):
+        self.target = target
+        self.capture_time = capture_time
+        self.samples = samples
+        self.armed = False
+        self.glitch = _Settings(ext_offset=0, clk_src='pll', output='enable_only', trigger_src='ext_single',
+                                repeat=500, width=40, offset=-45, enabled=True, mmcm_locked=True)
+        self.glitch.resetDCMs = lambda keepPhase=False: None
+        self.io = _ScopeIO(target)
+        self.trigger = _Settings(triggers='tio4', module='basic', edges=1)
+        self.clock = _Settings(clkgen_freq=30e6)
+        self.adc = _Settings(lo_gain_errors_disabled=False, clip_errors_disabled=False, samples=samples)
+
+    def arm(self):
+        self.armed = True
+
+    def fire(self):
+        # The glitch trigger fired, ext_single only goes off once per arm()
+        fired = self.armed
+        self.armed = False
+        return fired
+
+    def capture(self):
+        time.sleep(self.capture_time)
+        return False
+
+    def get_last_trace(self):
+        return np.zeros(self.samples)
+
+    def reset_fpga(self):
+        pass
+
+    def default_setup(self):
+        pass
+
+
+class SimulatedTarget:
+    '''
+    Everything a HardwareRig needs, with the glitch physics in between:
+    rig.HardwareRig(sim.rig_config(), scope=sim.scope)
+    '''
+    def __init__(self, config=None):
+        self.config = dict(SIM_DEFAULTS, **(config or {}))
+        self.rng = np.random.default_rng(self.config['seed'])
+        self.flash = self.rng.integers(0, 256, self.config['flash_size'], dtype=np.uint8).tobytes()
+        self.target = BootloaderEmulator(self.flash, self.config['flash_base'], self._read_allowed,
+                                         self.config['uart_reply'])
+        self.pico = PicoEMPEmulator(self.config['arm_time'])
+        self.printer = PrinterEmulator()
+        self.scope = MockScope(self, self.config['capture_time'])
+        self.glitches = 0
+
+    def rig_config(self, name='sim'):
+        return {'name': name, 'uart': self.target.port, 'pico': self.pico.port, 'printer': self.printer.port}
+
+    def _setting(self):
+        x, y, z = self.printer.position
+        return {'ext_offset': self.scope.glitch.ext_offset, 'x': x, 'y': y, 'z': z}
+
+    def _glitch(self, phase):
+        if not (self.scope.fire() and self.pico.armed):
+            return False
+        self.glitches += 1
+        c = self.config
+        return self.rng.random() < hotspot_probability(self._setting(), c[f'{phase}_center'], c[f'{phase}_width'], c[f'{phase}_peak'])
+
+    def _read_allowed(self):
+        return self._glitch('rdp1')
+
+    def power_on(self):
+        self.target.reset(self._glitch('rdp2'))
+
+    def reset(self):
+        self.target.reset(self.target.active and self.rng.random() < self.config['reset_keeps_bootloader'])
+
+    def enter_bootloader(self):
+        self.target.reset(True)
+
+    def close(self):
+        for device in (self.target, self.pico, self.printer):
+            device.close()
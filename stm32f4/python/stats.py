@@ -0,0 +1,114 @@
+import numpy as np
+from analysis import GLITCH_RESULTS, SUCCESS_RESULTS
+
+'''
+NumPy backed statistics over parsed glitch results
+
+Everything here works on a structured array with at least the x, y, offset and result
+columns (see analysis.GLITCH_DTYPE), so the output of parse_results_array and the
+result store can be used directly. Nothing is printed, every function returns plain
+dicts of arrays so they drop straight into pd.DataFrame(...) in the notebooks.
+'''
+
+# X/Y coordinates come from float sums in the printer loop (183.79999999999995 etc)
+# so positions are rounded to the printer resolution before grouping
+POSITION_DECIMALS = 2
+
+def result_counts(results):
+    counts = np.bincount(results['result'], minlength=len(GLITCH_RESULTS))
+    return {GLITCH_RESULTS.get(code, code): int(count) for code, count in enumerate(counts)}
+
+'''
+Return the k most frequent values and their counts, highest count first
+argpartition keeps this O(n) in the number of distinct values
+'''
+def top_k(values, counts, k=5):
+    if len(counts) == 0:
+        return values[:0], counts[:0]
+    k = min(k, len(counts))
+    top = np.argpartition(counts, -k)[-k:]
+    # Stable ordering on ties: higher count first, then lower value
+    top = top[np.lexsort((values[top], -counts[top]))]
+    return values[top], counts[top]
+
+def top_offsets(results, k=5, result=None):
+    offsets = results['offset']
+    if result is not None:
+        offsets = offsets[results['result'] == result]
+    values, counts = np.unique(offsets, return_counts=True)
+    return top_k(values, counts, k)
+
+def position_index(results, decimals=POSITION_DECIMALS):
+    pos = np.empty(len(results), dtype=[('x', np.float64), ('y', np.float64)])
+    pos['x'] = np.round(results['x'], decimals)
+    pos['y'] = np.round(results['y'], decimals)
+    cells, inverse = np.unique(pos, return_inverse=True)
+    return cells, inverse.reshape(-1)
+
+'''
+Compute every statistic from a single factorization of the offset, position and result columns
+
+Returns a dict with:
+- counts: per result name totals
+- top_offsets: result name -> (offsets, counts) for the k best offsets
+- cells: x, y, attempts, successes and rate for every (x, y) position
+- crosstab: sparse offset x position table of successes (offset, x, y, count)
+'''
+def campaign_stats(results, k=5, success=SUCCESS_RESULTS, decimals=POSITION_DECIMALS):
+    codes = results['result'].astype(np.intp)
+    n_codes = max(len(GLITCH_RESULTS), int(codes.max()) + 1 if len(codes) else 0)
+    offsets, off_idx = np.unique(results['offset'], return_inverse=True)
+    off_idx = off_idx.reshape(-1)
+    cells, cell_idx = position_index(results, decimals)
+    is_success = np.isin(codes, success)
+
+    # result x offset table, every per-result top-k comes out of this one bincount
+    by_offset = np.bincount(codes * len(offsets) + off_idx,
+                            minlength=n_codes * len(offsets)).reshape(n_codes, len(offsets))
+    top = {}
+    for code in range(n_codes):
+        if by_offset[code].any():
+            hit = by_offset[code] > 0
+            top[GLITCH_RESULTS.get(code, code)] = top_k(offsets[hit], by_offset[code][hit], k)
+
+    attempts = np.bincount(cell_idx, minlength=len(cells))
+    successes = np.bincount(cell_idx, weights=is_success, minlength=len(cells)).astype(np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = np.where(attempts > 0, successes / attempts, 0.0)
+
+    # Sparse cross tab so large grids with few hits stay small
+    key = cell_idx[is_success].astype(np.int64) * len(offsets) + off_idx[is_success]
+    keys, key_counts = np.unique(key, return_counts=True)
+    ct_cells = cells[keys // max(len(offsets), 1)]
+
+    return {
+        'counts': {GLITCH_RESULTS.get(code, code): int(count) for code, count in enumerate(by_offset.sum(axis=1))},
+        'top_offsets': top,
+        'cells': {
+            'x': cells['x'],
+            'y': cells['y'],
+            'attempts': attempts,
+            'successes': successes,
+            'rate': rate,
+        },
+        'crosstab': {
+            'offset': offsets[keys % max(len(offsets), 1)],
+            'x': ct_cells['x'],
+            'y': ct_cells['y'],
+            'count': key_counts,
+        },
+    }
+
+'''
+Dense offset x position matrix from the sparse cross tab, rows follow the returned offsets
+and columns follow the returned (x, y) cells
+'''
+def crosstab_dense(crosstab):
+    offsets, off_idx = np.unique(crosstab['offset'], return_inverse=True)
+    pos = np.empty(len(crosstab['count']), dtype=[('x', np.float64), ('y', np.float64)])
+    pos['x'] = crosstab['x']
+    pos['y'] = crosstab['y']
+    cells, cell_idx = np.unique(pos, return_inverse=True)
+    table = np.zeros((len(offsets), len(cells)), dtype=np.int64)
+    np.add.at(table, (off_idx.reshape(-1), cell_idx.reshape(-1)), crosstab['count'])
+    return offsets, cells, table
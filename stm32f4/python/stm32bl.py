@@ -3,26 +3,94 @@ import struct
 import time
 import sys
 import logging
+from bisect import bisect_left
+import timing
+
+ACK = 0x79
+NACK = 0x1F
 
 # Configure and create the serial connection
 port="/dev/serial/by-id/usb-FTDI_FT232R_USB_UART_A5XK3RJT-if00-port0"
 baud_rate = 115200  # Set the baud rate to match your STM32 bootloader configuration
-timeout = .2  # Set the timeout value as needed
-ser = serial.Serial(port, baud_rate, parity="E", timeout=timeout)
-
+timeout = .2  # Upper bound for a whole data phase once the target has ACKed
+# How long to wait for the first ACK/NACK byte. During glitching the target usually never
+# answers, so this is what each failed probe costs. Keep it above the FTDI latency timer (16ms)
+ack_timeout = .05
+ser = None
+
+def connect(port=port, baud_rate=baud_rate):
+    global ser
+    # Reads are bounded by the short ACK timeout, longer phases loop in read_exact
+    ser = serial.Serial(port, baud_rate, parity="E", timeout=ack_timeout)
+    return ser
+
+# Per command latency histograms, keyed by "<Command>:<ACK|NACK|TIMEOUT>"
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+latency_counts = {}
+
+def record_latency(name, seconds):
+    counts = latency_counts.get(name)
+    if counts is None:
+        counts = latency_counts[name] = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    counts[bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+def reset_latency():
+    latency_counts.clear()
+
+def log_latency_histograms(logger=None):
+    logger = logger or logging.getLogger('GDBG')
+    labels = [f"<{b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+    for name in sorted(latency_counts):
+        counts = latency_counts[name]
+        hist = " ".join(f"{label}:{count}" for label, count in zip(labels, counts) if count)
+        logger.debug(f"UART latency {name} n={sum(counts)} {hist}")
+
+# Read exactly n bytes, returns early as soon as they are in, or whatever arrived by the deadline
+# Each underlying read is bounded by ser.timeout (ack_timeout), so that is the granularity here
+def read_exact(n, deadline):
+    data = ser.read(n)
+    while len(data) < n and time.monotonic() < deadline:
+        data += ser.read(n - len(data))
+    return data
 
 # Helper function to send a bootloader command and receive the response
-def send_command(command, cmd_response=2, more_dat=False):
+# Returns the ACK/NACK byte followed by any data phase, or b'' if the target stayed quiet
+@timing.timed('uart.send_command')
+def send_command(command, ack_wait=None):
+    start = time.monotonic()
     ser.write(command.to_bytes())  # Send the command
-    time.sleep(0.01)  # Wait for a short delay to allow the response to be processed
-    response = ser.read(command.read_len)
+    # Wait for the first byte only, don't sit on the full read timeout
+    response = read_exact(1, start + (ack_wait or command.ack_timeout or ack_timeout))
+    if len(response) == 0:
+        record_latency(f"{type(command).__name__}:TIMEOUT", time.monotonic() - start)
+        return response
+    if response[0] != ACK:
+        record_latency(f"{type(command).__name__}:NACK", time.monotonic() - start)
+        return response
+    # Stream the data phase by its known length
+    deadline = time.monotonic() + timeout
+    data_len = command.data_len
+    if data_len is None:
+        # Length prefixed replies (GET, GET_ID): N then N+1 bytes
+        count = read_exact(1, deadline)
+        response += count
+        data_len = count[0] + 1 if count else 0
+    if command.trailing_ack:
+        data_len += 1
+    if data_len:
+        response += read_exact(data_len, deadline)
+    record_latency(f"{type(command).__name__}:ACK", time.monotonic() - start)
     return response
 
 class BootloaderCommand:
     def __init__(self, command_byte):
         self.command_byte = command_byte
         self.checksum = 0
-        self.read_len = 2
+        # Bytes expected after the ACK, None when the first data byte gives the length
+        self.data_len = 0
+        self.trailing_ack = False
+        # Optional per command override of the module ack_timeout
+        self.ack_timeout = None
         if self.command_byte != 0x7F:
             self.get_checksum()
 
@@ -35,6 +103,10 @@ class BootloaderCommand:
     def get_checksum(self):
         self.checksum = (~self.command_byte) & 0xFF
 
+    @property
+    def read_len(self):
+        return 1 + (self.data_len or 0) + (1 if self.trailing_ack else 0)
+
 
 class SetBaudRate(BootloaderCommand):
     def __init__(self):
@@ -44,16 +116,22 @@ class SetBaudRate(BootloaderCommand):
 class GetCommand(BootloaderCommand):
     def __init__(self):
         super().__init__(0x00)
+        self.data_len = None
+        self.trailing_ack = True
 
 
 class GetVersionCommand(BootloaderCommand):
     def __init__(self):
         super().__init__(0x01)
+        self.data_len = 3
+        self.trailing_ack = True
 
 
 class GetIDCommand(BootloaderCommand):
     def __init__(self):
         super().__init__(0x02)
+        self.data_len = None
+        self.trailing_ack = True
 
 
 class ReadMemoryCommand(BootloaderCommand):
@@ -65,7 +143,10 @@ class MemoryAddrCommand():
     def __init__(self, address):
         self.address = address
         self.xsum = 0
-        self.read_len = 2
+        self.data_len = 0
+        self.trailing_ack = False
+        self.ack_timeout = None
+        self.read_len = 1
         self.calculate_checksum()
 
     def to_bytes(self):
@@ -84,7 +165,8 @@ class MemoryAddrCommand():
 class MemoryLenCommand(BootloaderCommand):
     def __init__(self, length):
         super().__init__(length)
-        self.read_len = length + 3
+        # The bootloader sends length + 1 bytes after the ACK
+        self.data_len = length + 1
 
 
 class GoCommand(BootloaderCommand):
@@ -123,6 +205,8 @@ class WriteMemoryCommand(BootloaderCommand):
         data_length_bytes = len(self.data).to_bytes(2, 'little')
         return command_bytes + address_bytes + data_length_bytes + self.data
 
+# Returns the length + 1 bytes of data that were read, or None on NACK / no response
+@timing.timed('uart.read_memory')
 def read_memory(address, size,scope):
     logger = logging.getLogger('GDBG')
     logger.setLevel(logging.DEBUG)
@@ -134,12 +218,10 @@ def read_memory(address, size,scope):
     ]
     for cmd in read_sequence:
         response = send_command(cmd)
-        time.sleep(.01)
         if len(response) == 0:
             return None
-        if response[0] == '\x1f':
+        if response[0] == NACK:
             logger.debug(f"NACK CMD: {cmd.to_bytes()} Resp: {response}")
             return None
         logger.debug(f"CMD: {cmd.to_bytes()} Resp: {response}")
-    return response
-
+    return response[1:]
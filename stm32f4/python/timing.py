@@ -0,0 +1,186 @@
+import csv
+import json
+import threading
+import time
+from functools import wraps
+import numpy as np
+
+'''
+Span timing for the campaign loop
+
+    with timing.span('detect_bootloader'):
+        ...
+
+Spans are off by default, span() then hands back a shared no-op context manager so an
+instrumented call costs a few hundred nanoseconds. Once enable()d, each span is written to a
+fixed size ring buffer (name, attempt, start, duration), the oldest spans are overwritten
+when it is full. Spans from the device threads go into the same buffer.
+
+summary() gives per span count / mean / percentiles, export_csv() and export_json() write
+the raw spans or the summary out for a look in a notebook.
+'''
+
+SPAN_DTYPE = np.dtype([
+    ('name', '<u2'),
+    ('attempt', '<u4'),
+    ('start', '<f8'),
+    ('duration', '<f8'),
+])
+PERCENTILES = (50, 90, 99)
+
+enabled = False
+_buffer = np.zeros(0, dtype=SPAN_DTYPE)
+_count = 0
+_lock = threading.Lock()
+_names = {}
+attempt = 0
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+def enable(capacity=1 << 16):
+    global enabled, _buffer, _count, attempt
+    _buffer = np.zeros(capacity, dtype=SPAN_DTYPE)
+    _count = 0
+    attempt = 0
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def span(name):
+    if not enabled:
+        return _NO_SPAN
+    return _Span(name)
+
+'''
+Decorator version of span(), the name defaults to the function name
+'''
+def timed(name=None):
+    def decorate(function):
+        label = name or function.__name__
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(label, start, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def next_attempt():
+    # Spans recorded from here on are grouped under the next attempt number
+    global attempt
+    attempt += 1
+
+def record(name, start, duration):
+    global _count
+    # Spans come in from the device threads too
+    with _lock:
+        name_id = _names.get(name)
+        if name_id is None:
+            name_id = _names[name] = len(_names)
+        _buffer[_count % len(_buffer)] = (name_id, attempt, start, duration)
+        _count += 1
+
+'''
+Recorded spans in the order they finished, oldest first
+'''
+def spans():
+    with _lock:
+        if _count <= len(_buffer):
+            return _buffer[:_count].copy()
+        split = _count % len(_buffer)
+        return np.concatenate([_buffer[split:], _buffer[:split]])
+
+def span_names():
+    return {name_id: name for name, name_id in _names.items()}
+
+def summary(records=None):
+    records = spans() if records is None else records
+    names = span_names()
+    result = {}
+    for name_id in np.unique(records['name']):
+        durations = records['duration'][records['name'] == name_id] * 1000
+        values = np.percentile(durations, PERCENTILES)
+        stats = {
+            'count': int(len(durations)),
+            'total_ms': float(durations.sum()),
+            'mean_ms': float(durations.mean()),
+            'max_ms': float(durations.max()),
+        }
+        stats.update({f"p{p}_ms": float(v) for p, v in zip(PERCENTILES, values)})
+        result[names[int(name_id)]] = stats
+    return dict(sorted(result.items(), key=lambda item: -item[1]['total_ms']))
+
+'''
+Write the spans as CSV, raw=True writes every span, otherwise one summary row per name
+'''
+def export_csv(path, raw=False):
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        if raw:
+            names = span_names()
+            writer.writerow(['name', 'attempt', 'start', 'duration_ms'])
+            for record in spans():
+                writer.writerow([names[int(record['name'])], int(record['attempt']), f"{record['start']:.6f}", f"{record['duration'] * 1000:.4f}"])
+            return
+        stats = summary()
+        columns = ['count', 'total_ms', 'mean_ms'] + [f"p{p}_ms" for p in PERCENTILES] + ['max_ms']
+        writer.writerow(['name'] + columns)
+        for name, values in stats.items():
+            writer.writerow([name] + [round(values[column], 4) for column in columns])
+
+def export_json(path):
+    with open(path, 'w') as outfile:
+        json.dump(summary(), outfile, indent=2)
+
+def format_summary(stats=None):
+    stats = summary() if stats is None else stats
+    lines = []
+    for name, values in stats.items():
+        percentiles = " ".join(f"p{p}={values[f'p{p}_ms']:.3f}ms" for p in PERCENTILES)
+        lines.append(f"{name:24s} n={values['count']:6d} total={values['total_ms'] / 1000:8.2f}s mean={values['mean_ms']:.3f}ms {percentiles}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # Overhead of an instrumented call with timing off and on
+    n = 1000000
+    def cost():
+        start = time.perf_counter()
+        for _ in range(n):
+            with span('overhead'):
+                pass
+        return (time.perf_counter() - start) / n * 1e9
+    print(f"disabled: {cost():.0f}ns per span")
+    enable()
+    print(f"enabled: {cost():.0f}ns per span")
+    print(format_summary())
@@ -0,0 +1,247 @@
+import configparser
+import os
+import shutil
+import zipfile
+import numpy as np
+from cwproject import open_project
+
+'''
+Compact trace storage
+
+The Husky ADC is 12 bit, ChipWhisperer saves every sample as float64 code / 4096 - 0.5,
+8 bytes for 12 bits of data. A packed segment keeps the int16 ADC codes instead, in chunks
+of traces, each one optionally deflated (zlib level 1, fast) after taking the difference
+between neighbouring samples, which is what makes the codes compress well:
+
+    float64 .npy    1049 KB per trace
+    int16 codes      262 KB
+    delta + zlib      80 KB (vcap trace)
+
+The pack is a zip of .npy members (np.load() opens it too): chunk00000, chunk00001, ...
+plus gain / offset / shape / delta. The segment's .cfg gets format = int16, adcGain and
+adcOffset, and cwproject.open_project() hands out a PackedTraces for it, which decodes
+value = code * gain + offset a chunk at a time, only for the chunks that are read.
+
+Converting refuses traces that don't come back bit for bit, so it is lossless or nothing:
+
+    python tracepack.py ../traces/stm32f4-traces-vcap.cwp packed/stm32f4-traces-vcap.cwp
+'''
+
+PACK_SUFFIX = 'traces.pack'
+ADC_BITS = 12
+ADC_GAIN = 1 / (1 << ADC_BITS)
+ADC_OFFSET = -0.5
+
+
+def encode(traces, gain=ADC_GAIN, offset=ADC_OFFSET):
+    '''
+    ADC codes of float traces, ValueError unless they decode back exactly
+    '''
+    traces = np.asarray(traces, dtype=np.float64)
+    codes = np.round((traces - offset) / gain)
+    if codes.size and (codes.min() < np.iinfo(np.int16).min or codes.max() > np.iinfo(np.int16).max):
+        raise ValueError("traces are out of the int16 code range")
+    codes = codes.astype(np.int16)
+    if not np.array_equal(decode(codes, gain, offset), traces):
+        raise ValueError(f"traces are not code * {gain} + {offset}, packing would lose data")
+    return codes
+
+def decode(codes, gain=ADC_GAIN, offset=ADC_OFFSET, dtype=np.float64):
+    return codes.astype(dtype) * dtype(gain) + dtype(offset)
+
+
+class PackWriter:
+    def __init__(self, path, num_points, chunk=256, compress=True, delta=True, gain=ADC_GAIN, offset=ADC_OFFSET):
+        self.path = path
+        self.num_points = num_points
+        self.chunk = chunk
+        self.delta = delta
+        self.gain = gain
+        self.offset = offset
+        self.count = 0
+        self.chunks = 0
+        self._pending = []
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+                                    compresslevel=1 if compress else None)
+
+    def _member(self, name, array):
+        with self._zip.open(f"{name}.npy", 'w', force_zip64=True) as member:
+            np.lib.format.write_array(member, np.asarray(array), allow_pickle=False)
+
+    def _write_chunk(self, codes):
+        if self.delta:
+            codes = np.diff(codes, axis=1, prepend=np.int16(0))
+        self._member(f"chunk{self.chunks:05d}", codes)
+        self.chunks += 1
+
+    '''
+    Add float traces (checked to be lossless) or int16 codes, shape (traces, num_points)
+    '''
+    def append(self, traces):
+        traces = np.atleast_2d(traces)
+        codes = traces if traces.dtype == np.int16 else encode(traces, self.gain, self.offset)
+        self.count += len(codes)
+        self._pending.append(codes)
+        pending = sum(len(part) for part in self._pending)
+        if pending >= self.chunk:
+            codes = np.concatenate(self._pending)
+            for start in range(0, len(codes) - self.chunk + 1, self.chunk):
+                self._write_chunk(codes[start:start + self.chunk])
+            rest = len(codes) % self.chunk
+            self._pending = [codes[len(codes) - rest:]] if rest else []
+
+    def close(self):
+        if self._pending:
+            self._write_chunk(np.concatenate(self._pending))
+            self._pending = []
+        self._member('shape', np.array([self.count, self.num_points], dtype=np.int64))
+        self._member('chunk', np.array(self.chunk, dtype=np.int64))
+        self._member('gain', np.array(self.gain))
+        self._member('offset', np.array(self.offset))
+        self._member('delta', np.array(self.delta))
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedTraces:
+    '''
+    Read side of a pack, indexes like the (traces, points) float64 array it was made from
+    '''
+    def __init__(self, path, dtype=np.float64):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        self.shape = tuple(int(n) for n in self._read('shape'))
+        self.chunk = int(self._read('chunk'))
+        self.gain = float(self._read('gain'))
+        self.offset = float(self._read('offset'))
+        self.delta = bool(self._read('delta'))
+        self.dtype = np.dtype(dtype)
+        self.ndim = 2
+        # Last chunk decoded, reading a chunk row by row only inflates it once
+        self._cached = (None, None)
+
+    def _read(self, name):
+        with self._zip.open(f"{name}.npy") as member:
+            return np.lib.format.read_array(member)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def num_chunks(self):
+        return -(-self.shape[0] // self.chunk)
+
+    def chunk_codes(self, index):
+        if self._cached[0] != index:
+            codes = self._read(f"chunk{index:05d}")
+            if self.delta:
+                # int16 wraps the same way np.diff did, so the sum is exact
+                codes = np.cumsum(codes, axis=1, dtype=np.int16)
+            self._cached = (index, codes)
+        return self._cached[1]
+
+    '''
+    Raw ADC codes for rows (int, slice or index array), the SAD trigger works on these
+    '''
+    def codes(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            row = int(rows) + len(self) if rows < 0 else int(rows)
+            if not 0 <= row < len(self):
+                raise IndexError(f"index {rows} is out of bounds for {len(self)} traces")
+            return self.chunk_codes(row // self.chunk)[row % self.chunk]
+        rows = np.arange(len(self))[rows]
+        out = np.empty((len(rows), self.shape[1]), dtype=np.int16)
+        chunk_of = rows // self.chunk
+        for index in np.unique(chunk_of):
+            pick = chunk_of == index
+            out[pick] = self.chunk_codes(int(index))[rows[pick] % self.chunk]
+        return out
+
+    def __getitem__(self, key):
+        rows, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        codes = self.codes(rows)
+        if rest:
+            codes = codes[rest] if isinstance(rows, (int, np.integer)) else codes[(slice(None),) + rest]
+        return decode(codes, self.gain, self.offset, self.dtype.type)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data.astype(dtype) if dtype is not None else data
+
+    def chunks(self):
+        for index in range(self.num_chunks):
+            yield decode(self.chunk_codes(index), self.gain, self.offset, self.dtype.type)
+
+    def close(self):
+        self._zip.close()
+
+
+def pack_traces(traces, path, chunk=256, compress=True, delta=True):
+    # traces is anything indexable by row blocks, eg a memmapped .npy
+    with PackWriter(path, traces.shape[1], chunk, compress, delta) as writer:
+        for start in range(0, len(traces), chunk):
+            writer.append(traces[start:start + chunk])
+    return writer
+
+'''
+Copy a project with every segment's traces packed, the other arrays are copied as they are
+Returns (bytes before, bytes after) of the trace data
+'''
+def pack_project(source, dest, chunk=256, compress=True, delta=True, include_disabled=True):
+    project = open_project(source, include_disabled=include_disabled)
+    name = os.path.splitext(os.path.basename(dest))[0]
+    directory = os.path.join(os.path.dirname(os.path.abspath(dest)), f"{name}_data", "traces")
+    os.makedirs(directory, exist_ok=True)
+    before = after = 0
+    cfg_paths = []
+    for segment in project.segments:
+        pack_path = os.path.join(directory, f"{segment.prefix}{PACK_SUFFIX}")
+        traces = segment.array('traces')
+        writer = pack_traces(traces, pack_path, chunk, compress, delta)
+        before += os.path.getsize(segment.array_path('traces'))
+        after += os.path.getsize(pack_path)
+        for array_name in ('textin', 'textout', 'keylist', 'knownkey', 'records'):
+            if os.path.exists(segment.array_path(array_name)):
+                shutil.copy(segment.array_path(array_name), directory)
+        config = configparser.ConfigParser(interpolation=None)
+        config.optionxform = str
+        config.read(segment.path)
+        section = config['Trace Config']
+        section['format'] = 'int16'
+        section['adcGain'] = repr(writer.gain)
+        section['adcOffset'] = repr(writer.offset)
+        cfg_path = os.path.join(directory, os.path.basename(segment.path))
+        with open(cfg_path, 'w') as outfile:
+            config.write(outfile, space_around_delimiters=True)
+        cfg_paths.append(f"{name}_data/traces/{os.path.basename(segment.path)}")
+    # Same project file, pointing at every segment that was packed
+    with open(source) as infile:
+        tail = infile.read().split('[ChipWhisperer]', 1)
+    lines = ["[Trace Management]"]
+    for i, cfg_path in enumerate(cfg_paths):
+        lines += [f"tracefile{i} = {cfg_path}", f"enabled{i} = True"]
+    with open(dest, 'w') as outfile:
+        outfile.write("\n".join(lines) + "\n" + ("[ChipWhisperer]" + tail[1] if len(tail) > 1 else ""))
+    return before, after
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+    source = sys.argv[1] if len(sys.argv) > 1 else "../traces/stm32f4-traces-vcap.cwp"
+    dest = sys.argv[2] if len(sys.argv) > 2 else os.path.join(tempfile.mkdtemp(), os.path.basename(source))
+    start = time.perf_counter()
+    before, after = pack_project(source, dest)
+    print(f"Packed {source} -> {dest} in {time.perf_counter() - start:.2f}s: "
+          f"{before / 1024:.0f} KB -> {after / 1024:.0f} KB ({before / after:.1f}x)")
+    original = open_project(source, include_disabled=True).traces
+    packed = open_project(dest).traces
+    start = time.perf_counter()
+    same = np.array_equal(np.asarray(packed), np.asarray(original))
+    print(f"Read back {packed.shape} {packed.dtype} in {(time.perf_counter() - start) * 1000:.1f}ms, identical: {same}")
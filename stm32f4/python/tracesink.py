@@ -0,0 +1,279 @@
+import configparser
+import datetime
+import os
+import queue
+import threading
+import numpy as np
+
+'''
+Background trace writer
+
+Captured traces go into an in memory batch, full batches are handed to a writer thread that
+copies them into preallocated .npy files on disk. The capture side only ever copies one trace
+into memory: if the writer falls behind another batch buffer is allocated rather than waiting
+on it (stalls counts how often), so disk I/O doesn't hold up an attempt. That goes up to
+max_buffers batch buffers, after that append() blocks until the writer hands one back (waits
+counts how often) rather than dropping traces, so a writer that can't keep up at all slows
+the capture down instead of using up memory.
+
+Output uses the ChipWhisperer project layout, so cwproject.open_project and cw.open_project
+both read it: every segment is <prefix>traces.npy plus a config_<prefix>.cfg, listed in
+<name>.cwp. A segment file is preallocated for segment_size traces and trimmed when it is
+closed. numTraces in the .cfg is rewritten after every batch, so after a crash the traces
+of every batch that reached the writer are still readable with cwproject.open_project, which
+stops at numTraces. The crashed segment's .npy keeps its segment_size preallocated rows (what
+cw.open_project would show, without the textin / keylist files it also needs) until a TraceSink
+is opened on the project again and finishes it.
+The last batch still in memory, up to batch - 1 traces, is lost.
+
+Every trace can carry a record number, saved alongside as <prefix>records.npy (project.records
+in cwproject), stm32f4-3d.py gives it the index of the attempt's record in the result store.
+That is what ties a trace to its attempt, counting traces doesn't survive lost batches.
+
+    with TraceSink("../traces/rdp2-run") as sink:
+        sink.append(scope.get_last_trace(), record=len(store) - 1)
+'''
+
+def trim_npy(path, rows):
+    '''
+    Shrink a 2d .npy in place to its first rows, the header is rewritten at the same length
+    '''
+    with open(path, 'r+b') as npy:
+        version = np.lib.format.read_magic(npy)
+        start = npy.tell() + (2 if version == (1, 0) else 4)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, dtype = read_header(npy)
+        data_start = npy.tell()
+        shape = (rows,) + shape[1:]
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+        # Fewer digits in the shape, the padding takes up the difference
+        npy.seek(start)
+        npy.write(header.encode('latin1').ljust(data_start - start - 1) + b'\n')
+        npy.truncate(data_start + int(np.prod(shape)) * dtype.itemsize)
+
+def save_empty(directory, prefix, rows):
+    # cw.open_project loads these too, there is no plaintext / key for a boot trace
+    empty = np.array([None] * rows, dtype=object)
+    for name in ('textin', 'textout', 'keylist', 'knownkey'):
+        np.save(os.path.join(directory, f"{prefix}{name}.npy"), empty, allow_pickle=True)
+
+
+class TraceSink:
+    def __init__(self, project, num_points=None, dtype=np.float64, batch=32, segment_size=1024, max_buffers=4):
+        # project is the .cwp path without extension, segments go in <project>_data/traces
+        self.project = project
+        self.directory = f"{project}_data/traces"
+        os.makedirs(self.directory, exist_ok=True)
+        self.num_points = num_points
+        self.dtype = np.dtype(dtype)
+        self.batch = batch
+        self.segment_size = segment_size
+        # The two of the double buffering at least
+        self.max_buffers = max(max_buffers, 2)
+        self.segments = []
+        # Segments from an earlier run into the same project (a resumed campaign) stay listed
+        self._previous = []
+        if os.path.exists(f"{project}.cwp"):
+            config = configparser.ConfigParser(strict=False, interpolation=None)
+            config.read(f"{project}.cwp")
+            if config.has_section('Trace Management'):
+                self._previous = [path for key, path in config['Trace Management'].items() if key.startswith('tracefile')]
+        for path in self._previous:
+            self._trim_previous(os.path.join(os.path.dirname(os.path.abspath(project)), path))
+        self.count = 0
+        self.stalls = 0
+        self.waits = 0
+        self.error = None
+        self._fill = 0
+        self._buffer = None
+        self._buffers = 0
+        self._free = queue.Queue()
+        if num_points is not None:
+            self._allocate()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='tracesink', daemon=True)
+        self._writer.start()
+
+    # A segment a crashed run left preallocated, cut down to the traces its .cfg counts
+    def _trim_previous(self, cfg_path):
+        config = configparser.ConfigParser(interpolation=None)
+        if not config.read(cfg_path) or not config.has_section('Trace Config'):
+            return
+        section = config['Trace Config']
+        rows = int(section.get('numTraces', 0))
+        for name in ('traces', 'records'):
+            path = os.path.join(os.path.dirname(cfg_path), f"{section['prefix']}{name}.npy")
+            if os.path.exists(path) and len(np.load(path, mmap_mode='r')) > rows:
+                trim_npy(path, rows)
+        if not os.path.exists(os.path.join(os.path.dirname(cfg_path), f"{section['prefix']}textin.npy")):
+            save_empty(os.path.dirname(cfg_path), section['prefix'], rows)
+
+    def _buffer_pair(self):
+        return np.empty((self.batch, self.num_points), dtype=self.dtype), np.empty(self.batch, dtype=np.int64)
+
+    def _allocate(self):
+        # Double buffered: one being filled, one being written
+        for _ in range(2):
+            self._free.put(self._buffer_pair())
+        self._buffers = 2
+
+    def _new_buffer(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        if self._buffers < self.max_buffers:
+            # Every buffer is still with the writer, take another one rather than wait for it
+            self.stalls += 1
+            self._buffers += 1
+            return self._buffer_pair()
+        # As many as max_buffers allows, wait for the writer to finish one
+        self.waits += 1
+        return self._free.get()
+
+    '''
+    Queue one trace for writing, returns straight away unless all max_buffers batches are
+    waiting on the writer, then blocks until one is written
+    record is saved with it, -1 for none
+    '''
+    def append(self, trace, record=-1):
+        if self.error is not None:
+            raise self.error
+        if self.num_points is None:
+            self.num_points = len(trace)
+            self._allocate()
+        if self._buffer is None:
+            self._buffer = self._new_buffer()
+        self._buffer[0][self._fill] = trace
+        self._buffer[1][self._fill] = record
+        self._fill += 1
+        self.count += 1
+        if self._fill == self.batch:
+            self.flush()
+
+    def flush(self):
+        # Hand the current batch to the writer, it is written in the background
+        if self._fill:
+            self._queue.put((self._buffer, self._fill))
+            self._buffer = None
+            self._fill = 0
+
+    def _write_loop(self):
+        segment = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            buffer, rows = item
+            try:
+                done = 0
+                while done < rows:
+                    if segment is None or segment['count'] == self.segment_size:
+                        if segment is not None:
+                            self._close_segment(segment)
+                        segment = self._open_segment()
+                    take = min(rows - done, self.segment_size - segment['count'])
+                    segment['traces'][segment['count']:segment['count'] + take] = buffer[0][done:done + take]
+                    segment['records'][segment['count']:segment['count'] + take] = buffer[1][done:done + take]
+                    segment['count'] += take
+                    done += take
+                segment['traces'].flush()
+                segment['records'].flush()
+                self._write_config(segment)
+            except Exception as error:
+                self.error = error
+            finally:
+                self._free.put(buffer)
+                self._queue.task_done()
+        if segment is not None:
+            self._close_segment(segment)
+
+    def _open_segment(self):
+        prefix = datetime.datetime.now().strftime('%Y.%m.%d-%H.%M.%S') + f"_{len(self._previous) + len(self.segments)}"
+        path = os.path.join(self.directory, f"{prefix}traces.npy")
+        traces = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(self.segment_size, self.num_points))
+        records = np.lib.format.open_memmap(os.path.join(self.directory, f"{prefix}records.npy"), mode='w+',
+                                            dtype=np.int64, shape=(self.segment_size,))
+        segment = {'prefix': prefix, 'path': path, 'traces': traces, 'records': records, 'count': 0,
+                   'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        self.segments.append(segment)
+        self._write_config(segment)
+        self._write_project()
+        return segment
+
+    def _write_config(self, segment):
+        path = os.path.join(self.directory, f"config_{segment['prefix']}.cfg")
+        lines = ["[Trace Config]", "format = native", f"numTraces = {segment['count']}",
+                 f"numPoints = {self.num_points}", f"date = {segment['date']}", f"prefix = {segment['prefix']}",
+                 "targetHW = unknown", "targetSW = unknown", "scopeName = unknown", "scopeSampleRate = 0",
+                 "scopeYUnits = 0", "scopeXUnits = 0", 'notes = ""']
+        with open(path + '.tmp', 'w') as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(path + '.tmp', path)
+
+    def _close_segment(self, segment):
+        for name in ('traces', 'records'):
+            array = segment.pop(name)
+            array.flush()
+            del array
+        trim_npy(segment['path'], segment['count'])
+        trim_npy(os.path.join(self.directory, f"{segment['prefix']}records.npy"), segment['count'])
+        save_empty(self.directory, segment['prefix'], segment['count'])
+        self._write_config(segment)
+
+    def _write_project(self):
+        name = os.path.basename(self.project)
+        lines = ["[Trace Management]"]
+        paths = self._previous + [f"{name}_data/traces/config_{segment['prefix']}.cfg" for segment in self.segments]
+        for i, path in enumerate(paths):
+            lines.append(f"tracefile{i} = {path}")
+            lines.append(f"enabled{i} = True")
+        lines += ["[ChipWhisperer]", "[[General Settings]]", f"Project Name = {name}",
+                  "Project File Version = 1.00", "Project Author = Unknown", "Program Name = ChipWhisperer",
+                  'Program Version = ""']
+        with open(f"{self.project}.cwp.tmp", 'w') as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(f"{self.project}.cwp.tmp", f"{self.project}.cwp")
+
+    '''
+    Write out what is left and stop the writer, blocks until everything is on disk
+    '''
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+    from cwproject import open_project
+    # Capture rate the sink keeps up with, against a list of traces kept in memory
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    trace = np.random.default_rng(0).normal(0, 0.01, 131124)
+    project = os.path.join(tempfile.mkdtemp(), 'sink-test')
+    worst = 0.0
+    start = time.perf_counter()
+    with TraceSink(project, segment_size=200) as sink:
+        for i in range(count):
+            t0 = time.perf_counter()
+            sink.append(trace + i, record=i)
+            worst = max(worst, time.perf_counter() - t0)
+        queued = time.perf_counter() - start
+    total = time.perf_counter() - start
+    print(f"{count} traces queued in {queued:.2f}s (worst append {worst * 1000:.2f}ms), on disk after {total:.2f}s, "
+          f"{sink.stalls} stalls, {sink.waits} waits")
+    loaded = open_project(project + '.cwp')
+    assert loaded.traces.shape == (count, len(trace)) and loaded.traces[count - 1, 0] == trace[0] + count - 1
+    assert (loaded.records[:] == np.arange(count)).all()
+    loaded = loaded.traces
+    print(f"Read back {loaded.shape} from {len(sink.segments)} segments")